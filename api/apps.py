@@ -7,3 +7,11 @@ class ApiConfig(AppConfig):
     def ready(self):
         # importa y registra los signals del módulo notifications_mobile
         import api.notifications_mobile.signals_consulta  # noqa: F401
+        # invalidación de la caché de tenants al guardar/eliminar Empresa
+        import api.tenant_cache  # noqa: F401
+        # invalidación de la identidad cacheada por token (logout / cambios de Usuario)
+        import api.identity  # noqa: F401
+        # bitmaps de disponibilidad: se refrescan al crear/reprogramar/cancelar Consulta
+        import api.availability  # noqa: F401
+        # caché de TipoNotificacion / CanalNotificacion (y gemelos MN): se invalida al guardar
+        import api.catalogo_notificaciones  # noqa: F401
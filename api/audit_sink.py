@@ -0,0 +1,280 @@
+# api/audit_sink.py
+"""
+Escritura asíncrona y por lotes de la Bitácora.
+
+Antes cada request auditado (AuditMiddleware, login, cancelar cita, documentos...)
+hacía un INSERT síncrono en `bitacora` dentro del camino de la respuesta. Ahora:
+
+    registrar_bitacora(accion='crear_cita', usuario=usuario, empresa=empresa, ...)
+
+solo encola la fila en memoria (por worker). Un hilo de fondo la vuelca con
+bulk_create cuando se juntan AUDIT_BATCH_SIZE filas o pasan AUDIT_FLUSH_INTERVAL
+segundos, lo que ocurra primero. En la misma transacción se actualiza el resumen
+horario de estadísticas (api.bitacora_resumen).
+
+Si la BD no está disponible el lote se agrega a un archivo spool (JSON Lines,
+AUDIT_SPOOL_PATH) y se reinserta en el siguiente vuelco exitoso, conservando la
+fecha original del evento. Un worker que muere a mitad de esa reinserción deja un
+`.replay` con su pid que retoma el siguiente worker vivo. Al terminar el worker
+(atexit) se vacía el buffer.
+
+Con AUDIT_ASYNC = False (p. ej. en tests) la fila se inserta de forma síncrona.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+AUDIT_BATCH_SIZE = getattr(settings, 'AUDIT_BATCH_SIZE', 100)
+AUDIT_FLUSH_INTERVAL = getattr(settings, 'AUDIT_FLUSH_INTERVAL', 2.0)
+AUDIT_BUFFER_MAX = getattr(settings, 'AUDIT_BUFFER_MAX', 10000)
+AUDIT_SPOOL_PATH = getattr(
+    settings, 'AUDIT_SPOOL_PATH',
+    os.path.join(str(settings.BASE_DIR), 'var', 'audit_spool.jsonl'),
+)
+
+_queue = queue.Queue(maxsize=AUDIT_BUFFER_MAX)
+_start_lock = threading.Lock()
+_spool_lock = threading.Lock()
+_replay_lock = threading.Lock()
+_worker = None
+_pid = None
+
+
+def _fila(accion, usuario=None, empresa=None, ip_address=None, user_agent='',
+          tabla_afectada=None, registro_id=None, valores_anteriores=None, valores_nuevos=None):
+    """Snapshot serializable de la fila: solo ids, nada de instancias de modelos."""
+    return {
+        'accion': (accion or '')[:100],
+        'usuario_id': getattr(usuario, 'pk', usuario),
+        'empresa_id': getattr(empresa, 'pk', empresa),
+        'ip_address': ip_address or '0.0.0.0',
+        'user_agent': user_agent or '',
+        'tabla_afectada': tabla_afectada,
+        'registro_id': registro_id,
+        'valores_anteriores': valores_anteriores,
+        'valores_nuevos': valores_nuevos,
+        'timestamp': timezone.now().isoformat(),
+    }
+
+
+def registrar_bitacora(accion, **campos):
+    """
+    Registra un evento en la Bitácora sin bloquear el request.
+    Acepta los campos de Bitacora (usuario/empresa como instancia o id). Nunca lanza.
+    """
+    try:
+        fila = _fila(accion, **campos)
+        if not getattr(settings, 'AUDIT_ASYNC', True):
+            _insertar([fila])
+            return
+        _ensure_worker()
+        try:
+            _queue.put_nowait(fila)
+        except queue.Full:
+            # Buffer saturado (BD caída mucho tiempo): directo al spool
+            _spool([fila])
+    except Exception as e:
+        logger.error(f"[AuditSink] No se pudo registrar '{accion}': {e}")
+
+
+def _ensure_worker():
+    global _worker, _pid
+    # Tras un fork (gunicorn --preload) el hilo del padre no existe en el hijo
+    if _worker is not None and _worker.is_alive() and _pid == os.getpid():
+        return
+    with _start_lock:
+        if _worker is not None and _worker.is_alive() and _pid == os.getpid():
+            return
+        _pid = os.getpid()
+        _worker = threading.Thread(target=_run, name='audit-sink', daemon=True)
+        _worker.start()
+
+
+def _run():
+    while True:
+        try:
+            lote = _drain(block=True)
+            if lote:
+                _flush(lote)
+        except Exception as e:
+            # El hilo no puede morir: el próximo lote lo vuelve a intentar
+            logger.error(f"[AuditSink] Error inesperado en el vuelco: {e}")
+
+
+def _drain(block):
+    """Junta hasta AUDIT_BATCH_SIZE filas esperando como mucho AUDIT_FLUSH_INTERVAL."""
+    lote = []
+    deadline = time.monotonic() + AUDIT_FLUSH_INTERVAL
+    while len(lote) < AUDIT_BATCH_SIZE:
+        timeout = deadline - time.monotonic()
+        try:
+            if block and timeout > 0:
+                lote.append(_queue.get(timeout=timeout))
+            else:
+                lote.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return lote
+
+
+def _flush(lote):
+    close_old_connections()
+    try:
+        _insertar(lote)
+    except Exception as e:
+        logger.error(f"[AuditSink] BD no disponible, {len(lote)} registros al spool: {e}")
+        _spool(lote)
+        return
+    finally:
+        close_old_connections()
+    _replay_spool()
+
+
+def _insertar(filas, preservar_fecha=False):
+    from django.db import transaction
+    from .bitacora_resumen import acumular
+    from .models import Bitacora
+
+    objs = []
+    fechas = []
+    for fila in filas:
+        datos = dict(fila)
+        fechas.append(parse_datetime(datos.pop('timestamp')))
+        objs.append(Bitacora(**datos))
+
+    with transaction.atomic():
+        Bitacora.objects.bulk_create(objs, batch_size=AUDIT_BATCH_SIZE)
+
+        # timestamp es auto_now_add: bulk_create lo pisa con la hora del vuelco.
+        # Para filas del spool (que pueden tener horas) restauramos la del evento.
+        if preservar_fecha and objs and objs[0].pk is not None:
+            for obj, fecha in zip(objs, fechas):
+                obj.timestamp = fecha
+            Bitacora.objects.bulk_update(objs, ['timestamp'], batch_size=AUDIT_BATCH_SIZE)
+
+        # Resumen para estadísticas (api.bitacora_resumen), en la misma transacción
+        acumular((o.empresa_id, o.usuario_id, o.accion, o.timestamp) for o in objs)
+
+
+def _spool(filas):
+    try:
+        with _spool_lock:
+            os.makedirs(os.path.dirname(AUDIT_SPOOL_PATH), exist_ok=True)
+            with open(AUDIT_SPOOL_PATH, 'a', encoding='utf-8') as f:
+                for fila in filas:
+                    f.write(json.dumps(fila, default=str) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+    except Exception as e:
+        logger.critical(f"[AuditSink] Se perdieron {len(filas)} registros de bitácora: {e}")
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Existe, aunque sea de otro usuario
+    return True
+
+
+def _replays_huerfanos():
+    """`.replay` de workers que murieron a mitad de una reinserción."""
+    prefijo = f"{AUDIT_SPOOL_PATH}."
+    for ruta in glob.glob(f"{glob.escape(AUDIT_SPOOL_PATH)}.*.replay"):
+        pid = ruta[len(prefijo):-len('.replay')]
+        if pid.isdigit() and int(pid) != os.getpid() and not _proceso_vivo(int(pid)):
+            yield ruta
+
+
+def _leer_spool(ruta):
+    """Filas del archivo, línea por línea; una línea corrupta (p. ej. escritura cortada) se descarta sola."""
+    filas = []
+    with open(ruta, encoding='utf-8', errors='replace') as f:
+        for n, linea in enumerate(f, 1):
+            if not linea.strip():
+                continue
+            try:
+                filas.append(json.loads(linea))
+            except ValueError as e:
+                logger.error(f"[AuditSink] Línea {n} de {ruta} ilegible, se descarta: {e}")
+    return filas
+
+
+def _reinsertar(replaying):
+    """Inserta el contenido de `replaying` y lo borra. Lo que no entra vuelve al spool; False si falló."""
+    filas = _leer_spool(replaying)
+    ok = True
+    for i in range(0, len(filas), AUDIT_BATCH_SIZE):
+        try:
+            _insertar(filas[i:i + AUDIT_BATCH_SIZE], preservar_fecha=True)
+        except Exception as e:
+            # Lo que falta vuelve al spool para el próximo vuelco
+            logger.error(f"[AuditSink] Falló la reinserción del spool: {e}")
+            _spool(filas[i:])
+            ok = False
+            break
+    else:
+        logger.info(f"[AuditSink] Reinsertados {len(filas)} registros desde el spool")
+    # Si el worker muere antes de llegar aquí, el .replay queda en disco y lo retoma otro worker
+    # (_replays_huerfanos): mejor duplicar que perder
+    os.remove(replaying)
+    return ok
+
+
+def _replay_spool():
+    """
+    Reinserta lo que quedó en el spool y los `.replay` que dejaron workers muertos.
+    Si vuelve a fallar, las filas siguen en el spool.
+    """
+    if not _replay_lock.acquire(blocking=False):
+        return  # Otro hilo de este proceso ya está reinsertando
+    try:
+        replaying = f"{AUDIT_SPOOL_PATH}.{os.getpid()}.replay"
+        # Con nuestro lock tomado, un .replay con nuestro pid es de un proceso anterior que reusó el pid
+        if os.path.exists(replaying) and not _reinsertar(replaying):
+            return
+        for huerfano in _replays_huerfanos():
+            try:
+                os.replace(huerfano, replaying)
+            except FileNotFoundError:
+                continue  # Otro worker ya lo tomó
+            logger.warning(f"[AuditSink] Retomando {huerfano} de un worker que ya no existe")
+            if not _reinsertar(replaying):
+                return
+
+        if not os.path.exists(AUDIT_SPOOL_PATH):
+            return
+        with _spool_lock:
+            try:
+                os.replace(AUDIT_SPOOL_PATH, replaying)
+            except FileNotFoundError:
+                return  # Otro worker ya lo tomó
+        _reinsertar(replaying)
+    finally:
+        _replay_lock.release()
+
+
+def flush_bitacora():
+    """Vacía el buffer de forma síncrona (apagado del worker, comandos, tests)."""
+    while True:
+        lote = _drain(block=False)
+        if not lote:
+            break
+        _flush(lote)
+
+
+atexit.register(flush_bitacora)
@@ -0,0 +1,240 @@
+# api/availability.py
+"""
+Motor de disponibilidad de horarios.
+
+Cada empresa tiene un catálogo ordenado de Horario (slots). La ocupación de un
+odontólogo en un día se guarda como un bitmap (int): el bit i está en 1 si el
+slot i del catálogo tiene una Consulta. Ambos viven en la caché de Django:
+
+    disp:slots:<empresa>                     -> [(id, 'HH:MM:SS'), ...]
+    disp:occ:<empresa>:<odontologo>:<fecha>  -> (firma del catálogo, int)
+
+Responder "¿qué horarios quedan libres?" es recorrer los slots y mirar un bit
+(sin consultas a la BD con la caché caliente). Si falta la entrada se recalcula
+desde la BD (una consulta) y se guarda.
+
+Consistencia: los signals de Consulta (crear / reprogramar / cancelar) recalculan
+el bitmap afectado al confirmar la transacción, y los de Horario invalidan el
+catálogo. Eso llega a todos los workers solo si la caché 'default' es compartida
+(Redis/Memcached); con una caché por proceso (LocMemCache) los demás workers
+siguen viendo lo guardado hasta que vence, así que el TTL pasa a ser
+AVAILABILITY_CACHE_TTL_LOCAL (segundos). Las escrituras que no pasan por el ORM
+quedan acotadas por el TTL. La garantía contra doble reserva NO depende de esta
+caché (ver el índice único de consulta).
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .cache_local import cache_default_compartida
+from .models import Consulta, Horario
+
+logger = logging.getLogger(__name__)
+
+AVAILABILITY_CACHE_TTL = (
+    getattr(settings, 'AVAILABILITY_CACHE_TTL', 600) if cache_default_compartida()
+    else getattr(settings, 'AVAILABILITY_CACHE_TTL_LOCAL', 10)
+)
+
+
+def _emp(empresa_id):
+    return empresa_id if empresa_id is not None else 'all'
+
+
+def _slots_key(empresa_id):
+    return f'disp:slots:{_emp(empresa_id)}'
+
+
+def _occ_key(empresa_id, odontologo_id, fecha):
+    return f'disp:occ:{_emp(empresa_id)}:{odontologo_id}:{fecha.isoformat()}'
+
+
+def slots_empresa(empresa_id):
+    """Catálogo de horarios de la empresa ordenado por hora: [(id, 'HH:MM:SS'), ...]."""
+    key = _slots_key(empresa_id)
+    slots = cache.get(key)
+    if slots is None:
+        qs = Horario.objects.all()
+        if empresa_id is not None:
+            qs = qs.filter(empresa_id=empresa_id)
+        slots = [(hid, hora.isoformat()) for hid, hora in qs.order_by('hora').values_list('id', 'hora')]
+        cache.set(key, slots, AVAILABILITY_CACHE_TTL)
+    return slots
+
+
+def mascara_desde_ids(slots, horario_ids):
+    posicion = {hid: i for i, (hid, _) in enumerate(slots)}
+    mascara = 0
+    for hid in horario_ids:
+        i = posicion.get(hid)
+        if i is not None:
+            mascara |= 1 << i
+    return mascara
+
+
+def _consultas(empresa_id):
+    qs = Consulta.objects.all()
+    if empresa_id is not None:
+        qs = qs.filter(empresa_id=empresa_id)
+    return qs
+
+
+def _firma(slots):
+    # hash de una tupla de ints: estable entre procesos (no usa PYTHONHASHSEED)
+    return hash(tuple(hid for hid, _ in slots))
+
+
+def recalcular_ocupacion(empresa_id, odontologo_id, fecha, slots=None):
+    """Lee la ocupación real desde la BD y la deja en la caché."""
+    slots = slots if slots is not None else slots_empresa(empresa_id)
+    ocupados = _consultas(empresa_id).filter(
+        cododontologo_id=odontologo_id, fecha=fecha
+    ).values_list('idhorario_id', flat=True)
+    mascara = mascara_desde_ids(slots, ocupados)
+    cache.set(_occ_key(empresa_id, odontologo_id, fecha), (_firma(slots), mascara), AVAILABILITY_CACHE_TTL)
+    return mascara
+
+
+def ocupacion(empresa_id, odontologo_id, fecha, slots=None):
+    slots = slots if slots is not None else slots_empresa(empresa_id)
+    guardado = cache.get(_occ_key(empresa_id, odontologo_id, fecha))
+    # Un bitmap calculado con otro catálogo de horarios no sirve: se recalcula
+    if guardado is not None and guardado[0] == _firma(slots):
+        return guardado[1]
+    return recalcular_ocupacion(empresa_id, odontologo_id, fecha, slots)
+
+
+def horarios_disponibles(empresa_id, odontologo_id, fecha):
+    """Horarios libres del odontólogo en la fecha, en el formato de HorarioSerializer."""
+    slots = slots_empresa(empresa_id)
+    mascara = ocupacion(empresa_id, odontologo_id, fecha, slots)
+    return [
+        {'id': hid, 'hora': hora}
+        for i, (hid, hora) in enumerate(slots)
+        if not (mascara >> i) & 1
+    ]
+
+
+def guardar_ocupaciones(empresa_id, slots, mascaras):
+    """Precarga varios bitmaps de una vez: {(odontologo_id, fecha): mascara}."""
+    firma = _firma(slots)
+    cache.set_many(
+        {_occ_key(empresa_id, od, f): (firma, m) for (od, f), m in mascaras.items()},
+        AVAILABILITY_CACHE_TTL,
+    )
+
+
+def _ocupados_por_dia(empresa_id, odontologo_ids, desde, hasta):
+    """Una sola consulta agrupada: {(odontologo_id, fecha): [idhorario, ...]}."""
+    qs = _consultas(empresa_id).filter(
+        fecha__gte=desde, fecha__lte=hasta, cododontologo_id__in=odontologo_ids
+    )
+    ocupados = {}
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.aggregates import ArrayAgg
+
+        filas = qs.values('cododontologo_id', 'fecha').annotate(horarios=ArrayAgg('idhorario_id'))
+        for f in filas:
+            ocupados[(f['cododontologo_id'], f['fecha'])] = f['horarios']
+    else:
+        for od, fecha, hid in qs.values_list('cododontologo_id', 'fecha', 'idhorario_id'):
+            ocupados.setdefault((od, fecha), []).append(hid)
+    return ocupados
+
+
+def matriz_disponibilidad(empresa_id, odontologo_ids, desde, hasta):
+    """
+    Ocupación de varios odontólogos en un rango de fechas con una consulta.
+    Devuelve (slots, fechas, {(odontologo_id, fecha): mascara}) y de paso deja
+    los bitmaps en la caché para el endpoint de un solo día.
+    """
+    slots = slots_empresa(empresa_id)
+    fechas = [desde + timedelta(days=i) for i in range((hasta - desde).days + 1)]
+    ocupados = _ocupados_por_dia(empresa_id, odontologo_ids, desde, hasta)
+    mascaras = {
+        (od, f): mascara_desde_ids(slots, ocupados.get((od, f), ()))
+        for od in odontologo_ids
+        for f in fechas
+    }
+    guardar_ocupaciones(empresa_id, slots, mascaras)
+    return slots, fechas, mascaras
+
+
+def proximos_libres(empresa_id, odontologo_ids, desde, cantidad, dias_max=60, ahora=None, bloque_dias=7):
+    """
+    Los próximos `cantidad` huecos libres con cualquiera de los odontólogos,
+    ordenados por (fecha, hora, odontólogo). Recorre el calendario por bloques de
+    `bloque_dias` (una consulta por bloque) y corta en cuanto junta suficientes.
+    Si `ahora` (datetime local) cae en el rango, descarta las horas ya pasadas de ese día.
+    Devuelve (slots, [(fecha, horario_id, odontologo_id), ...]).
+    """
+    resultados = []
+    slots = slots_empresa(empresa_id)
+    limite = desde + timedelta(days=dias_max - 1)
+    inicio = desde
+    while inicio <= limite and len(resultados) < cantidad:
+        fin = min(inicio + timedelta(days=bloque_dias - 1), limite)
+        slots, fechas, mascaras = matriz_disponibilidad(empresa_id, odontologo_ids, inicio, fin)
+        for fecha in fechas:
+            for i, (hid, hora) in enumerate(slots):
+                if ahora is not None and fecha == ahora.date() and hora <= ahora.time().isoformat():
+                    continue
+                for od in odontologo_ids:
+                    if not (mascaras[(od, fecha)] >> i) & 1:
+                        resultados.append((fecha, hid, od))
+                        if len(resultados) >= cantidad:
+                            return slots, resultados
+        inicio = fin + timedelta(days=1)
+    return slots, resultados
+
+
+def _refrescar(empresa_id, odontologo_id, fecha):
+    if not odontologo_id or not fecha:
+        return
+    try:
+        # Bitmap del tenant: se recalcula ya (la pantalla de reservas lo consulta seguido).
+        # El de "sin tenant" solo se invalida.
+        recalcular_ocupacion(empresa_id, odontologo_id, fecha)
+        cache.delete(_occ_key(None, odontologo_id, fecha))
+    except Exception as e:
+        logger.warning(f"[Disponibilidad] No se pudo refrescar la ocupación: {e}")
+
+
+@receiver(post_init, sender=Consulta, dispatch_uid='disp_consulta_init')
+def _consulta_init(sender, instance, **kwargs):
+    # Valores originales para invalidar también el día/odontólogo anterior al reprogramar.
+    # Se leen de __dict__ para no disparar consultas si vienen diferidos (only/defer).
+    datos = instance.__dict__
+    instance._disp_original = (datos.get('empresa_id'), datos.get('cododontologo_id'), datos.get('fecha'))
+
+
+@receiver(post_save, sender=Consulta, dispatch_uid='disp_consulta_saved')
+@receiver(post_delete, sender=Consulta, dispatch_uid='disp_consulta_deleted')
+def _consulta_changed(sender, instance, **kwargs):
+    claves = {(instance.empresa_id, instance.cododontologo_id, instance.fecha)}
+    original = getattr(instance, '_disp_original', None)
+    if original:
+        claves.add(original)
+    instance._disp_original = (instance.empresa_id, instance.cododontologo_id, instance.fecha)
+
+    def refrescar():
+        for clave in claves:
+            _refrescar(*clave)
+
+    transaction.on_commit(refrescar)
+
+
+@receiver(post_save, sender=Horario, dispatch_uid='disp_horario_saved')
+@receiver(post_delete, sender=Horario, dispatch_uid='disp_horario_deleted')
+def _horario_changed(sender, instance, **kwargs):
+    # Cambian las posiciones de los bits: los bitmaps guardados con la firma del
+    # catálogo anterior se descartan solos al leerlos (ver ocupacion)
+    def invalidar():
+        cache.delete_many([_slots_key(instance.empresa_id), _slots_key(None)])
+
+    transaction.on_commit(invalidar)
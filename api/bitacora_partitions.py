@@ -0,0 +1,206 @@
+# api/bitacora_partitions.py
+"""
+Particionado mensual de la tabla `bitacora` (PostgreSQL).
+
+`bitacora` es una tabla particionada por RANGE ("timestamp") con una partición por
+mes (bitacora_yAAAAmMM) y una partición DEFAULT (bitacora_default) que recibe lo
+que caiga fuera de los meses creados. Así las consultas con filtro de fechas
+(listado, export, estadísticas) solo leen los meses implicados (partition pruning)
+y la retención se aplica con DETACH + DROP en lugar de DELETE masivos.
+
+Lo usan la migración que convierte la tabla y el comando `bitacora_particiones`
+(pre-crea meses, archiva y elimina los vencidos). Solo aplica a PostgreSQL:
+los llamadores comprueban es_postgres() antes de usarlas.
+"""
+import gzip
+import logging
+import os
+import re
+from datetime import date, datetime, timezone as dt_timezone
+
+logger = logging.getLogger(__name__)
+
+TABLA = 'bitacora'
+PARTICION_DEFAULT = 'bitacora_default'
+_RE_PARTICION = re.compile(r'^bitacora_y(\d{4})m(\d{2})$')
+
+
+def es_postgres(connection):
+    return connection.vendor == 'postgresql'
+
+
+def sumar_meses(anio, mes, n):
+    total = anio * 12 + (mes - 1) + n
+    return total // 12, total % 12 + 1
+
+
+def nombre_particion(anio, mes):
+    return f'bitacora_y{anio:04d}m{mes:02d}'
+
+
+def rango_mes(anio, mes):
+    """[inicio, fin) en UTC, tal como se guarda timestamptz."""
+    sig_anio, sig_mes = sumar_meses(anio, mes, 1)
+    return (
+        datetime(anio, mes, 1, tzinfo=dt_timezone.utc),
+        datetime(sig_anio, sig_mes, 1, tzinfo=dt_timezone.utc),
+    )
+
+
+def esta_particionada(cursor):
+    cursor.execute(
+        "SELECT c.relkind FROM pg_class c "
+        "WHERE c.relname = %s AND c.relnamespace = current_schema()::regnamespace",
+        [TABLA],
+    )
+    row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def listar_particiones(cursor):
+    """Devuelve {(anio, mes): nombre} de las particiones mensuales adjuntas."""
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = %s AND p.relnamespace = current_schema()::regnamespace",
+        [TABLA],
+    )
+    particiones = {}
+    for (nombre,) in cursor.fetchall():
+        m = _RE_PARTICION.match(nombre)
+        if m:
+            particiones[(int(m.group(1)), int(m.group(2)))] = nombre
+    return particiones
+
+
+def crear_particion(cursor, anio, mes):
+    """
+    Crea y adjunta la partición del mes. Si la DEFAULT ya tiene filas de ese mes,
+    se mueven primero (si no, ATTACH fallaría). Devuelve False si ya existía.
+    """
+    nombre = nombre_particion(anio, mes)
+    if (anio, mes) in listar_particiones(cursor):
+        return False
+    inicio, fin = rango_mes(anio, mes)
+
+    cursor.execute(
+        f'CREATE TABLE "{nombre}" (LIKE "{TABLA}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+    )
+    cursor.execute(
+        f'WITH movidas AS ('
+        f'  DELETE FROM "{PARTICION_DEFAULT}" WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *'
+        f') INSERT INTO "{nombre}" SELECT * FROM movidas',
+        [inicio, fin],
+    )
+    cursor.execute(
+        f'ALTER TABLE "{TABLA}" ATTACH PARTITION "{nombre}" FOR VALUES FROM (%s) TO (%s)',
+        [inicio, fin],
+    )
+    logger.info(f"[Bitacora] Partición creada: {nombre}")
+    return True
+
+
+def asegurar_particiones(cursor, desde, meses_adelante):
+    """Crea las particiones desde el mes de `desde` hasta `meses_adelante` meses después."""
+    creadas = []
+    for n in range(meses_adelante + 1):
+        anio, mes = sumar_meses(desde.year, desde.month, n)
+        if crear_particion(cursor, anio, mes):
+            creadas.append(nombre_particion(anio, mes))
+    return creadas
+
+
+def _copiar_a_gzip(cursor, select_sql, params, ruta):
+    """COPY (select) TO STDOUT en CSV comprimido. Escribe a .tmp y renombra al terminar."""
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    consulta = cursor.mogrify(select_sql, params).decode('utf-8') if params else select_sql
+    tmp = f'{ruta}.tmp'
+    with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+        cursor.copy_expert(f'COPY ({consulta}) TO STDOUT WITH CSV HEADER', f)
+    os.replace(tmp, ruta)
+    return ruta
+
+
+def archivar_particion(cursor, nombre, directorio):
+    """Vuelca la partición completa a <directorio>/<nombre>.csv.gz."""
+    ruta = os.path.join(directorio, f'{nombre}.csv.gz')
+    return _copiar_a_gzip(cursor, f'SELECT * FROM "{nombre}" ORDER BY id', None, ruta)
+
+
+def eliminar_particion(cursor, nombre):
+    cursor.execute(f'ALTER TABLE "{TABLA}" DETACH PARTITION "{nombre}"')
+    cursor.execute(f'DROP TABLE "{nombre}"')
+    logger.info(f"[Bitacora] Partición eliminada: {nombre}")
+
+
+def archivar_y_purgar_empresa(cursor, empresa_id, corte, directorio):
+    """
+    Retención propia de una empresa (más corta que la global): archiva y borra sus
+    filas anteriores a `corte`. El filtro por "timestamp" limita el DELETE a los
+    meses vencidos. Devuelve (ruta, filas_borradas).
+    """
+    condicion = '"empresa_id" = %s AND "timestamp" < %s'
+    params = [empresa_id, corte]
+    cursor.execute(f'SELECT COUNT(*) FROM "{TABLA}" WHERE {condicion}', params)
+    if not cursor.fetchone()[0]:
+        return None, 0
+
+    ruta = os.path.join(directorio, f'bitacora_empresa{empresa_id}_hasta_{corte:%Y%m%d}.csv.gz')
+    _copiar_a_gzip(cursor, f'SELECT * FROM "{TABLA}" WHERE {condicion} ORDER BY id', params, ruta)
+    cursor.execute(f'DELETE FROM "{TABLA}" WHERE {condicion}', params)
+    return ruta, cursor.rowcount
+
+
+def convertir_a_particionada(cursor, meses_adelante=3):
+    """
+    Convierte `bitacora` (tabla normal) en tabla particionada conservando filas,
+    ids y FKs. La PK pasa a (id, "timestamp") porque PostgreSQL exige que incluya
+    la clave de partición; el id sigue saliendo de una secuencia propia.
+    """
+    if esta_particionada(cursor):
+        return
+
+    cursor.execute(f'ALTER TABLE "{TABLA}" RENAME TO "bitacora_legacy"')
+    cursor.execute(
+        f'CREATE TABLE "{TABLA}" (LIKE "bitacora_legacy" INCLUDING DEFAULTS) '
+        f'PARTITION BY RANGE ("timestamp")'
+    )
+    cursor.execute('CREATE SEQUENCE IF NOT EXISTS "bitacora_id_seq_part"')
+    cursor.execute(f'ALTER SEQUENCE "bitacora_id_seq_part" OWNED BY "{TABLA}"."id"')
+    cursor.execute(f'''ALTER TABLE "{TABLA}" ALTER COLUMN "id" SET DEFAULT nextval('"bitacora_id_seq_part"')''')
+    cursor.execute(f'ALTER TABLE "{TABLA}" ALTER COLUMN "timestamp" SET DEFAULT now()')
+    cursor.execute(f'ALTER TABLE "{TABLA}" ALTER COLUMN "timestamp" SET NOT NULL')
+    cursor.execute(f'ALTER TABLE "{TABLA}" ADD CONSTRAINT "bitacora_part_pkey" PRIMARY KEY ("id", "timestamp")')
+    cursor.execute(
+        f'ALTER TABLE "{TABLA}" ADD CONSTRAINT "bitacora_part_codusuario_fk" '
+        f'FOREIGN KEY ("codusuario") REFERENCES "usuario" ("codigo") DEFERRABLE INITIALLY DEFERRED'
+    )
+    cursor.execute(
+        f'ALTER TABLE "{TABLA}" ADD CONSTRAINT "bitacora_part_empresa_fk" '
+        f'FOREIGN KEY ("empresa_id") REFERENCES "api_empresa" ("id") DEFERRABLE INITIALLY DEFERRED'
+    )
+    cursor.execute(f'CREATE INDEX "bitacora_part_ts_idx" ON "{TABLA}" ("timestamp")')
+    cursor.execute(f'CREATE INDEX "bitacora_part_empresa_ts_idx" ON "{TABLA}" ("empresa_id", "timestamp")')
+    cursor.execute(f'CREATE INDEX "bitacora_part_codusuario_idx" ON "{TABLA}" ("codusuario")')
+    cursor.execute(f'CREATE TABLE "{PARTICION_DEFAULT}" PARTITION OF "{TABLA}" DEFAULT')
+
+    # Un mes por partición desde el registro más antiguo hasta hoy + meses_adelante
+    cursor.execute('SELECT MIN("timestamp") FROM "bitacora_legacy"')
+    minimo = cursor.fetchone()[0]
+    hoy = date.today()
+    desde = minimo.date() if minimo else hoy
+    meses = (hoy.year - desde.year) * 12 + (hoy.month - desde.month) + meses_adelante
+    asegurar_particiones(cursor, desde, meses)
+
+    cursor.execute(
+        f'INSERT INTO "{TABLA}" (id, accion, tabla_afectada, registro_id, valores_anteriores, '
+        f'valores_nuevos, ip_address, user_agent, "timestamp", codusuario, empresa_id) '
+        f'SELECT id, accion, tabla_afectada, registro_id, valores_anteriores, '
+        f'valores_nuevos, ip_address, user_agent, COALESCE("timestamp", now()), codusuario, empresa_id '
+        f'FROM "bitacora_legacy"'
+    )
+    cursor.execute(
+        '''SELECT setval('"bitacora_id_seq_part"', COALESCE((SELECT MAX(id) FROM "bitacora_legacy"), 0) + 1, false)'''
+    )
+    cursor.execute('DROP TABLE "bitacora_legacy"')
@@ -0,0 +1,275 @@
+# api/bitacora_reportes.py
+"""
+Reportes PDF de la bitácora generados fuera del request.
+
+BitacoraViewSet.export (format=pdf) solo crea un ReporteBitacora PENDIENTE y
+responde 202 con su id. El comando `procesar_reportes_bitacora` toma los trabajos
+(select_for_update skip_locked, así varios procesos no se pisan), dibuja el PDF
+página a página directamente sobre el canvas de reportlab (memoria constante,
+sin tope de filas), lo guarda en S3 si hay bucket configurado o en disco
+(REPORTES_BITACORA_DIR) y marca el trabajo COMPLETADO. El cliente consulta
+GET /api/bitacora/reportes/<id>/ hasta obtener la URL de descarga.
+
+Cada reclamo es (procesado_por, fecha_inicio): el worker lo renueva mientras dibuja
+(latido), dibuja sobre un temporal propio y tanto la publicación del archivo como
+el estado final solo se aplican si el reclamo sigue siendo suyo.
+"""
+import logging
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .bitacora_export import EXPORT_CHUNK_SIZE, FILTROS, aplicar_filtros, descripcion_de
+from .models import Bitacora, ReporteBitacora
+
+logger = logging.getLogger(__name__)
+
+REPORTES_BITACORA_DIR = getattr(
+    settings, 'REPORTES_BITACORA_DIR', os.path.join(str(settings.BASE_DIR), 'var', 'reportes_bitacora')
+)
+# Un trabajo PROCESANDO sin latido (fecha_inicio) en este tiempo se considera huérfano
+# (worker caído) y se reintenta. El worker renueva fecha_inicio cada REPORTES_BITACORA_LATIDO
+# segundos mientras dibuja, así un reporte largo no se reclama a mitad.
+REPORTES_BITACORA_TIMEOUT = getattr(settings, 'REPORTES_BITACORA_TIMEOUT', 30 * 60)
+REPORTES_BITACORA_LATIDO = getattr(settings, 'REPORTES_BITACORA_LATIDO', 60)
+URL_DESCARGA_TTL = 3600
+
+# Columnas: (título, ancho en puntos) sobre A4 apaisado
+_COLUMNAS = [
+    ('Fecha/Hora', 85),
+    ('Acción', 105),
+    ('Usuario', 120),
+    ('Descripción', 300),
+    ('IP', 80),
+    ('Modelo', 80),
+]
+_FUENTE = 'Helvetica'
+_TAM_FUENTE = 7
+_ALTO_FILA = 11
+
+
+def crear_reporte(empresa, usuario, params):
+    filtros = {k: params.get(k) for k in FILTROS if params.get(k)}
+    return ReporteBitacora.objects.create(empresa=empresa, solicitado_por=usuario, filtros=filtros)
+
+
+def _recortar(texto, ancho):
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+
+    texto = str(texto or '').replace('\n', ' ')
+    if stringWidth(texto, _FUENTE, _TAM_FUENTE) <= ancho:
+        return texto
+    # Aproximación inicial por caracteres y ajuste fino
+    texto = texto[:int(ancho / (_TAM_FUENTE * 0.45))]
+    while texto and stringWidth(texto + '…', _FUENTE, _TAM_FUENTE) > ancho:
+        texto = texto[:-1]
+    return texto + '…'
+
+
+class ReclamoPerdido(Exception):
+    """Otro worker tomó el reporte (el latido no llegó a tiempo): hay que abandonarlo."""
+
+
+def renderizar_pdf(queryset, destino, subtitulo='', latido=None):
+    """Dibuja el PDF fila a fila. Devuelve (filas, páginas). `latido()` se llama en cada página."""
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.pdfgen import canvas
+
+    ancho_pag, alto_pag = landscape(A4)
+    margen = 30
+    c = canvas.Canvas(destino, pagesize=(ancho_pag, alto_pag))
+    c.setTitle('Bitácora de Auditoría')
+    estado = {'pagina': 0, 'y': 0}
+
+    def encabezado():
+        if latido is not None:
+            latido()
+        estado['pagina'] += 1
+        y = alto_pag - margen
+        if estado['pagina'] == 1:
+            c.setFont('Helvetica-Bold', 14)
+            c.drawString(margen, y - 10, 'Bitácora de Auditoría')
+            c.setFont(_FUENTE, 8)
+            c.drawString(margen, y - 24, f"Generado el: {timezone.localtime():%d/%m/%Y %H:%M}  {subtitulo}")
+            y -= 40
+        c.setFont('Helvetica-Bold', _TAM_FUENTE + 1)
+        x = margen
+        for titulo, ancho in _COLUMNAS:
+            c.drawString(x, y, titulo)
+            x += ancho
+        c.line(margen, y - 3, ancho_pag - margen, y - 3)
+        c.setFont(_FUENTE, 7)
+        c.drawRightString(ancho_pag - margen, margen - 15, f"Página {estado['pagina']}")
+        c.setFont(_FUENTE, _TAM_FUENTE)
+        estado['y'] = y - _ALTO_FILA - 2
+
+    encabezado()
+    filas = 0
+    for entry in queryset.select_related('usuario').iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        if estado['y'] < margen:
+            c.showPage()
+            encabezado()
+        valores = [
+            timezone.localtime(entry.timestamp).strftime('%d/%m/%Y %H:%M') if entry.timestamp else '',
+            entry.accion,
+            f"{entry.usuario.nombre} {entry.usuario.apellido}" if entry.usuario_id and entry.usuario else 'Anónimo',
+            descripcion_de(entry),
+            entry.ip_address,
+            entry.tabla_afectada or '',
+        ]
+        x = margen
+        for (_, ancho), valor in zip(_COLUMNAS, valores):
+            c.drawString(x, estado['y'], _recortar(valor, ancho - 4))
+            x += ancho
+        estado['y'] -= _ALTO_FILA
+        filas += 1
+
+    if not filas:
+        c.drawString(margen, estado['y'], 'Sin registros para los filtros indicados.')
+    c.save()
+    return filas, estado['pagina']
+
+
+def _usa_s3():
+    return bool(getattr(settings, 'AWS_STORAGE_BUCKET_NAME', None))
+
+
+def _s3_client():
+    import boto3
+
+    return boto3.client(
+        's3',
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        region_name=settings.AWS_S3_REGION_NAME
+    )
+
+
+def _guardar(reporte, ruta_tmp):
+    """Publica el PDF terminado: os.replace sobre {id}.pdf (atómico) o subida a S3."""
+    if not _usa_s3():
+        ruta = os.path.join(REPORTES_BITACORA_DIR, f"{reporte.id}.pdf")
+        os.replace(ruta_tmp, ruta)
+        return 'local', ruta
+    key = f"reportes_bitacora/{reporte.empresa_id or 'global'}/{reporte.id}.pdf"
+    _s3_client().upload_file(ruta_tmp, settings.AWS_STORAGE_BUCKET_NAME, key,
+                             ExtraArgs={'ContentType': 'application/pdf'})
+    os.remove(ruta_tmp)
+    return 's3', key
+
+
+def _borrar(ruta):
+    try:
+        os.remove(ruta)
+    except FileNotFoundError:
+        pass
+
+
+def url_descarga(reporte, request=None):
+    """URL firmada de S3, o la acción de descarga local del ViewSet."""
+    if reporte.estado != 'COMPLETADO':
+        return None
+    if reporte.almacenamiento == 's3':
+        return _s3_client().generate_presigned_url(
+            'get_object',
+            Params={'Bucket': settings.AWS_STORAGE_BUCKET_NAME, 'Key': reporte.archivo},
+            ExpiresIn=URL_DESCARGA_TTL
+        )
+    ruta = f"/api/bitacora/reportes/{reporte.id}/descargar/"
+    return request.build_absolute_uri(ruta) if request else ruta
+
+
+def reclamar_reporte(worker):
+    """Toma el reporte pendiente más antiguo (o uno huérfano). None si no hay."""
+    limite = timezone.now() - timedelta(seconds=REPORTES_BITACORA_TIMEOUT)
+    with transaction.atomic():
+        reporte = (
+            ReporteBitacora.objects
+            .select_for_update(skip_locked=True)
+            .filter(estado='PENDIENTE')
+            .order_by('fecha_creacion')
+            .first()
+        ) or (
+            ReporteBitacora.objects
+            .select_for_update(skip_locked=True)
+            .filter(estado='PROCESANDO', fecha_inicio__lt=limite)
+            .order_by('fecha_inicio')
+            .first()
+        )
+        if reporte is None:
+            return None
+        reporte.estado = 'PROCESANDO'
+        reporte.procesado_por = worker
+        reporte.fecha_inicio = timezone.now()
+        reporte.save(update_fields=['estado', 'procesado_por', 'fecha_inicio'])
+    return reporte
+
+
+class _Reclamo:
+    """Reclamo (procesado_por, fecha_inicio) de un worker sobre un reporte."""
+
+    def __init__(self, reporte):
+        self.reporte_id = reporte.id
+        self.worker = reporte.procesado_por
+        self.fecha_inicio = reporte.fecha_inicio
+        self._ultimo = time.monotonic()
+
+    def _filas(self):
+        return ReporteBitacora.objects.filter(
+            id=self.reporte_id, estado='PROCESANDO', procesado_por=self.worker, fecha_inicio=self.fecha_inicio
+        )
+
+    def latido(self, forzar=False):
+        """Renueva fecha_inicio cada REPORTES_BITACORA_LATIDO s. ReclamoPerdido si ya no es nuestro."""
+        if not forzar and time.monotonic() - self._ultimo < REPORTES_BITACORA_LATIDO:
+            return
+        ahora = timezone.now()
+        if not self._filas().update(fecha_inicio=ahora):
+            raise ReclamoPerdido(f"Reporte {self.reporte_id} reclamado por otro worker")
+        self.fecha_inicio = ahora
+        self._ultimo = time.monotonic()
+
+    def terminar(self, **campos):
+        """Estado final solo si el reclamo sigue siendo nuestro. Devuelve True si se guardó."""
+        return bool(self._filas().update(fecha_fin=timezone.now(), **campos))
+
+
+def procesar_reporte(reporte_id, worker, fecha_inicio):
+    """
+    Genera y guarda el PDF de un reporte reclamado por `worker` en `fecha_inicio`
+    (lo devuelto por reclamar_reporte). Dibuja sobre un archivo temporal propio del
+    reclamo y solo publica el resultado si el reclamo sigue vigente. Devuelve el estado final.
+    """
+    reporte = ReporteBitacora.objects.get(id=reporte_id)
+    reporte.procesado_por, reporte.fecha_inicio = worker, fecha_inicio
+    reclamo = _Reclamo(reporte)
+    queryset = Bitacora.objects.all()
+    if reporte.empresa_id:
+        queryset = queryset.filter(empresa_id=reporte.empresa_id)
+    queryset = aplicar_filtros(queryset, reporte.filtros or {}).order_by('-timestamp', '-id')
+
+    filtros_txt = ', '.join(f"{k}={v}" for k, v in (reporte.filtros or {}).items())
+    os.makedirs(REPORTES_BITACORA_DIR, exist_ok=True)
+    ruta_tmp = os.path.join(REPORTES_BITACORA_DIR, f"{reporte.id}.{os.getpid()}.{fecha_inicio.timestamp():.6f}.tmp")
+    try:
+        filas, paginas = renderizar_pdf(queryset, ruta_tmp, subtitulo=filtros_txt, latido=reclamo.latido)
+        reclamo.latido(forzar=True)  # no publicar un PDF de un reclamo que ya perdimos
+        almacenamiento, archivo = _guardar(reporte, ruta_tmp)
+    except ReclamoPerdido as e:
+        logger.warning(f"[ReporteBitacora] {e}; se abandona este render")
+        _borrar(ruta_tmp)
+        return 'ABANDONADO'
+    except Exception as e:
+        logger.exception(f"[ReporteBitacora] Error generando {reporte.id}")
+        _borrar(ruta_tmp)
+        reclamo.terminar(estado='ERROR', error=str(e)[:2000])
+        return 'ERROR'
+
+    if not reclamo.terminar(estado='COMPLETADO', total_registros=filas, paginas=paginas,
+                            almacenamiento=almacenamiento, archivo=archivo, error=''):
+        return 'ABANDONADO'
+    return 'COMPLETADO'
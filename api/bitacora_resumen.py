@@ -0,0 +1,125 @@
+# api/bitacora_resumen.py
+"""
+Mantenimiento y consulta de BitacoraResumen (conteos por empresa/hora/acción/usuario).
+
+- acumular(): lo llama api.audit_sink en la misma transacción que el bulk_create,
+  sumando los registros recién insertados a su hora (upsert incremental).
+- recalcular_dia(): lo usa el comando bitacora_resumen_backfill para rehacer un día
+  completo desde la tabla bitacora.
+- estadisticas(): lo usa BitacoraViewSet.estadisticas; solo lee el resumen.
+"""
+from collections import Counter
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate, TruncHour
+
+from .models import Bitacora, BitacoraResumen, Usuario
+
+GRANULARIDADES = ('dia', 'hora')
+
+
+def _hora_utc(momento):
+    return momento.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def acumular(registros):
+    """
+    registros: iterable de (empresa_id, usuario_id, accion, timestamp).
+    Suma cada registro al bucket horario correspondiente.
+    """
+    conteos = Counter(
+        (empresa_id or 0, _hora_utc(momento), accion, usuario_id or 0)
+        for empresa_id, usuario_id, accion, momento in registros
+        if momento is not None
+    )
+    if not conteos:
+        return
+
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO bitacora_resumen (empresa_id, hora, accion, usuario_id, total) '
+                'VALUES (%s, %s, %s, %s, %s) '
+                'ON CONFLICT ON CONSTRAINT uniq_bitacora_resumen_clave '
+                'DO UPDATE SET total = bitacora_resumen.total + EXCLUDED.total',
+                [(*clave, total) for clave, total in conteos.items()],
+            )
+        return
+
+    for (empresa_id, hora, accion, usuario_id), total in conteos.items():
+        actualizados = BitacoraResumen.objects.filter(
+            empresa_id=empresa_id, hora=hora, accion=accion, usuario_id=usuario_id
+        ).update(total=F('total') + total)
+        if not actualizados:
+            BitacoraResumen.objects.create(
+                empresa_id=empresa_id, hora=hora, accion=accion, usuario_id=usuario_id, total=total
+            )
+
+
+def recalcular_dia(dia):
+    """Reemplaza el resumen del día (UTC) con los conteos actuales de bitacora."""
+    inicio = datetime.combine(dia, time.min, tzinfo=dt_timezone.utc)
+    fin = inicio + timedelta(days=1)
+
+    filas = (
+        Bitacora.objects
+        .filter(timestamp__gte=inicio, timestamp__lt=fin)
+        .annotate(hora=TruncHour('timestamp', tzinfo=dt_timezone.utc))
+        .values('empresa_id', 'hora', 'accion', 'usuario_id')
+        .annotate(total=Count('id'))
+    )
+    nuevos = [
+        BitacoraResumen(
+            empresa_id=f['empresa_id'] or 0,
+            hora=f['hora'],
+            accion=f['accion'],
+            usuario_id=f['usuario_id'] or 0,
+            total=f['total'],
+        )
+        for f in filas
+    ]
+    with transaction.atomic():
+        BitacoraResumen.objects.filter(hora__gte=inicio, hora__lt=fin).delete()
+        BitacoraResumen.objects.bulk_create(nuevos, batch_size=500)
+    return len(nuevos)
+
+
+def estadisticas(empresa_id, desde, hasta, granularidad='dia', top_usuarios=10):
+    """
+    Estadísticas del rango [desde, hasta) leyendo solo el resumen.
+    empresa_id=None incluye todas las empresas.
+    """
+    qs = BitacoraResumen.objects.filter(hora__gte=desde, hora__lt=hasta)
+    if empresa_id is not None:
+        qs = qs.filter(empresa_id=empresa_id)
+
+    acciones = {
+        f['accion']: f['n']
+        for f in qs.values('accion').annotate(n=Sum('total')).order_by('-n')
+    }
+
+    top = list(
+        qs.exclude(usuario_id=0)
+        .values('usuario_id').annotate(n=Sum('total')).order_by('-n')[:top_usuarios]
+    )
+    nombres = {
+        u.codigo: f"{u.nombre} {u.apellido}"
+        for u in Usuario.objects.filter(codigo__in=[f['usuario_id'] for f in top]).only('codigo', 'nombre', 'apellido')
+    }
+    usuarios_activos = {nombres.get(f['usuario_id'], f"Usuario #{f['usuario_id']}"): f['n'] for f in top}
+
+    # TruncDate usa la zona horaria local (TIME_ZONE), así los días coinciden con el calendario de la clínica
+    trunc = TruncHour('hora') if granularidad == 'hora' else TruncDate('hora')
+    serie = [
+        {'periodo': f['periodo'].isoformat(), 'total': f['n']}
+        for f in qs.annotate(periodo=trunc).values('periodo').annotate(n=Sum('total')).order_by('periodo')
+    ]
+
+    return {
+        'total_registros': sum(acciones.values()),
+        'acciones': acciones,
+        'usuarios_activos': usuarios_activos,
+        'serie': serie,
+    }
@@ -0,0 +1,68 @@
+# api/cache_local.py
+"""
+Cachés en memoria del worker que se invalidan en todos los procesos.
+
+Cada CacheLocal guarda sus entradas en un dict del proceso. Para avisar al
+resto de workers se usa un "version stamp" en la caché 'default' de Django:
+invalidar() vacía lo local y publica una versión nueva; sincronizar() la
+consulta como mucho cada `intervalo` segundos y descarta las entradas si
+cambió. Entre procesos esto solo funciona si la caché 'default' es compartida
+(Redis/Memcached, ver CACHES en settings y cache_default_compartida()); si no,
+el TTL de cada entrada es lo único que acota la antigüedad.
+
+Lo usan api.tenant_cache y api.catalogo_notificaciones.
+"""
+import logging
+import threading
+import time
+
+from django.core.cache import cache, caches
+
+logger = logging.getLogger(__name__)
+
+_BACKENDS_POR_PROCESO = ('LocMemCache', 'DummyCache')
+
+
+def cache_default_compartida() -> bool:
+    """False si la caché 'default' vive en cada proceso (LocMemCache) o no guarda nada (DummyCache)."""
+    return type(caches['default']).__name__ not in _BACKENDS_POR_PROCESO
+
+
+class CacheLocal:
+    def __init__(self, clave_version, intervalo, etiqueta):
+        self.clave_version = clave_version
+        self.intervalo = intervalo
+        self.etiqueta = etiqueta
+        self.lock = threading.Lock()
+        self.entradas = {}
+        self._version = None
+        self._revisada_en = 0.0
+
+    def _version_compartida(self):
+        try:
+            return cache.get(self.clave_version)
+        except Exception as e:
+            logger.warning(f"[{self.etiqueta}] No se pudo leer la versión compartida: {e}")
+            return self._version
+
+    def sincronizar(self, now):
+        """Descarta las entradas locales si otro worker invalidó la caché."""
+        if now - self._revisada_en < self.intervalo:
+            return
+        version = self._version_compartida()
+        with self.lock:
+            self._revisada_en = now
+            if version != self._version:
+                self.entradas.clear()
+                self._version = version
+
+    def invalidar(self):
+        """Vacía la caché local y avisa al resto de workers publicando una versión nueva."""
+        nueva = time.time_ns()
+        try:
+            cache.set(self.clave_version, nueva, timeout=None)
+        except Exception as e:
+            logger.warning(f"[{self.etiqueta}] No se pudo publicar la versión compartida: {e}")
+        with self.lock:
+            self.entradas.clear()
+            self._version = nueva
@@ -0,0 +1,93 @@
+# api/catalogo_notificaciones.py
+"""
+Caché en proceso (por worker) de los catálogos TipoNotificacion / CanalNotificacion
+y de sus gemelos unmanaged (TipoNotificacionMN / CanalNotificacionMN).
+
+Los envíos masivos resolvían el mismo tipo y canal por nombre en cada fila o en
+cada usuario. Son tablas de pocas filas que casi nunca cambian, así que se
+guardan en memoria por (modelo, nombre), incluidos los nombres inexistentes.
+
+Invalidación: post_save / post_delete de cualquiera de los cuatro modelos
+vacían la caché de todos los workers (version stamp de api.cache_local,
+revisado como mucho cada NOTIF_CATALOG_VERSION_CHECK segundos).
+NOTIF_CATALOG_TTL acota la antigüedad si se edita con .update().
+"""
+import copy
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .cache_local import CacheLocal
+from .models_notifications import CanalNotificacion, TipoNotificacion
+from .notifications_mobile.models import CanalNotificacionMN, TipoNotificacionMN
+
+NOTIF_CATALOG_TTL = getattr(settings, 'NOTIF_CATALOG_TTL', 600)
+NOTIF_CATALOG_VERSION_CHECK = getattr(settings, 'NOTIF_CATALOG_VERSION_CHECK', 5)
+
+_cache = CacheLocal('notif_catalog:version', NOTIF_CATALOG_VERSION_CHECK, 'CatalogoNotif')
+_entries = _cache.entradas  # (label del modelo, nombre) -> (instancia | None, expira_en)
+
+
+def _cacheado(modelo, nombre, now):
+    """(encontrado, instancia): encontrado=False si hay que ir a la BD."""
+    entry = _entries.get((modelo._meta.label, nombre))
+    if entry is not None and entry[1] > now:
+        return True, entry[0]
+    return False, None
+
+
+def _store(modelo, nombre, instancia, now):
+    with _cache.lock:
+        _entries[(modelo._meta.label, nombre)] = (instancia, now + NOTIF_CATALOG_TTL)
+
+
+def obtener(modelo, nombre):
+    """
+    Devuelve la fila de `modelo` con ese nombre (o None), activa o no: el llamador
+    decide qué hacer con `activo`. Cada llamada recibe su propia copia.
+    """
+    now = time.monotonic()
+    _cache.sincronizar(now)
+    encontrado, instancia = _cacheado(modelo, nombre, now)
+    if not encontrado:
+        instancia = modelo.objects.filter(nombre=nombre).first()
+        _store(modelo, nombre, instancia, now)
+    return copy.copy(instancia) if instancia is not None else None
+
+
+def requerir(modelo, nombre):
+    """Como obtener(), pero lanza modelo.DoesNotExist igual que objects.get()."""
+    instancia = obtener(modelo, nombre)
+    if instancia is None:
+        raise modelo.DoesNotExist(f"{modelo.__name__} '{nombre}' no existe")
+    return instancia
+
+
+def asegurar(modelo, nombre, defaults=None):
+    """get_or_create cacheado: solo toca la BD la primera vez (o tras invalidar)."""
+    instancia = obtener(modelo, nombre)
+    if instancia is None:
+        # La creación dispara post_save e invalida; se guarda después
+        instancia, _ = modelo.objects.get_or_create(nombre=nombre, defaults=defaults or {})
+        _store(modelo, nombre, instancia, time.monotonic())
+        instancia = copy.copy(instancia)
+    return instancia
+
+
+def invalidate_catalogo_cache():
+    """Vacía la caché local y avisa al resto de workers."""
+    _cache.invalidar()
+
+
+@receiver(post_save, sender=TipoNotificacion, dispatch_uid='catalogo_notif_tipo_saved')
+@receiver(post_delete, sender=TipoNotificacion, dispatch_uid='catalogo_notif_tipo_deleted')
+@receiver(post_save, sender=CanalNotificacion, dispatch_uid='catalogo_notif_canal_saved')
+@receiver(post_delete, sender=CanalNotificacion, dispatch_uid='catalogo_notif_canal_deleted')
+@receiver(post_save, sender=TipoNotificacionMN, dispatch_uid='catalogo_notif_tipo_mn_saved')
+@receiver(post_delete, sender=TipoNotificacionMN, dispatch_uid='catalogo_notif_tipo_mn_deleted')
+@receiver(post_save, sender=CanalNotificacionMN, dispatch_uid='catalogo_notif_canal_mn_saved')
+@receiver(post_delete, sender=CanalNotificacionMN, dispatch_uid='catalogo_notif_canal_mn_deleted')
+def _catalogo_changed(sender, instance, **kwargs):
+    invalidate_catalogo_cache()
@@ -0,0 +1,141 @@
+# api/email_outbox.py
+"""
+Bandeja de salida de correos (tabla correo_saliente).
+
+El request solo hace un INSERT con encolar_correo() dentro de su transacción: si
+la operación se revierte, el correo también; si se confirma, el correo queda
+pendiente aunque el proveedor SMTP esté caído. El comando `despachar_correos`
+reclama lotes (select_for_update skip_locked, así pueden correr varios), los
+envía por una sola conexión SMTP reutilizada y reintenta los fallidos con
+backoff exponencial hasta EMAIL_OUTBOX_MAX_INTENTOS.
+
+Un lote reclamado queda ENVIANDO con proximo_intento = ahora + EMAIL_OUTBOX_TIMEOUT;
+si el worker muere a mitad, al vencer ese plazo otro lo vuelve a tomar.
+"""
+import logging
+import smtplib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import CorreoSaliente
+
+logger = logging.getLogger(__name__)
+
+EMAIL_OUTBOX_LOTE = getattr(settings, 'EMAIL_OUTBOX_LOTE', 50)
+EMAIL_OUTBOX_MAX_INTENTOS = getattr(settings, 'EMAIL_OUTBOX_MAX_INTENTOS', 8)
+EMAIL_OUTBOX_BACKOFF_BASE = getattr(settings, 'EMAIL_OUTBOX_BACKOFF_BASE', 30)  # segundos
+EMAIL_OUTBOX_BACKOFF_MAX = getattr(settings, 'EMAIL_OUTBOX_BACKOFF_MAX', 3600)
+EMAIL_OUTBOX_TIMEOUT = getattr(settings, 'EMAIL_OUTBOX_TIMEOUT', 600)
+
+
+def encolar_correo(asunto, cuerpo, destinatarios, remitente=None, cuerpo_html='', empresa=None, referencia=''):
+    """Guarda el correo en la bandeja de salida (usa la transacción del llamador)."""
+    return CorreoSaliente.objects.create(
+        empresa=empresa,
+        referencia=referencia,
+        remitente=remitente or settings.DEFAULT_FROM_EMAIL,
+        destinatarios=[d for d in destinatarios if d],
+        asunto=asunto,
+        cuerpo=cuerpo,
+        cuerpo_html=cuerpo_html or '',
+    )
+
+
+def espera_reintento(intentos):
+    """Segundos hasta el próximo intento tras `intentos` fallos: 30, 60, 120... con tope."""
+    return min(EMAIL_OUTBOX_BACKOFF_BASE * 2 ** max(intentos - 1, 0), EMAIL_OUTBOX_BACKOFF_MAX)
+
+
+def reclamar_lote(worker, limite=EMAIL_OUTBOX_LOTE):
+    """Marca como ENVIANDO hasta `limite` correos vencidos y los devuelve."""
+    ahora = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            CorreoSaliente.objects
+            .select_for_update(skip_locked=True)
+            .filter(Q(estado='PENDIENTE') | Q(estado='ENVIANDO'), proximo_intento__lte=ahora)
+            .order_by('proximo_intento')
+            .values_list('id', flat=True)[:limite]
+        )
+        if not ids:
+            return []
+        CorreoSaliente.objects.filter(id__in=ids).update(
+            estado='ENVIANDO',
+            procesado_por=worker,
+            proximo_intento=ahora + timedelta(seconds=EMAIL_OUTBOX_TIMEOUT),
+        )
+    return list(CorreoSaliente.objects.filter(id__in=ids).order_by('id'))
+
+
+def _mensaje(correo, conexion):
+    msg = EmailMultiAlternatives(
+        subject=correo.asunto,
+        body=correo.cuerpo,
+        from_email=correo.remitente,
+        to=correo.destinatarios,
+        connection=conexion,
+    )
+    if correo.cuerpo_html:
+        msg.attach_alternative(correo.cuerpo_html, 'text/html')
+    return msg
+
+
+def _marcar_fallo(correo, error):
+    intentos = correo.intentos + 1
+    definitivo = intentos >= EMAIL_OUTBOX_MAX_INTENTOS
+    CorreoSaliente.objects.filter(id=correo.id).update(
+        estado='ERROR' if definitivo else 'PENDIENTE',
+        intentos=intentos,
+        ultimo_error=str(error)[:2000],
+        proximo_intento=timezone.now() + timedelta(seconds=espera_reintento(intentos)),
+    )
+    nivel = logging.ERROR if definitivo else logging.WARNING
+    logger.log(nivel, f"[Outbox] Correo {correo.id} falló (intento {intentos}): {error}")
+
+
+def enviar_lote(correos, conexion=None):
+    """
+    Envía los correos reclamados por una única conexión SMTP. Devuelve
+    (enviados, fallidos). Si el servidor corta la conexión se reabre una vez.
+    """
+    if not correos:
+        return 0, 0
+    conexion = conexion or get_connection(fail_silently=False)
+    enviados = []
+    fallidos = 0
+    try:
+        conexion.open()
+    except Exception as e:
+        for correo in correos:
+            _marcar_fallo(correo, e)
+        return 0, len(correos)
+
+    try:
+        for correo in correos:
+            if not correo.destinatarios:
+                _marcar_fallo(correo, 'Sin destinatarios')
+                fallidos += 1
+                continue
+            try:
+                try:
+                    _mensaje(correo, conexion).send()
+                except smtplib.SMTPServerDisconnected:
+                    conexion.close()
+                    conexion.open()
+                    _mensaje(correo, conexion).send()
+                enviados.append(correo.id)
+            except Exception as e:
+                _marcar_fallo(correo, e)
+                fallidos += 1
+    finally:
+        conexion.close()
+        if enviados:
+            CorreoSaliente.objects.filter(id__in=enviados).update(
+                estado='ENVIADO', fecha_envio=timezone.now(), ultimo_error=''
+            )
+    return len(enviados), fallidos
@@ -0,0 +1,223 @@
+# api/identity.py
+"""
+Identidad de negocio del request (Usuario + tipo + empresa + subtipo).
+
+Hasta ahora cada capa (TenantMiddleware, AuditMiddleware, vistas, no_show_policies)
+buscaba el Usuario por email por su cuenta. get_identity(request) devuelve un único
+objeto perezoso por request que resuelve todo con UNA consulta:
+
+    identidad = get_identity(request)
+    identidad.usuario        # Usuario (con empresa, idtipousuario y subtipo precargados) o None
+    identidad.empresa_id
+    identidad.subtipo        # 'paciente' | 'odontologo' | 'recepcionista' | 'administrador' | 'usuario'
+    identidad.es_admin
+
+Con 'Authorization: Token ...' el resultado además se guarda en la caché de Django
+por token (IDENTITY_CACHE_TTL segundos), así los requests siguientes no vuelven a
+consultar authtoken_token ni usuario. Igual que TokenAuthentication de DRF, un
+token de un usuario inactivo no autentica. Se invalida al borrar el token (logout)
+o al guardar/eliminar el Usuario o el usuario de Django.
+"""
+import hashlib
+import logging
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+from rest_framework.authtoken.models import Token
+
+from .models import Usuario
+
+logger = logging.getLogger(__name__)
+
+IDENTITY_CACHE_TTL = getattr(settings, 'IDENTITY_CACHE_TTL', 60)
+
+_REQUEST_ATTR = '_api_identity'
+
+
+def _token_cache_key(token_key):
+    # No guardamos el token en claro como clave de caché
+    return 'identity:token:' + hashlib.sha256(token_key.encode('utf-8')).hexdigest()
+
+
+def _token_from_header(request):
+    auth_header = request.META.get('HTTP_AUTHORIZATION', '')
+    if not auth_header.startswith('Token '):
+        return None
+    parts = auth_header.split()
+    return parts[1] if len(parts) == 2 else None
+
+
+def _fetch_usuario(email):
+    if not email:
+        return None
+    return (
+        Usuario.objects
+        .select_related('empresa', 'idtipousuario', 'paciente', 'odontologo', 'recepcionista')
+        .filter(correoelectronico__iexact=email.strip().lower())
+        .first()
+    )
+
+
+class RequestIdentity:
+    """Resuelve perezosamente (y una sola vez) quién hace el request."""
+
+    def __init__(self, request):
+        self._request = request
+
+    @cached_property
+    def _snapshot(self):
+        request = self._request
+        user = getattr(request, 'user', None)
+
+        # 1) Sesión de Django (AuthenticationMiddleware ya resolvió request.user)
+        if user is not None and getattr(user, 'is_authenticated', False):
+            email = getattr(user, 'email', None) or getattr(user, 'username', '')
+            return {'user_id': user.pk, 'email': email, 'usuario': _fetch_usuario(email)}
+
+        # 2) Token DRF (en los middlewares request.user todavía es anónimo)
+        token_key = _token_from_header(request)
+        if not token_key:
+            return {'user_id': None, 'email': None, 'usuario': None}
+
+        cache_key = _token_cache_key(token_key)
+        try:
+            snapshot = cache.get(cache_key)
+        except Exception as e:
+            logger.warning(f"[Identity] Caché no disponible: {e}")
+            snapshot = None
+        if snapshot is not None:
+            return snapshot
+
+        try:
+            token = Token.objects.select_related('user').get(key=token_key)
+        except Token.DoesNotExist:
+            return {'user_id': None, 'email': None, 'usuario': None}
+        if not token.user.is_active:
+            # TokenAuthentication lo rechaza: no se cachea, así reactivarlo vale al instante
+            return {'user_id': None, 'email': None, 'usuario': None}
+
+        email = token.user.email or token.user.username
+        snapshot = {'user_id': token.user_id, 'email': email, 'usuario': _fetch_usuario(email)}
+        try:
+            cache.set(cache_key, snapshot, IDENTITY_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"[Identity] No se pudo cachear la identidad: {e}")
+        return snapshot
+
+    @property
+    def is_authenticated(self):
+        return self._snapshot['user_id'] is not None
+
+    @property
+    def user_id(self):
+        return self._snapshot['user_id']
+
+    @property
+    def email(self):
+        return self._snapshot['email']
+
+    @property
+    def usuario(self):
+        return self._snapshot['usuario']
+
+    @property
+    def tipo(self):
+        return self.usuario.idtipousuario if self.usuario else None
+
+    @property
+    def rol(self):
+        return (self.tipo.rol or '').strip().lower() if self.tipo else ''
+
+    @property
+    def empresa(self):
+        return self.usuario.empresa if self.usuario else None
+
+    @property
+    def empresa_id(self):
+        return self.usuario.empresa_id if self.usuario else None
+
+    @property
+    def es_admin(self):
+        return self.rol == 'administrador'
+
+    @cached_property
+    def subtipo(self):
+        usuario = self.usuario
+        if not usuario:
+            return None
+        # Las relaciones inversas ya vienen en el select_related: no hay consultas extra
+        for nombre in ('paciente', 'odontologo', 'recepcionista'):
+            try:
+                getattr(usuario, nombre)
+                return nombre
+            except Exception:
+                continue
+        if usuario.idtipousuario_id == 1:
+            return 'administrador'
+        return 'usuario'
+
+    @property
+    def paciente(self):
+        return getattr(self.usuario, 'paciente', None) if self.subtipo == 'paciente' else None
+
+    @property
+    def odontologo(self):
+        return getattr(self.usuario, 'odontologo', None) if self.subtipo == 'odontologo' else None
+
+    @property
+    def recepcionista(self):
+        return getattr(self.usuario, 'recepcionista', None) if self.subtipo == 'recepcionista' else None
+
+
+def get_identity(request):
+    """
+    Devuelve la RequestIdentity del request (se crea la primera vez).
+    Acepta tanto el HttpRequest de Django como el Request de DRF.
+    """
+    request = getattr(request, '_request', request)
+    identity = getattr(request, _REQUEST_ATTR, None)
+    if identity is None:
+        identity = RequestIdentity(request)
+        setattr(request, _REQUEST_ATTR, identity)
+    return identity
+
+
+def invalidate_token_identity(token_key):
+    try:
+        cache.delete(_token_cache_key(token_key))
+    except Exception as e:
+        logger.warning(f"[Identity] No se pudo invalidar la identidad cacheada: {e}")
+
+
+@receiver(post_delete, sender=Token, dispatch_uid='identity_token_deleted')
+def _token_deleted(sender, instance, **kwargs):
+    invalidate_token_identity(instance.key)
+
+
+def _invalidar_tokens(filtro, descripcion):
+    try:
+        for key in Token.objects.filter(filtro).values_list('key', flat=True):
+            invalidate_token_identity(key)
+    except Exception as e:
+        logger.warning(f"[Identity] Error invalidando identidades de {descripcion}: {e}")
+
+
+@receiver(post_save, sender=Usuario, dispatch_uid='identity_usuario_saved')
+@receiver(post_delete, sender=Usuario, dispatch_uid='identity_usuario_deleted')
+def _usuario_changed(sender, instance, **kwargs):
+    email = (instance.correoelectronico or '').strip()
+    if not email:
+        return
+    # El username no siempre es el email: se busca por los dos
+    _invalidar_tokens(Q(user__username__iexact=email) | Q(user__email__iexact=email), email)
+
+
+@receiver(post_save, sender=get_user_model(), dispatch_uid='identity_user_saved')
+def _user_changed(sender, instance, **kwargs):
+    # p. ej. is_active=False: la identidad cacheada no debe seguir autenticando
+    _invalidar_tokens(Q(user_id=instance.pk), f"user {instance.pk}")
@@ -0,0 +1,78 @@
+# api/management/commands/bench_plantillas.py
+import time
+
+from django.core.management.base import BaseCommand
+from django.template import Context, Template
+from django.utils import timezone
+
+from api.models import Usuario
+from api.models_notifications import PlantillaNotificacion
+from api.services.notification_service import NotificationService
+
+PLANTILLAS = {
+    'variables': (
+        'Hola {{ nombre }} {{ apellido }}, te recordamos tu cita del {{ fecha }} a las {{ hora }} '
+        'con {{ doctor }} en {{ clinica_nombre }}. Llámanos al {{ clinica_telefono }}.'
+    ),
+    'etiquetas': (
+        '{% if doctor %}Hola {{ nombre|title }}, tu cita con {{ doctor }}{% else %}Hola {{ nombre }}, '
+        'tu cita{% endif %} es el {{ fecha }} a las {{ hora }}.'
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Mide el render de plantillas de notificación por destinatario: Template(texto) en cada '
+        'render (como antes) frente a la versión compilada y cacheada (api.plantillas_compiladas). '
+        'No toca la base de datos.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--destinatarios', type=int, default=10000)
+        parser.add_argument('--repeticiones', type=int, default=3, help='Se informa la mejor corrida')
+
+    def handle(self, *args, **opts):
+        n = max(1, opts['destinatarios'])
+        servicio = NotificationService()
+        base = servicio._contexto_base()
+        datos = {'fecha': '12/03/2025', 'hora': '10:30', 'doctor': 'Dra. Rojas'}
+        contextos = [
+            servicio._contexto_plantilla(
+                Usuario(codigo=i, nombre=f'paciente {i}', apellido='Pérez',
+                        correoelectronico=f'p{i}@example.com', telefono='70000000'),
+                datos, base,
+            )
+            for i in range(n)
+        ]
+
+        for nombre, texto in PLANTILLAS.items():
+            plantilla = PlantillaNotificacion(id=1, mensaje_template=texto, fecha_actualizacion=timezone.now())
+
+            def sin_cache():
+                return [Template(texto).render(Context(c)) for c in contextos]
+
+            def compilada():
+                return [servicio._renderizar(texto, c, plantilla, 'mensaje_template') for c in contextos]
+
+            if sin_cache() != compilada():
+                self.stderr.write(self.style.ERROR(f'{nombre}: la salida compilada difiere de Template()'))
+                continue
+
+            t_antes = self._mejor(sin_cache, opts['repeticiones'])
+            t_ahora = self._mejor(compilada, opts['repeticiones'])
+            por_10k = 10000 / n
+            self.stdout.write(
+                f'{nombre:10} Template(): {t_antes * por_10k * 1000:8.1f} ms/10k ({n / t_antes:9.0f}/s)   '
+                f'compilada: {t_ahora * por_10k * 1000:8.1f} ms/10k ({n / t_ahora:9.0f}/s)   '
+                f'x{t_antes / t_ahora:.1f}'
+            )
+
+    def _mejor(self, fn, repeticiones):
+        mejor = None
+        for _ in range(max(1, repeticiones)):
+            inicio = time.perf_counter()
+            fn()
+            duracion = time.perf_counter() - inicio
+            mejor = duracion if mejor is None else min(mejor, duracion)
+        return mejor
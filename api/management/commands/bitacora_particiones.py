@@ -0,0 +1,102 @@
+# api/management/commands/bitacora_particiones.py
+from datetime import date
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api import bitacora_partitions as bp
+from api.models import Empresa
+
+
+class Command(BaseCommand):
+    help = (
+        'Mantenimiento de las particiones mensuales de la bitácora: pre-crea los meses '
+        'siguientes, archiva (CSV gzip) y elimina los vencidos según la retención global '
+        'y la de cada empresa. Pensado para ejecutarse a diario desde cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--meses-adelante', type=int,
+            default=getattr(settings, 'BITACORA_PARTICIONES_ADELANTE', 3),
+            help='Particiones a pre-crear después del mes actual',
+        )
+        parser.add_argument(
+            '--retencion-meses', type=int,
+            default=getattr(settings, 'BITACORA_RETENCION_MESES', 12),
+            help='Retención global en meses (las empresas pueden definir la suya)',
+        )
+        parser.add_argument(
+            '--archivo-dir',
+            default=getattr(settings, 'BITACORA_ARCHIVO_DIR', None),
+            help='Directorio donde se guardan los .csv.gz archivados',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Solo muestra lo que se haría',
+        )
+
+    def handle(self, *args, **options):
+        if not bp.es_postgres(connection):
+            raise CommandError('El particionado de la bitácora requiere PostgreSQL.')
+
+        archivo_dir = options['archivo_dir']
+        if not archivo_dir:
+            raise CommandError('Defina BITACORA_ARCHIVO_DIR o use --archivo-dir.')
+        dry_run = options['dry_run']
+        hoy = date.today()
+
+        with connection.cursor() as cursor:
+            if not bp.esta_particionada(cursor):
+                raise CommandError("La tabla 'bitacora' no está particionada (¿falta aplicar migraciones?).")
+
+            # 1) Pre-crear los meses siguientes
+            if dry_run:
+                existentes = bp.listar_particiones(cursor)
+                for n in range(options['meses_adelante'] + 1):
+                    anio, mes = bp.sumar_meses(hoy.year, hoy.month, n)
+                    if (anio, mes) not in existentes:
+                        self.stdout.write(f'[dry-run] Crearía {bp.nombre_particion(anio, mes)}')
+            else:
+                with transaction.atomic():
+                    creadas = bp.asegurar_particiones(cursor, hoy, options['meses_adelante'])
+                for nombre in creadas:
+                    self.stdout.write(self.style.SUCCESS(f'Partición creada: {nombre}'))
+
+            # 2) Retención. Una partición se elimina entera solo cuando venció para TODAS las
+            #    empresas; las que retienen menos se purgan fila a fila dentro de los meses vivos.
+            global_meses = options['retencion_meses']
+            retenciones = {
+                e.id: e.retencion_bitacora_meses or global_meses
+                for e in Empresa.objects.only('id', 'retencion_bitacora_meses')
+            }
+            max_meses = max([global_meses, *retenciones.values()])
+
+            for empresa_id, meses in sorted(retenciones.items()):
+                if meses >= max_meses:
+                    continue
+                corte = bp.rango_mes(*bp.sumar_meses(hoy.year, hoy.month, -meses))[0]
+                if dry_run:
+                    self.stdout.write(f'[dry-run] Purgaría empresa {empresa_id} antes de {corte:%Y-%m-%d}')
+                    continue
+                with transaction.atomic():
+                    ruta, borradas = bp.archivar_y_purgar_empresa(cursor, empresa_id, corte, archivo_dir)
+                if borradas:
+                    self.stdout.write(f'Empresa {empresa_id}: {borradas} registros archivados en {ruta}')
+
+            # 3) Particiones completas vencidas (el límite superior ya pasó el corte)
+            corte_anio, corte_mes = bp.sumar_meses(hoy.year, hoy.month, -max_meses)
+            for (anio, mes), nombre in sorted(bp.listar_particiones(cursor).items()):
+                if (anio, mes) >= (corte_anio, corte_mes):
+                    continue
+                if dry_run:
+                    self.stdout.write(f'[dry-run] Archivaría y eliminaría {nombre}')
+                    continue
+                # El archivo se escribe antes del DROP: si falla, la partición sigue intacta
+                ruta = bp.archivar_particion(cursor, nombre, archivo_dir)
+                with transaction.atomic():
+                    bp.eliminar_particion(cursor, nombre)
+                self.stdout.write(self.style.SUCCESS(f'{nombre} archivada en {ruta} y eliminada'))
+
+        self.stdout.write(self.style.SUCCESS('Mantenimiento de la bitácora completado'))
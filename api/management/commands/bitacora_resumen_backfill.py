@@ -0,0 +1,48 @@
+# api/management/commands/bitacora_resumen_backfill.py
+from datetime import date, datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+
+from api.bitacora_resumen import recalcular_dia
+from api.models import Bitacora
+
+
+class Command(BaseCommand):
+    help = (
+        'Recalcula el resumen de la bitácora (bitacora_resumen) día por día desde la tabla '
+        'bitacora. Usar tras desplegar el resumen o para corregir un rango concreto.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--desde', help='Fecha inicial YYYY-MM-DD (por defecto, el registro más antiguo)')
+        parser.add_argument('--hasta', help='Fecha final inclusive YYYY-MM-DD (por defecto, hoy)')
+
+    def handle(self, *args, **options):
+        try:
+            desde = datetime.strptime(options['desde'], '%Y-%m-%d').date() if options['desde'] else None
+            hasta = datetime.strptime(options['hasta'], '%Y-%m-%d').date() if options['hasta'] else date.today()
+        except ValueError:
+            raise CommandError('Las fechas deben tener formato YYYY-MM-DD')
+
+        if desde is None:
+            rango = Bitacora.objects.aggregate(minimo=Min('timestamp'), maximo=Max('timestamp'))
+            if not rango['minimo']:
+                self.stdout.write('La bitácora está vacía: nada que recalcular')
+                return
+            desde = rango['minimo'].date()
+
+        if desde > hasta:
+            raise CommandError('--desde no puede ser posterior a --hasta')
+
+        dias = 0
+        buckets = 0
+        dia = desde
+        while dia <= hasta:
+            buckets += recalcular_dia(dia)
+            dias += 1
+            dia += timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Resumen recalculado: {dias} días, {buckets} filas agregadas ({desde} a {hasta})'
+        ))
@@ -0,0 +1,38 @@
+# api/management/commands/despachar_correos.py
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.utils_procesos import nombre_worker
+from api.email_outbox import EMAIL_OUTBOX_LOTE, enviar_lote, reclamar_lote
+
+
+class Command(BaseCommand):
+    help = (
+        'Envía los correos pendientes de la bandeja de salida (correo_saliente) por lotes, '
+        'reutilizando la conexión SMTP y reintentando los fallidos con backoff.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=EMAIL_OUTBOX_LOTE, help='Correos por lote')
+        parser.add_argument('--intervalo', type=float, default=2.0, help='Segundos entre sondeos si no hay trabajo')
+        parser.add_argument('--una-vez', action='store_true', help='Envía lo pendiente y termina')
+
+    def handle(self, *args, **options):
+        worker = nombre_worker()
+        lote = max(1, options['lote'])
+        self.stdout.write(f'Despachando correos (lote {lote}, worker {worker})')
+
+        while True:
+            correos = reclamar_lote(worker, lote)
+            if correos:
+                enviados, fallidos = enviar_lote(correos)
+                estilo = self.style.SUCCESS if not fallidos else self.style.WARNING
+                self.stdout.write(estilo(f'Lote de {len(correos)}: {enviados} enviados, {fallidos} con error'))
+                continue
+
+            if options['una_vez']:
+                break
+            connections.close_all()
+            time.sleep(options['intervalo'])
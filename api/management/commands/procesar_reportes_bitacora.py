@@ -0,0 +1,66 @@
+# api/management/commands/procesar_reportes_bitacora.py
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.bitacora_reportes import procesar_reporte, reclamar_reporte
+from api.utils_procesos import nombre_worker
+
+
+def _procesar_en_hijo(reporte_id, worker, fecha_inicio):
+    # Proceso hijo (fork): abre su propia conexión a la BD
+    estado = procesar_reporte(reporte_id, worker, fecha_inicio)
+    connections.close_all()
+    return reporte_id, estado
+
+
+class Command(BaseCommand):
+    help = (
+        'Genera los reportes PDF de bitácora pendientes (ReporteBitacora). '
+        'Con --procesos N renderiza hasta N reportes en paralelo.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--procesos', type=int, default=2, help='Reportes renderizados en paralelo')
+        parser.add_argument('--intervalo', type=float, default=5.0, help='Segundos entre sondeos si no hay trabajo')
+        parser.add_argument('--una-vez', action='store_true', help='Procesa lo pendiente y termina')
+
+    def handle(self, *args, **options):
+        procesos = max(1, options['procesos'])
+        worker = nombre_worker()
+        self.stdout.write(f'Procesando reportes de bitácora ({procesos} procesos, worker {worker})')
+
+        # fork explícito: los hijos heredan Django ya configurado
+        ctx = multiprocessing.get_context('fork')
+        en_curso = set()
+        with ProcessPoolExecutor(max_workers=procesos, mp_context=ctx) as pool:
+            while True:
+                while len(en_curso) < procesos:
+                    reporte = reclamar_reporte(worker)
+                    if reporte is None:
+                        break
+                    # Nunca hacer fork con una conexión abierta: el hijo compartiría el socket
+                    connections.close_all()
+                    en_curso.add(pool.submit(_procesar_en_hijo, reporte.id, reporte.procesado_por, reporte.fecha_inicio))
+                    self.stdout.write(f'Reporte {reporte.id} en proceso')
+
+                if not en_curso:
+                    if options['una_vez']:
+                        break
+                    connections.close_all()
+                    time.sleep(options['intervalo'])
+                    continue
+
+                hechos, en_curso = wait(en_curso, return_when=FIRST_COMPLETED)
+                for futuro in hechos:
+                    try:
+                        reporte_id, estado = futuro.result()
+                        estilo = self.style.SUCCESS if estado == 'COMPLETADO' else self.style.ERROR
+                        # ABANDONADO: otro worker lo reclamó (sin latido a tiempo) y él lo termina
+                        self.stdout.write(estilo(f'Reporte {reporte_id}: {estado}'))
+                    except Exception as e:
+                        # Queda PROCESANDO y se reintenta al vencer REPORTES_BITACORA_TIMEOUT
+                        self.stdout.write(self.style.ERROR(f'Fallo inesperado en un proceso hijo: {e}'))
@@ -1,10 +1,15 @@
 # api/middleware.py
+import logging
 
 from django.utils.deprecation import MiddlewareMixin
 from django.contrib.auth import get_user_model
-from .models import Bitacora, Usuario, Empresa
+from .models import Empresa
+from .identity import get_identity
+from .audit_sink import registrar_bitacora
 import json
 
+logger = logging.getLogger(__name__)
+
 
 def get_client_ip(request):
     """Obtiene la IP del cliente considerando proxies"""
@@ -35,39 +40,15 @@ def get_client_ip(request):
 
 
 def get_usuario_from_request(request):
-    """Obtiene el usuario de negocio (Usuario) desde el request"""
+    """
+    Obtiene el usuario de negocio (Usuario) desde el request.
+    Delega en api.identity: se resuelve una sola vez por request (sesión o Token)
+    y, con Token, se reutiliza entre requests desde la caché.
+    """
     try:
-        # Verificar si hay token en el header
-        auth_header = request.META.get('HTTP_AUTHORIZATION', '')
-        if auth_header.startswith('Token '):
-            from rest_framework.authtoken.models import Token
-            token_key = auth_header.split(' ')[1]
-            try:
-                token = Token.objects.select_related('user').get(key=token_key)
-                request.user = token.user
-                print(f"[Token] Usuario autenticado: {token.user}")
-            except Token.DoesNotExist:
-                print("[Token] Token no encontrado")
-                return None
-
-        if hasattr(request, 'user') and request.user.is_authenticated:
-            print(f"[Auth] Usuario autenticado: {request.user}")
-            # Primero intentar por correo electrónico
-            email = getattr(request.user, 'email', None) or getattr(request.user, 'username', '')
-            if email:
-                usuario = Usuario.objects.select_related('empresa').filter(
-                    correoelectronico__iexact=email.strip().lower()
-                ).first()
-                if usuario:
-                    print(f"[Usuario encontrado] Email: {email}, Empresa: {usuario.empresa}")
-                    return usuario
-                else:
-                    print(f"[Usuario no encontrado] Email: {email}")
-
-        print("[Auth] Usuario no autenticado o no encontrado")
-        return None
+        return get_identity(request).usuario
     except Exception as e:
-        print(f"[Error] Excepción en get_usuario_from_request: {str(e)}")
+        logger.error(f"Excepción en get_usuario_from_request: {str(e)}")
         return None
 
 
@@ -270,9 +251,8 @@ class AuditMiddleware(MiddlewareMixin):
                 if not empresa and usuario and usuario.empresa:
                     empresa = usuario.empresa
 
-                from django.utils import timezone
-                
-                Bitacora.objects.create(
+                # Encolado: el INSERT lo hace el hilo de api.audit_sink, no el request
+                registrar_bitacora(
                     accion=accion,
                     usuario=usuario,
                     empresa=empresa,
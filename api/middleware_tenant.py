@@ -1,5 +1,6 @@
 from django.http import HttpResponseForbidden
-from .models import Usuario, Empresa
+from .identity import get_identity
+from .tenant_cache import get_empresa_por_subdomain
 import logging
 
 logger = logging.getLogger(__name__)
@@ -10,7 +11,7 @@ class TenantMiddleware:
     Middleware para Multi-Tenancy basado en subdominios.
 
     Identifica la empresa (tenant) según el subdominio de la petición y:
-    1. Resuelve el objeto Empresa desde la BD
+    1. Resuelve el objeto Empresa (caché por worker con respaldo en la BD)
     2. Lo almacena en request.tenant
     3. Valida que usuarios autenticados pertenezcan a su empresa
     """
@@ -39,22 +40,10 @@ class TenantMiddleware:
         # Resolver el objeto Empresa desde el subdominio
         tenant_empresa = None
         if subdomain and subdomain not in ['www', 'api']:  # Ignorar subdominios especiales
-            try:
-                tenant_empresa = Empresa.objects.get(
-                    subdomain__iexact=subdomain,
-                    activo=True
-                )
+            # Caché por worker (ver api.tenant_cache): evita ir a la BD en cada request
+            tenant_empresa = get_empresa_por_subdomain(subdomain)
+            if tenant_empresa:
                 logger.debug(f"[TenantMiddleware] Tenant resuelto: {tenant_empresa.nombre} (subdomain: {subdomain})")
-            except Empresa.DoesNotExist:
-                logger.warning(f"[TenantMiddleware] Subdominio '{subdomain}' no encontrado o inactivo")
-                # No hacer nada, tenant_empresa será None
-            except Empresa.MultipleObjectsReturned:
-                logger.error(f"[TenantMiddleware] Múltiples empresas con subdomain '{subdomain}' - ERROR DE CONFIGURACIÓN")
-                # Tomar la primera activa como fallback
-                tenant_empresa = Empresa.objects.filter(
-                    subdomain__iexact=subdomain,
-                    activo=True
-                ).first()
 
         # Guardar el objeto Empresa en request.tenant (NO el string)
         request.tenant = tenant_empresa
@@ -82,13 +71,10 @@ class TenantMiddleware:
             if not any(request.path.startswith(path) for path in excluded_paths):
                 # Verificar si el usuario pertenece a la empresa del tenant
                 try:
-                    # Buscar el usuario en la tabla Usuario (modelo de negocio)
-                    usuario = Usuario.objects.filter(
-                        correoelectronico__iexact=request.user.email,
-                        empresa=tenant_empresa  # Comparar objeto con objeto
-                    ).first()
+                    # Usuario de negocio resuelto una sola vez por request (ver api.identity)
+                    usuario = get_identity(request).usuario
 
-                    if not usuario:
+                    if not usuario or usuario.empresa_id != tenant_empresa.id:
                         # Log detallado para debugging
                         logger.warning(
                             f"[TenantMiddleware] Acceso denegado: usuario '{request.user.email}' "
@@ -97,14 +83,10 @@ class TenantMiddleware:
                         )
 
                         # Verificar si el usuario existe en otra empresa
-                        usuario_otra_empresa = Usuario.objects.filter(
-                            correoelectronico__iexact=request.user.email
-                        ).select_related('empresa').first()
-
-                        if usuario_otra_empresa:
+                        if usuario:
                             logger.warning(
                                 f"[TenantMiddleware] El usuario '{request.user.email}' pertenece a "
-                                f"'{usuario_otra_empresa.empresa.nombre}' (subdomain: {usuario_otra_empresa.empresa.subdomain})"
+                                f"'{usuario.empresa.nombre}' (subdomain: {usuario.empresa.subdomain})"
                             )
                         else:
                             logger.error(
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 20:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_bloqueousuario'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='empresa',
+            name='retencion_bitacora_meses',
+            field=models.PositiveIntegerField(blank=True, help_text='Meses que se conserva la bitácora de esta empresa (vacío = BITACORA_RETENCION_MESES)', null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+def particionar_bitacora(apps, schema_editor):
+    # Solo PostgreSQL soporta particionado declarativo
+    from api.bitacora_partitions import convertir_a_particionada, es_postgres
+
+    if not es_postgres(schema_editor.connection):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        convertir_a_particionada(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_empresa_retencion_bitacora'),
+    ]
+
+    operations = [
+        # El estado del modelo Bitacora no cambia: solo el almacenamiento físico.
+        # No hay reversa automática (volver a una tabla simple requiere copiar los datos a mano).
+        migrations.RunPython(particionar_bitacora, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-17 20:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_bitacora_particionada'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BitacoraResumen',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('empresa_id', models.IntegerField(default=0)),
+                ('hora', models.DateTimeField(help_text='Inicio de la hora (UTC)')),
+                ('accion', models.CharField(max_length=100)),
+                ('usuario_id', models.IntegerField(default=0)),
+                ('total', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Resumen de Bitácora',
+                'verbose_name_plural': 'Resúmenes de Bitácora',
+                'db_table': 'bitacora_resumen',
+                'indexes': [models.Index(fields=['empresa_id', 'hora'], name='idx_bitresumen_emp_hora')],
+                'constraints': [models.UniqueConstraint(fields=('empresa_id', 'hora', 'accion', 'usuario_id'), name='uniq_bitacora_resumen_clave')],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.6 on 2026-10-17 20:10
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_bitacoraresumen'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReporteBitacora',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filtros', models.JSONField(blank=True, default=dict)),
+                ('estado', models.CharField(choices=[('PENDIENTE', 'Pendiente'), ('PROCESANDO', 'Procesando'), ('COMPLETADO', 'Completado'), ('ERROR', 'Error')], default='PENDIENTE', max_length=20)),
+                ('total_registros', models.PositiveIntegerField(default=0)),
+                ('paginas', models.PositiveIntegerField(default=0)),
+                ('almacenamiento', models.CharField(blank=True, default='', max_length=10)),
+                ('archivo', models.CharField(blank=True, default='', max_length=500)),
+                ('error', models.TextField(blank=True, default='')),
+                ('procesado_por', models.CharField(blank=True, default='', max_length=100)),
+                ('fecha_creacion', models.DateTimeField(auto_now_add=True)),
+                ('fecha_inicio', models.DateTimeField(blank=True, null=True)),
+                ('fecha_fin', models.DateTimeField(blank=True, null=True)),
+                ('empresa', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='reportes_bitacora', to='api.empresa')),
+                ('solicitado_por', models.ForeignKey(blank=True, db_column='solicitado_por', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reportes_bitacora', to='api.usuario')),
+            ],
+            options={
+                'verbose_name': 'Reporte de Bitácora',
+                'verbose_name_plural': 'Reportes de Bitácora',
+                'db_table': 'reporte_bitacora',
+                'ordering': ['-fecha_creacion'],
+                'indexes': [models.Index(fields=['estado', 'fecha_creacion'], name='idx_repbitacora_estado')],
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.6 on 2026-10-17 20:14
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def verificar_duplicados(apps, schema_editor):
+    """El índice no se puede crear si ya hay citas dobles: se listan para resolverlas a mano."""
+    Consulta = apps.get_model('api', 'Consulta')
+    duplicados = list(
+        Consulta.objects.filter(cododontologo__isnull=False)
+        .values('empresa_id', 'cododontologo_id', 'fecha', 'idhorario_id')
+        .annotate(total=Count('id'))
+        .filter(total__gt=1)[:20]
+    )
+    if duplicados:
+        detalle = '\n'.join(
+            f"  empresa={d['empresa_id']} odontologo={d['cododontologo_id']} "
+            f"fecha={d['fecha']} horario={d['idhorario_id']} ({d['total']} citas)"
+            for d in duplicados
+        )
+        raise RuntimeError(
+            'Hay consultas duplicadas en el mismo horario; elimine o reprograme las sobrantes '
+            f'antes de migrar:\n{detalle}'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_reportebitacora'),
+    ]
+
+    operations = [
+        migrations.RunPython(verificar_duplicados, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='consulta',
+            constraint=models.UniqueConstraint(condition=models.Q(('cododontologo__isnull', False), ('empresa__isnull', False)), fields=('empresa', 'cododontologo', 'fecha', 'idhorario'), name='uniq_consulta_slot'),
+        ),
+        migrations.AddConstraint(
+            model_name='consulta',
+            constraint=models.UniqueConstraint(condition=models.Q(('cododontologo__isnull', False), ('empresa__isnull', True)), fields=('cododontologo', 'fecha', 'idhorario'), name='uniq_consulta_slot_sin_empresa'),
+        ),
+    ]
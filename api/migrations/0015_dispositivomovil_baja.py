@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-17 20:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_correosaliente'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dispositivomovil',
+            name='fecha_baja',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dispositivomovil',
+            name='motivo_baja',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+    ]
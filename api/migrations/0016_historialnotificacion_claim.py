@@ -0,0 +1,27 @@
+# Generated by Django 5.2.6 on 2026-10-17 20:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_dispositivomovil_baja'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historialnotificacion',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='historialnotificacion',
+            name='claimed_by',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='historialnotificacion',
+            index=models.Index(fields=['estado', 'claimed_at'], name='idx_histnotif_estado_claim'),
+        ),
+    ]
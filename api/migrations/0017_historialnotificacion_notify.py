@@ -0,0 +1,47 @@
+from django.db import migrations
+
+# Canal que escucha run_notification_scheduler. Payload: "<id>:<fecha_envio epoch>"
+CREAR_TRIGGER = """
+CREATE OR REPLACE FUNCTION historialnotificacion_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('notif_programada', NEW.id || ':' || extract(epoch FROM NEW.fecha_envio));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS historialnotificacion_notify ON historialnotificacion;
+CREATE TRIGGER historialnotificacion_notify
+    AFTER INSERT OR UPDATE OF estado, fecha_envio ON historialnotificacion
+    FOR EACH ROW
+    WHEN (NEW.estado = 'PENDIENTE' AND NEW.idcanalnotificacion = 1 AND NEW.fecha_envio IS NOT NULL)
+    EXECUTE FUNCTION historialnotificacion_notify();
+"""
+
+BORRAR_TRIGGER = """
+DROP TRIGGER IF EXISTS historialnotificacion_notify ON historialnotificacion;
+DROP FUNCTION IF EXISTS historialnotificacion_notify();
+"""
+
+
+def crear_trigger(apps, schema_editor):
+    # LISTEN/NOTIFY solo existe en PostgreSQL; en otros motores el scheduler sondea
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(CREAR_TRIGGER)
+
+
+def borrar_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(BORRAR_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_historialnotificacion_claim'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_trigger, borrar_trigger),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+# Clave de deduplicación de queue_reminders: (consulta, tipo de recordatorio, dispositivo).
+# Parcial sobre las filas que marca el propio comando (origen = 'queue_reminders'),
+# así los recordatorios viejos posiblemente duplicados no impiden crear el índice.
+CREAR_INDICE = """
+CREATE UNIQUE INDEX IF NOT EXISTS uniq_hist_recordatorio
+    ON historialnotificacion (
+        (datos_adicionales->>'consulta_id'),
+        (datos_adicionales->>'tipo'),
+        iddispositivomovil
+    )
+    WHERE (datos_adicionales->>'origen') = 'queue_reminders'
+"""
+
+BORRAR_INDICE = "DROP INDEX IF EXISTS uniq_hist_recordatorio"
+
+
+def crear_indice(apps, schema_editor):
+    # Índice de expresiones sobre jsonb: solo PostgreSQL
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(CREAR_INDICE)
+
+
+def borrar_indice(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(BORRAR_INDICE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_historialnotificacion_notify'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_indice, borrar_indice),
+    ]
@@ -0,0 +1,121 @@
+# Generated by Django 5.2.6 on 2026-10-17 20:25
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+PENDIENTES = ('PENDIENTE', 'PENDING', 'PROCESSING')
+
+# datos_adicionales -> columnas. signals_consulta/reprogramar guardaban "reminder" (24h/2h)
+# y la confirmación sin marca (título "Consulta creada"); queue_reminders guardaba "tipo".
+BACKFILL_SQL = """
+UPDATE historialnotificacion SET
+    consulta_id = CASE WHEN datos_adicionales->>'consulta_id' ~ '^[0-9]+$'
+                       THEN (datos_adicionales->>'consulta_id')::integer END,
+    empresa_id = CASE WHEN datos_adicionales->>'empresa_id' ~ '^[0-9]+$'
+                      THEN (datos_adicionales->>'empresa_id')::integer END,
+    reminder_kind = CASE
+        WHEN datos_adicionales->>'reminder' = '24h' OR datos_adicionales->>'tipo' = 'REMINDER_H24' THEN 'H24'
+        WHEN datos_adicionales->>'reminder' = '2h' OR datos_adicionales->>'tipo' = 'REMINDER_H2' THEN 'H2'
+        WHEN titulo = 'Consulta creada' AND datos_adicionales ? 'consulta_id' THEN 'CREADA'
+    END
+WHERE datos_adicionales ?| array['consulta_id', 'empresa_id']
+"""
+
+# Pendientes repetidos (misma consulta, tipo y dispositivo): queda el más antiguo
+DEDUPLICAR_SQL = """
+DELETE FROM historialnotificacion h
+ USING historialnotificacion o
+ WHERE h.estado IN %(pendientes)s AND o.estado IN %(pendientes)s
+   AND h.consulta_id = o.consulta_id
+   AND h.reminder_kind = o.reminder_kind
+   AND COALESCE(h.iddispositivomovil, 0) = COALESCE(o.iddispositivomovil, 0)
+   AND h.id > o.id
+"""
+
+BORRAR_INDICE_JSON = "DROP INDEX IF EXISTS uniq_hist_recordatorio"
+
+
+def _entero(valor):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def _tipo_recordatorio(datos, titulo):
+    if datos.get('reminder') == '24h' or datos.get('tipo') == 'REMINDER_H24':
+        return 'H24'
+    if datos.get('reminder') == '2h' or datos.get('tipo') == 'REMINDER_H2':
+        return 'H2'
+    if titulo == 'Consulta creada' and 'consulta_id' in datos:
+        return 'CREADA'
+    return None
+
+
+def copiar_columnas(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(BACKFILL_SQL)
+            cursor.execute(DEDUPLICAR_SQL, {'pendientes': PENDIENTES})
+        return
+
+    HistorialNotificacion = apps.get_model('api', 'HistorialNotificacion')
+    vistos, sobrantes, cambiados = set(), [], []
+    for h in HistorialNotificacion.objects.exclude(datos_adicionales=None).order_by('id').iterator():
+        datos = h.datos_adicionales if isinstance(h.datos_adicionales, dict) else {}
+        h.consulta_id = _entero(datos.get('consulta_id'))
+        h.empresa_id = _entero(datos.get('empresa_id'))
+        h.reminder_kind = _tipo_recordatorio(datos, h.titulo)
+        if h.estado in PENDIENTES and h.consulta_id and h.reminder_kind:
+            clave = (h.consulta_id, h.reminder_kind, h.dispositivo_movil_id or 0)
+            if clave in vistos:
+                sobrantes.append(h.id)
+                continue
+            vistos.add(clave)
+        cambiados.append(h)
+    HistorialNotificacion.objects.bulk_update(
+        cambiados, ['consulta_id', 'empresa_id', 'reminder_kind'], batch_size=500
+    )
+    HistorialNotificacion.objects.filter(id__in=sobrantes).delete()
+
+
+def borrar_indice_json(apps, schema_editor):
+    # Reemplazado por uniq_hist_recordatorio_pendiente sobre las columnas nuevas
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(BORRAR_INDICE_JSON)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_historialnotificacion_recordatorio_unico'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historialnotificacion',
+            name='consulta_id',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='historialnotificacion',
+            name='empresa_id',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='historialnotificacion',
+            name='reminder_kind',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+        migrations.RunPython(copiar_columnas, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='historialnotificacion',
+            index=models.Index(fields=['consulta_id'], name='idx_histnotif_consulta'),
+        ),
+        migrations.AddConstraint(
+            model_name='historialnotificacion',
+            constraint=models.UniqueConstraint(models.F('consulta_id'), models.F('reminder_kind'), django.db.models.functions.comparison.Coalesce('dispositivo_movil', 0, output_field=models.BigIntegerField()), condition=models.Q(('consulta_id__isnull', False), ('estado__in', ['PENDIENTE', 'PENDING', 'PROCESSING']), ('reminder_kind__isnull', False)), name='uniq_hist_recordatorio_pendiente'),
+        ),
+        migrations.RunPython(borrar_indice_json, migrations.RunPython.noop),
+    ]
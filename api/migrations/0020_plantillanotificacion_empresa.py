@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-17 20:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_historialnotificacion_recordatorio_columnas'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='plantillanotificacion',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='plantillanotificacion',
+            name='empresa',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='plantillas_notificacion', to='api.empresa'),
+        ),
+        migrations.AddConstraint(
+            model_name='plantillanotificacion',
+            constraint=models.UniqueConstraint(condition=models.Q(('empresa__isnull', True)), fields=('tipo_notificacion', 'canal_notificacion'), name='uniq_plantilla_general'),
+        ),
+        migrations.AddConstraint(
+            model_name='plantillanotificacion',
+            constraint=models.UniqueConstraint(condition=models.Q(('empresa__isnull', False)), fields=('tipo_notificacion', 'canal_notificacion', 'empresa'), name='uniq_plantilla_empresa'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.6 on 2026-10-17 20:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_plantillanotificacion_empresa'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketPushExpo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticket_id', models.CharField(max_length=64, unique=True)),
+                ('token', models.TextField()),
+                ('fecha_envio', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Ticket Push Expo',
+                'verbose_name_plural': 'Tickets Push Expo',
+                'db_table': 'ticketpushexpo',
+            },
+        ),
+    ]
@@ -33,6 +33,11 @@ class Empresa(models.Model):
         blank=True,
         help_text="ID de la suscripción en Stripe"
     )
+    retencion_bitacora_meses = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Meses que se conserva la bitácora de esta empresa (vacío = BITACORA_RETENCION_MESES)"
+    )
 
     class Meta:
         db_table = 'api_empresa'
@@ -104,6 +109,21 @@ class Consulta(models.Model):
 
     class Meta:
         db_table = 'consulta'
+        # Un odontólogo no puede tener dos citas en el mismo horario del mismo día.
+        # Lo garantiza la BD (ver api.reservas); las filas sin empresa (datos previos
+        # al multi-tenant) tienen su propio índice porque NULL no se compara en UNIQUE.
+        constraints = [
+            models.UniqueConstraint(
+                fields=['empresa', 'cododontologo', 'fecha', 'idhorario'],
+                condition=models.Q(cododontologo__isnull=False, empresa__isnull=False),
+                name='uniq_consulta_slot',
+            ),
+            models.UniqueConstraint(
+                fields=['cododontologo', 'fecha', 'idhorario'],
+                condition=models.Q(cododontologo__isnull=False, empresa__isnull=True),
+                name='uniq_consulta_slot_sin_empresa',
+            ),
+        ]
 
 
 class Tipodeconsulta(models.Model):
@@ -426,6 +446,126 @@ class Bitacora(models.Model):
         return f"{usuario_nombre} - {self.accion} - {self.tabla_afectada} - {self.timestamp}"
 
 
+class BitacoraResumen(models.Model):
+    """
+    Conteos pre-agregados de la bitácora por (empresa, hora, acción, usuario).
+    Lo mantiene api.audit_sink al insertar y el comando bitacora_resumen_backfill.
+    empresa_id / usuario_id = 0 cuando el registro no tiene empresa o usuario
+    (así la clave única no depende de NULLs).
+    """
+    empresa_id = models.IntegerField(default=0)
+    hora = models.DateTimeField(help_text="Inicio de la hora (UTC)")
+    accion = models.CharField(max_length=100)
+    usuario_id = models.IntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = 'bitacora_resumen'
+        verbose_name = 'Resumen de Bitácora'
+        verbose_name_plural = 'Resúmenes de Bitácora'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['empresa_id', 'hora', 'accion', 'usuario_id'],
+                name='uniq_bitacora_resumen_clave',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['empresa_id', 'hora'], name='idx_bitresumen_emp_hora'),
+        ]
+
+    def __str__(self):
+        return f"{self.hora:%Y-%m-%d %H}h - {self.accion} - {self.total}"
+
+
+class ReporteBitacora(models.Model):
+    """
+    Trabajo de generación de un reporte PDF de la bitácora.
+    Lo crea BitacoraViewSet.export (format=pdf) y lo procesa el comando
+    procesar_reportes_bitacora fuera del request.
+    """
+    ESTADO_CHOICES = [
+        ('PENDIENTE', 'Pendiente'),
+        ('PROCESANDO', 'Procesando'),
+        ('COMPLETADO', 'Completado'),
+        ('ERROR', 'Error'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    empresa = models.ForeignKey(Empresa, on_delete=models.CASCADE, related_name='reportes_bitacora', null=True, blank=True)
+    solicitado_por = models.ForeignKey(
+        Usuario,
+        on_delete=models.SET_NULL,
+        db_column='solicitado_por',
+        null=True,
+        blank=True,
+        related_name='reportes_bitacora'
+    )
+    filtros = models.JSONField(default=dict, blank=True)
+    estado = models.CharField(max_length=20, choices=ESTADO_CHOICES, default='PENDIENTE')
+    total_registros = models.PositiveIntegerField(default=0)
+    paginas = models.PositiveIntegerField(default=0)
+    almacenamiento = models.CharField(max_length=10, blank=True, default='')  # 'local' | 's3'
+    archivo = models.CharField(max_length=500, blank=True, default='')  # ruta local o key de S3
+    error = models.TextField(blank=True, default='')
+    procesado_por = models.CharField(max_length=100, blank=True, default='')
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+    fecha_inicio = models.DateTimeField(null=True, blank=True)
+    fecha_fin = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'reporte_bitacora'
+        ordering = ['-fecha_creacion']
+        verbose_name = 'Reporte de Bitácora'
+        verbose_name_plural = 'Reportes de Bitácora'
+        indexes = [
+            models.Index(fields=['estado', 'fecha_creacion'], name='idx_repbitacora_estado'),
+        ]
+
+    def __str__(self):
+        return f"Reporte {self.id} - {self.estado}"
+
+
+class CorreoSaliente(models.Model):
+    """
+    Bandeja de salida de correos (patrón outbox). Se escribe en la misma
+    transacción que el cambio que lo origina (p. ej. la Consulta) y lo envía
+    el comando despachar_correos, nunca el request.
+    """
+    ESTADO_CHOICES = [
+        ('PENDIENTE', 'Pendiente'),
+        ('ENVIANDO', 'Enviando'),
+        ('ENVIADO', 'Enviado'),
+        ('ERROR', 'Error'),
+    ]
+
+    empresa = models.ForeignKey(Empresa, on_delete=models.CASCADE, related_name='correos_salientes', null=True, blank=True)
+    referencia = models.CharField(max_length=100, blank=True, default='')  # p. ej. 'consulta:123'
+    remitente = models.CharField(max_length=255)
+    destinatarios = models.JSONField(default=list)
+    asunto = models.CharField(max_length=255)
+    cuerpo = models.TextField()
+    cuerpo_html = models.TextField(blank=True, default='')
+    estado = models.CharField(max_length=20, choices=ESTADO_CHOICES, default='PENDIENTE')
+    intentos = models.PositiveIntegerField(default=0)
+    proximo_intento = models.DateTimeField(default=timezone.now)
+    ultimo_error = models.TextField(blank=True, default='')
+    procesado_por = models.CharField(max_length=100, blank=True, default='')
+    fecha_creacion = models.DateTimeField(auto_now_add=True)
+    fecha_envio = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'correo_saliente'
+        ordering = ['-fecha_creacion']
+        verbose_name = 'Correo Saliente'
+        verbose_name_plural = 'Correos Salientes'
+        indexes = [
+            models.Index(fields=['estado', 'proximo_intento'], name='idx_correo_estado_prox'),
+        ]
+
+    def __str__(self):
+        return f"{self.asunto} -> {', '.join(self.destinatarios or [])} ({self.estado})"
+
+
 # ============================================================================
 # CONTROL DE ACCESO: BLOQUEO DE USUARIOS
 # ============================================================================
@@ -1,6 +1,7 @@
 # api/models_notifications.py
 from django.db import models
-from .models import Usuario
+from django.db.models.functions import Coalesce
+from .models import Empresa, Usuario
 
 
 class TipoNotificacion(models.Model):
@@ -77,6 +78,9 @@ class DispositivoMovil(models.Model):
     activo = models.BooleanField(default=True)
     fecha_registro = models.DateTimeField(auto_now_add=True)
     ultima_actividad = models.DateTimeField(auto_now=True)
+    # Baja automática cuando FCM rechaza el token (UNREGISTERED, INVALID_ARGUMENT...)
+    motivo_baja = models.CharField(max_length=50, blank=True, default='')
+    fecha_baja = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         db_table = 'dispositivomovil'
@@ -87,6 +91,23 @@ class DispositivoMovil(models.Model):
         return f"{self.usuario.nombre} - {self.plataforma} - {self.modelo_dispositivo}"
 
 
+class TicketPushExpo(models.Model):
+    """
+    Tickets aceptados por Expo a la espera de su recibo (revisar_recibos_expo)
+    """
+    ticket_id = models.CharField(max_length=64, unique=True)
+    token = models.TextField()
+    fecha_envio = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'ticketpushexpo'
+        verbose_name = 'Ticket Push Expo'
+        verbose_name_plural = 'Tickets Push Expo'
+
+    def __str__(self):
+        return self.ticket_id
+
+
 class HistorialNotificacion(models.Model):
     """
     Registro de notificaciones enviadas
@@ -118,11 +139,38 @@ class HistorialNotificacion(models.Model):
     error_mensaje = models.TextField(blank=True, null=True)
     intentos = models.IntegerField(default=0)
 
+    # Reclamo por lotes de process_notifs (estado PROCESSING): quién y cuándo
+    claimed_by = models.CharField(max_length=100, blank=True, null=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+
+    # Recordatorios de citas: antes solo en datos_adicionales (consulta_id / reminder / tipo)
+    consulta_id = models.IntegerField(blank=True, null=True)
+    reminder_kind = models.CharField(max_length=20, blank=True, null=True)  # CREADA, H24, H2
+    empresa_id = models.IntegerField(blank=True, null=True)
+
     class Meta:
         db_table = 'historialnotificacion'
         verbose_name = 'Historial de Notificación'
         verbose_name_plural = 'Historial de Notificaciones'
         ordering = ['-fecha_creacion']
+        indexes = [
+            models.Index(fields=['estado', 'claimed_at'], name='idx_histnotif_estado_claim'),
+            models.Index(fields=['consulta_id'], name='idx_histnotif_consulta'),
+        ]
+        constraints = [
+            # Un recordatorio pendiente por (consulta, tipo, dispositivo); los ya enviados no cuentan
+            models.UniqueConstraint(
+                models.F('consulta_id'),
+                models.F('reminder_kind'),
+                Coalesce('dispositivo_movil', 0, output_field=models.BigIntegerField()),
+                condition=models.Q(
+                    consulta_id__isnull=False,
+                    reminder_kind__isnull=False,
+                    estado__in=['PENDIENTE', 'PENDING', 'PROCESSING'],
+                ),
+                name='uniq_hist_recordatorio_pendiente',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.usuario.nombre} - {self.titulo} - {self.estado}"
@@ -134,6 +182,9 @@ class PlantillaNotificacion(models.Model):
     """
     tipo_notificacion = models.ForeignKey(TipoNotificacion, on_delete=models.CASCADE, db_column='idtiponotificacion')
     canal_notificacion = models.ForeignKey(CanalNotificacion, on_delete=models.CASCADE, db_column='idcanalnotificacion')
+    # Sin empresa: plantilla general; con empresa: la reemplaza para los usuarios de esa clínica
+    empresa = models.ForeignKey(Empresa, on_delete=models.CASCADE, null=True, blank=True,
+                                related_name='plantillas_notificacion')
 
     nombre = models.CharField(max_length=100)
     asunto_template = models.CharField(max_length=200, blank=True, null=True)  # Para emails
@@ -150,7 +201,18 @@ class PlantillaNotificacion(models.Model):
 
     class Meta:
         db_table = 'plantillanotificacion'
-        unique_together = ['tipo_notificacion', 'canal_notificacion']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['tipo_notificacion', 'canal_notificacion'],
+                condition=models.Q(empresa__isnull=True),
+                name='uniq_plantilla_general',
+            ),
+            models.UniqueConstraint(
+                fields=['tipo_notificacion', 'canal_notificacion', 'empresa'],
+                condition=models.Q(empresa__isnull=False),
+                name='uniq_plantilla_empresa',
+            ),
+        ]
         verbose_name = 'Plantilla de Notificación'
         verbose_name_plural = 'Plantillas de Notificación'
 
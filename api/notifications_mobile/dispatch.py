@@ -0,0 +1,126 @@
+# api/notifications_mobile/dispatch.py
+"""
+Despacho de notificaciones PUSH pendientes (estado PENDIENTE, idcanalnotificacion=1).
+
+Lo comparten el endpoint mobile_dispatch_due y el comando
+run_notification_scheduler. Cada lote se reclama en una transacción corta
+(select_for_update(skip_locked) + claimed_by/claimed_at) que se confirma antes de
+enviar, así los dos caminos (o varios procesos) pueden correr a la vez sin enviar
+dos veces la misma fila y ningún lock queda abierto durante los envíos a FCM.
+Los resultados se guardan de a DESPACHO_ESCRITURA filas; si el proceso muere a
+mitad, solo lo no guardado se reclama de nuevo al vencer DESPACHO_RECLAMO_VENCIDO.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from api.utils_procesos import nombre_worker
+from .models import DispositivoMovilMN, HistorialNotificacionMN
+from .token_pruning import tokens_muertos
+from .utils import mobile_send_push_fcm
+
+CANAL_PUSH = 1
+CAMPOS_RESULTADO = ["estado", "fecha_entrega", "intentos", "error_mensaje", "iddispositivomovil"]
+# Un reclamo más viejo que esto se considera abandonado (proceso caído) y la fila vuelve a enviarse
+DESPACHO_RECLAMO_VENCIDO = timedelta(minutes=getattr(settings, 'MOBILE_DISPATCH_RECLAMO_MIN', 10))
+DESPACHO_ESCRITURA = 20  # filas por UPDATE de resultados
+
+
+def pendientes_push():
+    return HistorialNotificacionMN.objects.filter(estado="PENDIENTE", idcanalnotificacion=CANAL_PUSH)
+
+
+def _dispositivos_por_usuario(codusuarios):
+    dispositivos = {}
+    for d in (
+        DispositivoMovilMN.objects.filter(codusuario__in=[c for c in codusuarios if c], activo=True)
+        .exclude(token_fcm__isnull=True)
+        .exclude(token_fcm="")
+        .only("id", "codusuario", "token_fcm")
+        .order_by("-ultima_actividad")
+    ):
+        dispositivos.setdefault(d.codusuario, []).append(d)
+    return dispositivos
+
+
+def _reclamar(limite, ahora, ids):
+    """Toma hasta `limite` filas vencidas y sin reclamo vigente; la transacción termina al volver."""
+    reclamo = timezone.now()
+    with transaction.atomic():
+        qs = pendientes_push().filter(
+            Q(claimed_at__isnull=True) | Q(claimed_at__lt=reclamo - DESPACHO_RECLAMO_VENCIDO),
+            fecha_envio__lte=ahora,
+        )
+        if ids is not None:
+            qs = qs.filter(id__in=ids)
+        filas = list(qs.select_for_update(skip_locked=True).order_by("fecha_envio", "id")[:limite])
+        if filas:
+            HistorialNotificacionMN.objects.filter(id__in=[f.id for f in filas]).update(
+                claimed_by=nombre_worker(), claimed_at=reclamo
+            )
+    return filas
+
+
+def _guardar(filas):
+    if filas:
+        HistorialNotificacionMN.objects.bulk_update(filas, CAMPOS_RESULTADO, batch_size=500)
+
+
+def despachar_lote(limite, ahora=None, ids=None, muertos=None):
+    """
+    Envía hasta `limite` notificaciones vencidas (opcionalmente solo las de `ids`).
+    Reclamo y consulta de dispositivos en bloque; los envíos van fuera de la
+    transacción y los resultados se guardan de a DESPACHO_ESCRITURA filas.
+    `muertos` acumula los tokens rechazados por FCM (se excluyen de los envíos siguientes).
+    Devuelve {"total", "sent", "skipped", "errors"}.
+    """
+    ahora = ahora or timezone.now()
+    muertos = {} if muertos is None else muertos
+    resumen = {"total": 0, "sent": 0, "skipped": 0, "errors": 0}
+
+    pendientes = _reclamar(limite, ahora, ids)
+    if not pendientes:
+        return resumen
+    resumen["total"] = len(pendientes)
+
+    dispositivos = _dispositivos_por_usuario({
+        obj.codusuario or (obj.datos_adicionales or {}).get("paciente_codusuario")
+        for obj in pendientes
+    })
+
+    listos = []
+    for obj in pendientes:
+        if len(listos) >= DESPACHO_ESCRITURA:
+            _guardar(listos)
+            listos = []
+        listos.append(obj)
+        data = obj.datos_adicionales or {}
+        codusuario = obj.codusuario or data.get("paciente_codusuario")
+        devices = [d for d in dispositivos.get(codusuario, []) if d.token_fcm not in muertos]
+        tokens = list(dict.fromkeys([d.token_fcm for d in devices]))
+        obj.intentos = (obj.intentos or 0) + 1
+
+        if not tokens:
+            resumen["skipped"] += 1
+            obj.estado = "ERROR"
+            obj.error_mensaje = "sin tokens activos"
+            continue
+
+        try:
+            res = mobile_send_push_fcm(tokens, obj.titulo, obj.mensaje, data)
+            muertos.update(tokens_muertos(res.get("resultados")))
+            obj.estado = "ENVIADO"
+            obj.fecha_entrega = ahora
+            obj.error_mensaje = ""
+            obj.iddispositivomovil = devices[0].id   # <<< guarda el dispositivo usado
+            resumen["sent"] += 1
+        except Exception as e:
+            resumen["errors"] += 1
+            obj.estado = "ERROR"
+            obj.error_mensaje = str(e)[:1000]
+
+    _guardar(listos)
+    return resumen
@@ -0,0 +1,184 @@
+# api/notifications_mobile/expo_sender.py
+"""
+Envío por lotes a Expo Push y seguimiento de recibos.
+
+- Los mensajes se mandan de a EXPO_LOTE (máximo 100 por request según Expo) por
+  una requests.Session por hilo (no es segura entre hilos, igual que en
+  NotificationService._session_push), que reutiliza conexiones entre lotes.
+- Expo responde un ticket por mensaje, en el mismo orden: cada mensaje devuelve
+  {"token", "ok", "ticket_id", "codigo", "error", "muerto"}; `muerto` = Expo ya
+  informó DeviceNotRegistered y el dispositivo se puede dar de baja.
+- Un ticket "ok" solo significa que Expo aceptó el mensaje: el resultado real
+  (recibo) se consulta más tarde. guardar_tickets() los deja en ticketpushexpo y
+  el comando `revisar_recibos_expo` llama a revisar_recibos(), que da de baja los
+  dispositivos con DeviceNotRegistered y borra los tickets ya resueltos.
+"""
+import json
+import logging
+import threading
+from datetime import timedelta
+from typing import Any, Dict, Iterable, List
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from api.models_notifications import TicketPushExpo
+from api.notifications_mobile.token_pruning import desactivar_tokens
+
+logger = logging.getLogger(__name__)
+
+EXPO_PUSH_URL = getattr(settings, 'EXPO_PUSH_URL', 'https://exp.host/--/api/v2/push/send')
+EXPO_RECEIPTS_URL = getattr(settings, 'EXPO_RECEIPTS_URL', 'https://exp.host/--/api/v2/push/getReceipts')
+EXPO_LOTE = min(getattr(settings, 'EXPO_LOTE', 100), 100)
+EXPO_LOTE_RECIBOS = 1000  # ids por consulta de recibos (límite de Expo)
+EXPO_RECIBOS_VIGENCIA = timedelta(hours=24)  # después Expo ya no guarda el recibo
+
+CODIGO_NO_REGISTRADO = 'DeviceNotRegistered'
+
+
+def es_token_expo(token) -> bool:
+    return bool(token) and token.startswith(('ExponentPushToken', 'ExpoPushToken'))
+
+
+def construir_mensaje(token, title, body, data=None) -> Dict[str, Any]:
+    return {
+        "to": token,
+        "title": title,
+        "body": body,
+        "data": data or {},
+        "sound": "default",
+        "badge": 1,
+    }
+
+
+def _lotes(items, tamano):
+    for i in range(0, len(items), tamano):
+        yield items[i:i + tamano]
+
+
+def _resultado_ticket(token, ticket) -> Dict[str, Any]:
+    if (ticket or {}).get("status") == "ok":
+        return {"token": token, "ok": True, "ticket_id": ticket.get("id"), "codigo": None,
+                "error": None, "muerto": False}
+    codigo = ((ticket or {}).get("details") or {}).get("error") or "ERROR"
+    return {"token": token, "ok": False, "ticket_id": None, "codigo": codigo,
+            "error": ((ticket or {}).get("message") or "sin ticket")[:200],
+            "muerto": codigo == CODIGO_NO_REGISTRADO}
+
+
+class ExpoSender:
+    def __init__(self, access_token=None, push_url=None, receipts_url=None, timeout=15):
+        self.access_token = access_token if access_token is not None else getattr(settings, 'EXPO_ACCESS_TOKEN', None)
+        self.push_url = push_url or EXPO_PUSH_URL
+        self.receipts_url = receipts_url or EXPO_RECEIPTS_URL
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        """Session del hilo actual: requests.Session no es segura entre hilos."""
+        sesion = getattr(self._local, 'sesion', None)
+        if sesion is None:
+            sesion = self._local.sesion = requests.Session()
+            adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+            sesion.mount('https://', adaptador)
+            sesion.mount('http://', adaptador)
+        return sesion
+
+    def _post(self, url, cuerpo):
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        if self.access_token:
+            headers["Authorization"] = f"Bearer {self.access_token}"
+        return self.session.post(url, headers=headers, data=json.dumps(cuerpo), timeout=self.timeout)
+
+    def enviar(self, mensajes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Envía los mensajes (construir_mensaje) de a EXPO_LOTE; un resultado por mensaje, en orden."""
+        resultados = []
+        for lote in _lotes(mensajes, EXPO_LOTE):
+            try:
+                r = self._post(self.push_url, lote)
+                tickets = r.json().get("data") if r.status_code == 200 else None
+                error = None if isinstance(tickets, list) else f"{r.status_code} - {r.text[:200]}"
+            except (requests.RequestException, ValueError) as e:
+                tickets, error = None, str(e)[:200]
+            if error:
+                logger.error(f"[Expo] Lote de {len(lote)} mensajes rechazado: {error}")
+                resultados.extend({"token": m["to"], "ok": False, "ticket_id": None, "codigo": "HTTP",
+                                   "error": error, "muerto": False} for m in lote)
+                continue
+            tickets = tickets + [None] * (len(lote) - len(tickets))
+            resultados.extend(_resultado_ticket(m["to"], t) for m, t in zip(lote, tickets))
+        return resultados
+
+    def recibos(self, ticket_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """{ticket_id: recibo} de los que Expo ya resolvió (los demás no vienen en la respuesta)."""
+        recibos = {}
+        for lote in _lotes(ticket_ids, EXPO_LOTE_RECIBOS):
+            r = self._post(self.receipts_url, {"ids": lote})
+            r.raise_for_status()
+            recibos.update(r.json().get("data") or {})
+        return recibos
+
+
+def guardar_tickets(resultados: Iterable[dict]) -> int:
+    """Registra los tickets aceptados para consultar su recibo más tarde."""
+    tickets = [TicketPushExpo(ticket_id=r["ticket_id"], token=r["token"])
+               for r in resultados or [] if r.get("ok") and r.get("ticket_id")]
+    TicketPushExpo.objects.bulk_create(tickets, batch_size=500, ignore_conflicts=True)
+    return len(tickets)
+
+
+def revisar_recibos(sender=None, min_edad=timedelta(minutes=15), lote=EXPO_LOTE_RECIBOS) -> Dict[str, int]:
+    """
+    Consulta los recibos de los tickets con al menos `min_edad`, da de baja los
+    dispositivos con DeviceNotRegistered y borra los tickets resueltos o vencidos.
+    """
+    sender = sender or get_expo_sender()
+    ahora = timezone.now()
+    vencidos = TicketPushExpo.objects.filter(fecha_envio__lt=ahora - EXPO_RECIBOS_VIGENCIA).delete()[0]
+    resumen = {"revisados": 0, "ok": 0, "errores": 0, "bajas": 0, "vencidos": vencidos}
+
+    ultimo_id = 0
+    while True:
+        tickets = list(
+            TicketPushExpo.objects.filter(id__gt=ultimo_id, fecha_envio__lte=ahora - min_edad)
+            .order_by("id").values_list("id", "ticket_id", "token")[:lote]
+        )
+        if not tickets:
+            break
+        ultimo_id = tickets[-1][0]
+        recibos = sender.recibos([t[1] for t in tickets])
+
+        muertos, resueltos = {}, []
+        for id, ticket_id, token in tickets:
+            recibo = recibos.get(ticket_id)
+            if recibo is None:
+                continue  # todavía sin recibo: se vuelve a consultar en la próxima corrida
+            resueltos.append(id)
+            if recibo.get("status") == "ok":
+                resumen["ok"] += 1
+                continue
+            resumen["errores"] += 1
+            codigo = (recibo.get("details") or {}).get("error")
+            if codigo == CODIGO_NO_REGISTRADO:
+                muertos[token] = codigo
+            else:
+                logger.warning(f"[Expo] Recibo {ticket_id} con error {codigo}: {recibo.get('message')}")
+
+        resumen["revisados"] += len(tickets)
+        resumen["bajas"] += desactivar_tokens(muertos)
+        TicketPushExpo.objects.filter(id__in=resueltos).delete()
+    return resumen
+
+
+_sender = None
+
+
+def get_expo_sender() -> ExpoSender:
+    """Motor compartido por el proceso (con una Session y su pool de conexiones por hilo)."""
+    global _sender
+    if _sender is None:
+        _sender = ExpoSender()
+    return _sender
@@ -0,0 +1,105 @@
+# api/notifications_mobile/fcm_auth.py
+"""
+Proveedor del access token OAuth2 de Google para FCM HTTP v1.
+
+Un solo proveedor por proceso guarda el token hasta poco antes de que venza
+(FCM_TOKEN_MARGEN segundos) y la clave RSA del service account ya parseada, así
+cada push no paga ni la firma del JWT ni el POST a oauth2.googleapis.com.
+La renovación es single-flight: si varios hilos encuentran el token vencido,
+solo uno lo pide a Google y el resto espera y reutiliza el resultado.
+"""
+import threading
+import time
+
+import jwt  # PyJWT
+import requests
+
+from api.notifications_mobile.config import get_fcm_sa_info
+
+FCM_SCOPE = "https://www.googleapis.com/auth/firebase.messaging"
+GOOGLE_TOKEN_URL = "https://oauth2.googleapis.com/token"
+# Se renueva este tiempo antes del vencimiento real (Google entrega tokens de 1 h)
+FCM_TOKEN_MARGEN = 300
+
+
+class GoogleTokenProvider:
+    def __init__(self, sa_loader=get_fcm_sa_info, margen=FCM_TOKEN_MARGEN, session=None):
+        self._sa_loader = sa_loader
+        self._margen = margen
+        self._session = session
+        self._lock = threading.Lock()
+        self._actual = (None, 0.0)  # (token, epoch de vencimiento), se reemplaza entero
+        self._clave = None  # (private_key_id, objeto de clave)
+
+    def _clave_firma(self, sa_info):
+        kid = sa_info.get("private_key_id")
+        if self._clave is None or self._clave[0] != kid:
+            from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+            clave = load_pem_private_key(sa_info["private_key"].encode("utf-8"), password=None)
+            self._clave = (kid, clave)
+        return self._clave[1]
+
+    def _pedir_token(self):
+        sa_info = self._sa_loader()
+        now = int(time.time())
+        payload = {
+            "iss": sa_info["client_email"],
+            "scope": FCM_SCOPE,
+            "aud": GOOGLE_TOKEN_URL,
+            "iat": now,
+            "exp": now + 3600,
+        }
+        signed_jwt = jwt.encode(
+            payload,
+            self._clave_firma(sa_info),
+            algorithm="RS256",
+            headers={"kid": sa_info.get("private_key_id")},
+        )
+        resp = (self._session or requests).post(
+            GOOGLE_TOKEN_URL,
+            data={
+                "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+                "assertion": signed_jwt,
+            },
+            timeout=15,
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        return data["access_token"], now + int(data.get("expires_in", 3600))
+
+    def _vigente(self):
+        token, vence = self._actual
+        return token if token and time.time() < vence - self._margen else None
+
+    def token(self) -> str:
+        # Camino rápido sin lock: lectura de una tupla ya publicada
+        token = self._vigente()
+        if token:
+            return token
+        with self._lock:
+            # Otro hilo pudo renovarlo mientras esperábamos el lock
+            token = self._vigente()
+            if token:
+                return token
+            self._actual = self._pedir_token()
+            return self._actual[0]
+
+    def invalidar(self, token=None):
+        """Descarta el token (p. ej. FCM respondió 401). Si se pasa `token`, solo si sigue siendo ese."""
+        with self._lock:
+            if token is None or token == self._actual[0]:
+                self._actual = (None, 0.0)
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_token_provider() -> GoogleTokenProvider:
+    global _provider
+    if _provider is None:
+        with _provider_lock:
+            if _provider is None:
+                _provider = GoogleTokenProvider()
+    return _provider
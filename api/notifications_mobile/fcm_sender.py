@@ -0,0 +1,221 @@
+# api/notifications_mobile/fcm_sender.py
+"""
+Motor de envío FCM HTTP v1 concurrente.
+
+- Una requests.Session por proceso con pool de conexiones del tamaño de la
+  concurrencia: los envíos reutilizan TCP+TLS en lugar de abrir uno por token.
+- Los tokens de una llamada se reparten en un pool de hilos acotado
+  (FCM_CONCURRENCIA); un solo token se envía en el hilo actual.
+- Cada token devuelve un resultado propio: {"token", "ok", "status", "codigo", "error", "muerto"},
+  con `codigo` tomado del payload de error de FCM (UNREGISTERED, QUOTA_EXCEEDED...) y
+  `muerto` = el token ya no sirve y hay que darlo de baja (ver es_token_muerto).
+- 429 / 503 respetan Retry-After y pausan a todos los hilos del proceso (no solo
+  al que recibió la respuesta); sin cabecera se usa backoff exponencial. Se
+  reintenta hasta FCM_MAX_REINTENTOS veces.
+
+FCM_BASE_URL permite apuntar el motor a un servidor FCM falso local en pruebas.
+"""
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Tuple
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from api.notifications_mobile.config import get_fcm_project_id
+from api.notifications_mobile.fcm_auth import get_token_provider
+
+logger = logging.getLogger(__name__)
+
+FCM_BASE_URL = getattr(settings, 'FCM_BASE_URL', 'https://fcm.googleapis.com')
+FCM_CONCURRENCIA = getattr(settings, 'FCM_CONCURRENCIA', 16)
+FCM_MAX_REINTENTOS = getattr(settings, 'FCM_MAX_REINTENTOS', 3)
+FCM_BACKOFF_BASE = 1.0  # segundos
+FCM_BACKOFF_MAX = 30.0
+
+# Respuestas que vale la pena reintentar
+_ESTADOS_TRANSITORIOS = {429, 500, 502, 503, 504}
+_CODIGOS_TRANSITORIOS = {'QUOTA_EXCEEDED', 'UNAVAILABLE', 'INTERNAL'}
+
+
+def construir_mensaje(title, body, data=None, android_channel_id="smilestudio_default") -> Dict[str, Any]:
+    """Mensaje FCM v1 sin el token (se agrega por destinatario)."""
+    message: Dict[str, Any] = {
+        "notification": {"title": title, "body": body},
+        "data": {k: str(v) for (k, v) in (data or {}).items()},
+        "android": {"priority": "HIGH"},
+        "apns": {"headers": {"apns-priority": "10"}},
+    }
+    if android_channel_id:
+        message["android"]["notification"] = {
+            "channel_id": android_channel_id,
+            "sound": "default",
+        }
+    return message
+
+
+def codigo_error(status, texto) -> str:
+    """errorCode de FCM (details[].errorCode), o el status de Google, o HTTP_<n>."""
+    try:
+        error = json.loads(texto).get("error") or {}
+    except (ValueError, AttributeError):
+        error = {}
+    for detalle in error.get("details") or []:
+        if isinstance(detalle, dict) and detalle.get("errorCode"):
+            return detalle["errorCode"]
+    return error.get("status") or f"HTTP_{status}"
+
+
+def es_token_muerto(codigo, texto) -> bool:
+    """
+    UNREGISTERED (app desinstalada / token rotado), que FCM informa en
+    details[].errorCode, o INVALID_ARGUMENT cuando el mensaje culpa al
+    registration token. Un 404 sin ese detalle, SENDER_ID_MISMATCH o un
+    INVALID_ARGUMENT por el payload también salen con FCM_PROJECT_ID /
+    FCM_BASE_URL mal configurados o un proxy en el medio, y darían de baja
+    todos los dispositivos.
+    """
+    if codigo == 'UNREGISTERED':
+        return True
+    return codigo == 'INVALID_ARGUMENT' and 'registration token' in (texto or '').lower()
+
+
+def segundos_retry_after(valor):
+    """Retry-After en segundos (admite número o fecha HTTP). None si no viene o no se entiende."""
+    if not valor:
+        return None
+    try:
+        return max(float(valor), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(valor).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class _Pausa:
+    """Compuerta compartida: tras un 429 todos los hilos esperan hasta `hasta`."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hasta = 0.0
+
+    def pausar(self, segundos):
+        with self._lock:
+            self._hasta = max(self._hasta, time.monotonic() + segundos)
+
+    def esperar(self):
+        restante = self._hasta - time.monotonic()
+        if restante > 0:
+            time.sleep(restante)
+
+
+class FCMSender:
+    def __init__(self, project_id=None, base_url=None, concurrencia=None, max_reintentos=None,
+                 token_provider=None, timeout=15):
+        self.project_id = project_id
+        self.base_url = (base_url or FCM_BASE_URL).rstrip('/')
+        self.concurrencia = max(1, concurrencia or FCM_CONCURRENCIA)
+        self.max_reintentos = FCM_MAX_REINTENTOS if max_reintentos is None else max_reintentos
+        self.token_provider = token_provider or get_token_provider()
+        self.timeout = timeout
+        self.session = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrencia)
+        self.session.mount('https://', adaptador)
+        self.session.mount('http://', adaptador)
+        self._pausa = _Pausa()
+
+    @property
+    def url(self):
+        project_id = self.project_id or get_fcm_project_id()
+        return f"{self.base_url}/v1/projects/{project_id}/messages:send"
+
+    def _post(self, url, cuerpo):
+        access_token = self.token_provider.token()
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json; charset=UTF-8",
+        }
+        r = self.session.post(url, headers=headers, data=cuerpo, timeout=self.timeout)
+        if r.status_code == 401:
+            # Token revocado o vencido antes de tiempo: se renueva una vez y se reintenta
+            self.token_provider.invalidar(access_token)
+            headers["Authorization"] = f"Bearer {self.token_provider.token()}"
+            r = self.session.post(url, headers=headers, data=cuerpo, timeout=self.timeout)
+        return r
+
+    def enviar_uno(self, url, token, mensaje) -> Dict[str, Any]:
+        cuerpo = json.dumps({"message": dict(mensaje, token=token)})
+        intento = 0
+        while True:
+            self._pausa.esperar()
+            try:
+                r = self._post(url, cuerpo)
+            except requests.RequestException as e:
+                status, codigo, texto, espera = None, 'NETWORK', str(e), None
+            else:
+                if r.status_code in (200, 201):
+                    return {"token": token, "ok": True, "status": r.status_code, "codigo": None,
+                            "error": None, "muerto": False}
+                status, texto = r.status_code, r.text
+                codigo = codigo_error(status, texto)
+                espera = segundos_retry_after(r.headers.get("Retry-After"))
+                if status == 429 or (status == 503 and espera is not None):
+                    espera = espera if espera is not None else min(FCM_BACKOFF_BASE * 2 ** intento, FCM_BACKOFF_MAX)
+                    self._pausa.pausar(espera)
+
+            transitorio = status is None or status in _ESTADOS_TRANSITORIOS or codigo in _CODIGOS_TRANSITORIOS
+            if not transitorio or intento >= self.max_reintentos:
+                if transitorio:
+                    logger.warning(f"[FCM] {token[:12]}… sin éxito tras {intento + 1} intentos: {codigo}")
+                return {"token": token, "ok": False, "status": status, "codigo": codigo, "error": texto[:200],
+                        "muerto": es_token_muerto(codigo, texto)}
+            intento += 1
+            if espera is None:
+                time.sleep(min(FCM_BACKOFF_BASE * 2 ** (intento - 1), FCM_BACKOFF_MAX))
+
+    def enviar(self, tokens: List[str], title: str, body: str, data=None,
+               android_channel_id="smilestudio_default") -> List[Dict[str, Any]]:
+        """Envía a todos los tokens; devuelve un resultado por token, en el mismo orden."""
+        if not tokens:
+            return []
+        url = self.url
+        mensaje = construir_mensaje(title, body, data, android_channel_id)
+        if len(tokens) == 1:
+            return [self.enviar_uno(url, tokens[0], mensaje)]
+        with ThreadPoolExecutor(max_workers=min(self.concurrencia, len(tokens)),
+                                thread_name_prefix='fcm') as pool:
+            return list(pool.map(lambda tok: self.enviar_uno(url, tok, mensaje), tokens))
+
+
+    def enviar_varios(self, envios: List[Tuple[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """
+        Como enviar(), pero cada token con su propio mensaje (construir_mensaje): los
+        envíos masivos con plantilla por usuario comparten un solo pool de hilos.
+        """
+        if not envios:
+            return []
+        url = self.url
+        with ThreadPoolExecutor(max_workers=min(self.concurrencia, len(envios)),
+                                thread_name_prefix='fcm') as pool:
+            return list(pool.map(lambda envio: self.enviar_uno(url, *envio), envios))
+
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def get_fcm_sender() -> FCMSender:
+    """Motor compartido por el proceso (una sola Session y su pool de conexiones)."""
+    global _sender
+    if _sender is None:
+        with _sender_lock:
+            if _sender is None:
+                _sender = FCMSender()
+    return _sender
@@ -1,104 +1,132 @@
+from datetime import timedelta
+
 from django.core.management.base import BaseCommand
-from django.db import transaction
 from django.utils import timezone
 
+from api.utils_procesos import nombre_worker
 from api.notifications_mobile.models import (
     HistorialNotificacionMN,
     UsuarioMN,
     DispositivoMovilMN,
 )
+from api.notifications_mobile.queue import claim_batch
+from api.notifications_mobile.token_pruning import desactivar_tokens, tokens_muertos
 from api.notifications_mobile.utils import mobile_send_push_fcm
 
+CAMPOS_RESULTADO = ["estado", "error_mensaje", "intentos", "fecha_envio"]
+# Filas por UPDATE de resultados: si el worker muere, solo se reenvía el tramo en curso
+RESULTADOS_POR_UPDATE = 20
+
+
 class Command(BaseCommand):
-    help = "Procesa notificaciones PENDING y las envía por FCM."
+    help = (
+        "Procesa notificaciones PENDING y las envía por FCM. Reclama lotes "
+        "(estado PROCESSING + claimed_by), así varios procesos pueden correr en paralelo."
+    )
 
     def add_arguments(self, parser):
-        parser.add_argument("--limit", type=int, default=100)
+        parser.add_argument("--limit", type=int, default=100, help="Filas reclamadas por lote")
         parser.add_argument("--dry-run", action="store_true")
+        parser.add_argument("--drain", action="store_true", help="Sigue reclamando lotes hasta vaciar la cola")
+        parser.add_argument("--stale-minutes", type=int, default=10,
+                            help="Un reclamo PROCESSING más viejo que esto se considera abandonado")
+        parser.add_argument("--worker", default=None, help="Identificador del worker (por defecto host:pid)")
 
     def handle(self, *args, **opts):
-        limit = opts["limit"]
-        dry_run = opts["dry_run"]
+        limit = max(1, opts["limit"])
 
-        qs = HistorialNotificacionMN.objects.filter(estado="PENDING").order_by("id")[:limit]
-        if not qs:
-            self.stdout.write(self.style.WARNING("No hay PENDING"))
+        if opts["dry_run"]:
+            qs = HistorialNotificacionMN.objects.filter(estado="PENDING").order_by("id")[:limit]
+            for h in qs:
+                self.stdout.write(f"DRY-RUN id={h.id} usuario={h.codusuario} dispositivo={h.iddispositivomovil}")
             return
 
+        worker = opts["worker"] or nombre_worker()
+        stale_after = timedelta(minutes=opts["stale_minutes"])
+        muertos = {}  # tokens que FCM rechazó en esta corrida: no se reintentan y se dan de baja al final
         processed = 0
-        for h in qs:
-            with transaction.atomic():
-                h = (HistorialNotificacionMN.objects
-                     .select_for_update(skip_locked=True)
-                     .get(id=h.id))
-
-                if h.estado != "PENDING":
-                    continue
-
-                try:
-                    u = UsuarioMN.objects.get(codigo=h.codusuario)
-                except UsuarioMN.DoesNotExist:
-                    h.estado = "ERROR"
-                    h.error_mensaje = "Usuario inexistente"
-                    h.intentos = (h.intentos or 0) + 1
-                    h.fecha_envio = timezone.now()
-                    h.save()
-                    continue
-
-                if not (u.recibir_notificaciones and u.notificaciones_push):
-                    h.estado = "SKIPPED_PREF"
-                    h.intentos = (h.intentos or 0) + 1
-                    h.fecha_envio = timezone.now()
-                    h.save()
-                    processed += 1
-                    continue
-
-                tokens = []
-                if h.iddispositivomovil:
-                    d = DispositivoMovilMN.objects.filter(
-                        id=h.iddispositivomovil, codusuario=u.codigo, activo=True
-                    ).first()
-                    if d:
-                        tokens = [d.token_fcm]
-                else:
-                    tokens = list(
-                        DispositivoMovilMN.objects
-                        .filter(codusuario=u.codigo, activo=True)
-                        .values_list("token_fcm", flat=True)
-                    )
-
-                now = timezone.now()
-                if not tokens:
-                    h.estado = "NO_TOKENS"
-                    h.error_mensaje = "No hay dispositivos activos"
-                    h.intentos = (h.intentos or 0) + 1
-                    h.fecha_envio = now
-                    h.save()
-                    processed += 1
-                    continue
-
-                if dry_run:
-                    self.stdout.write(f"DRY-RUN id={h.id} tokens={len(tokens)}")
-                    continue
-
-                res = mobile_send_push_fcm(
-                    tokens=tokens,
-                    title=h.titulo,
-                    body=h.mensaje,
-                    data=h.datos_adicionales or {},
-                    android_channel_id="smilestudio_default",
-                )
-                sent = int(res.get("sent", 0))
-                estado = "SENT" if sent == len(tokens) else ("PARTIAL" if sent > 0 else "ERROR")
-
-                h.estado = estado
-                h.intentos = (h.intentos or 0) + 1
-                h.fecha_envio = now
-                if res.get("errors"):
-                    h.error_mensaje = "\n".join(res["errors"])[:1000]
-                h.save()
-
-                self.stdout.write(f"{estado} id={h.id} sent={sent}/{len(tokens)}")
-                processed += 1
 
+        while True:
+            lote = claim_batch(worker, limit, stale_after)
+            if not lote:
+                break
+            processed += self._procesar_lote(lote, muertos, worker)
+            if not opts["drain"]:
+                break
+
+        if not processed:
+            self.stdout.write(self.style.WARNING("No hay PENDING"))
+
+        bajas = desactivar_tokens(muertos)
+        if bajas:
+            self.stdout.write(self.style.WARNING(f"Dispositivos dados de baja (token inválido): {bajas}"))
         self.stdout.write(self.style.SUCCESS(f"Procesadas: {processed}"))
+
+    def _procesar_lote(self, lote, muertos, worker):
+        # Usuarios y dispositivos del lote en dos consultas
+        usuarios = UsuarioMN.objects.in_bulk({h.codusuario for h in lote})
+        dispositivos = {}
+        for d in (
+            DispositivoMovilMN.objects
+            .filter(codusuario__in=usuarios.keys(), activo=True)
+            .only("id", "codusuario", "token_fcm")
+            .order_by("id")
+        ):
+            dispositivos.setdefault(d.codusuario, []).append(d)
+
+        for inicio in range(0, len(lote), RESULTADOS_POR_UPDATE):
+            tramo = lote[inicio:inicio + RESULTADOS_POR_UPDATE]
+            for h in tramo:
+                self._procesar_fila(h, usuarios, dispositivos, muertos)
+            HistorialNotificacionMN.objects.bulk_update(tramo, CAMPOS_RESULTADO, batch_size=500)
+
+            # Renueva el reclamo de lo que falta para que otro worker no lo dé por abandonado
+            resto = [h.id for h in lote[inicio + RESULTADOS_POR_UPDATE:]]
+            if resto:
+                HistorialNotificacionMN.objects.filter(
+                    id__in=resto, estado="PROCESSING", claimed_by=worker
+                ).update(claimed_at=timezone.now())
+        return len(lote)
+
+    def _procesar_fila(self, h, usuarios, dispositivos, muertos):
+        h.intentos = (h.intentos or 0) + 1
+        h.fecha_envio = timezone.now()
+        u = usuarios.get(h.codusuario)
+        if u is None:
+            h.estado = "ERROR"
+            h.error_mensaje = "Usuario inexistente"
+            return
+
+        if not (u.recibir_notificaciones and u.notificaciones_push):
+            h.estado = "SKIPPED_PREF"
+            return
+
+        propios = dispositivos.get(u.codigo, [])
+        if h.iddispositivomovil:
+            propios = [d for d in propios if d.id == h.iddispositivomovil]
+        tokens = [d.token_fcm for d in propios if d.token_fcm and d.token_fcm not in muertos]
+
+        if not tokens:
+            h.estado = "NO_TOKENS"
+            h.error_mensaje = "No hay dispositivos activos"
+            return
+
+        try:
+            res = mobile_send_push_fcm(
+                tokens=tokens,
+                title=h.titulo,
+                body=h.mensaje,
+                data=h.datos_adicionales or {},
+                android_channel_id="smilestudio_default",
+            )
+        except Exception as e:
+            h.estado = "ERROR"
+            h.error_mensaje = f"EXC: {e}"[:1000]
+            return
+
+        muertos.update(tokens_muertos(res.get("resultados")))
+        sent = int(res.get("sent", 0))
+        h.estado = "SENT" if sent == len(tokens) else ("PARTIAL" if sent > 0 else "ERROR")
+        if res.get("errors"):
+            h.error_mensaje = "\n".join(res["errors"])[:1000]
+        self.stdout.write(f"{h.estado} id={h.id} sent={sent}/{len(tokens)}")
@@ -1,9 +1,60 @@
 from datetime import datetime, timedelta
 from django.core.management.base import BaseCommand
+from django.db import connection
 from django.utils import timezone
 
 from api.notifications_mobile.models import ConsultaMN, HorarioMN, UsuarioMN
-from api.notifications_mobile.queue import enqueue_notif_for_user_devices
+from api.notifications_mobile.queue import (
+    DEFAULT_CANAL, RECORDATORIO_H2, RECORDATORIO_H24, _ensure_catalog, enqueue_notif_for_user_devices,
+)
+
+TITULO = "Recordatorio de consulta"
+
+# Una sola pasada por ventana: la fecha/hora de la cita se arma en la BD, se filtran
+# ventana y preferencias y se inserta una fila por dispositivo activo. El NOT EXISTS
+# descarta los avisos que ya existen en cualquier estado (las ventanas de ±tolerancia
+# se solapan entre corridas y process_notifs ya pudo marcarlos SENT), incluidos los de
+# nivel usuario (sin dispositivo). El índice uniq_hist_recordatorio_pendiente
+# (migración 0019) cubre la carrera entre dos corridas simultáneas.
+ENCOLAR_SQL = """
+    INSERT INTO historialnotificacion (
+        titulo, mensaje, datos_adicionales, estado, fecha_creacion, fecha_envio,
+        fecha_entrega, fecha_lectura, error_mensaje, intentos,
+        codusuario, idtiponotificacion, idcanalnotificacion, iddispositivomovil,
+        consulta_id, reminder_kind, empresa_id
+    )
+    SELECT
+        %(titulo)s,
+        'Tienes una consulta el ' || to_char(c.fecha + h.hora, 'DD/MM HH24:MI'),
+        jsonb_build_object(
+            'tipo', %(tipo)s,
+            'consulta_id', c.id,
+            'fecha', to_char(c.fecha, 'YYYY-MM-DD'),
+            'hora', to_char(h.hora, 'HH24:MI:SS')
+        ),
+        'PENDING', now(), NULL, NULL, NULL, NULL, 0,
+        u.codigo, %(tipo_id)s, %(canal_id)s, d.id,
+        c.id, %(kind)s, c.empresa_id
+    FROM consulta c
+    JOIN horario h ON h.id = c.idhorario
+    JOIN usuario u ON u.codigo = c.codpaciente
+    JOIN dispositivomovil d ON d.codusuario = u.codigo AND d.activo
+    WHERE c.fecha BETWEEN %(fecha_desde)s AND %(fecha_hasta)s
+      AND ((c.fecha + h.hora) AT TIME ZONE %(tz)s) BETWEEN %(inicio)s AND %(fin)s
+      AND u.recibir_notificaciones
+      AND u.notificaciones_push
+      AND NOT EXISTS (
+          SELECT 1 FROM historialnotificacion x
+           WHERE x.consulta_id = c.id
+             AND x.reminder_kind = %(kind)s
+             AND COALESCE(x.iddispositivomovil, d.id) = d.id
+      )
+    ON CONFLICT (consulta_id, reminder_kind, COALESCE(iddispositivomovil, 0))
+    WHERE consulta_id IS NOT NULL AND reminder_kind IS NOT NULL
+      AND estado IN ('PENDIENTE', 'PENDING', 'PROCESSING')
+    DO NOTHING
+"""
+
 
 def combine_dt(fecha, hora):
     naive = datetime.combine(fecha, hora)
@@ -24,52 +75,76 @@ class Command(BaseCommand):
 
         windows = []
         if opts["only"] in ("ALL","H24"):
-            windows.append(("REMINDER_H24", target_h24 - tol, target_h24 + tol))
+            windows.append(("REMINDER_H24", RECORDATORIO_H24, target_h24 - tol, target_h24 + tol))
         if opts["only"] in ("ALL","H2"):
-            windows.append(("REMINDER_H2", target_h2 - tol, target_h2 + tol))
+            windows.append(("REMINDER_H2", RECORDATORIO_H2, target_h2 - tol, target_h2 + tol))
 
+        encolar = self._encolar_sql if connection.vendor == "postgresql" else self._encolar_por_fila
         total = 0
-        for tipo_nombre, win_start, win_end in windows:
-            fechas = {win_start.date(), win_end.date()}
-            qs = ConsultaMN.objects.filter(fecha__in=list(fechas))
-
-            cnt = 0
-            for c in qs:
-                try:
-                    h = HorarioMN.objects.get(id=c.idhorario)
-                except HorarioMN.DoesNotExist:
-                    continue
-
-                appt_dt = combine_dt(c.fecha, h.hora)
-                if not (win_start <= appt_dt <= win_end):
-                    continue
-
-                try:
-                    u = UsuarioMN.objects.get(codigo=c.codpaciente)
-                except UsuarioMN.DoesNotExist:
-                    continue
-                if not (u.recibir_notificaciones and u.notificaciones_push):
-                    continue
-
-                titulo = "Recordatorio de consulta"
-                mensaje = f"Tienes una consulta el {appt_dt.strftime('%d/%m %H:%M')}"
-                data = {
-                    "tipo": tipo_nombre,
-                    "consulta_id": c.id,
-                    "fecha": c.fecha.isoformat(),
-                    "hora": h.hora.strftime("%H:%M:%S"),
-                }
-
-                rows = enqueue_notif_for_user_devices(
-                    usuario_codigo=u.codigo,
-                    titulo=titulo,
-                    mensaje=mensaje,
-                    tipo_nombre=tipo_nombre,
-                    data=data,
-                )
-                cnt += len(rows)
-
+        for tipo_nombre, kind, win_start, win_end in windows:
+            cnt = encolar(tipo_nombre, kind, win_start, win_end)
             self.stdout.write(f"{tipo_nombre}: encoladas {cnt}")
             total += cnt
 
         self.stdout.write(self.style.SUCCESS(f"Total encoladas: {total}"))
+
+    def _encolar_sql(self, tipo_nombre, kind, win_start, win_end):
+        tipo, canal = _ensure_catalog(tipo_nombre, DEFAULT_CANAL)
+        with connection.cursor() as cursor:
+            cursor.execute(ENCOLAR_SQL, {
+                "titulo": TITULO,
+                "tipo": tipo_nombre,
+                "kind": kind,
+                "tipo_id": tipo.id,
+                "canal_id": canal.id,
+                "fecha_desde": win_start.date(),
+                "fecha_hasta": win_end.date(),
+                "tz": timezone.get_current_timezone_name(),
+                "inicio": win_start,
+                "fin": win_end,
+            })
+            return cursor.rowcount
+
+    def _encolar_por_fila(self, tipo_nombre, kind, win_start, win_end):
+        # Motores sin INSERT ... SELECT ... ON CONFLICT con este SQL (desarrollo local)
+        fechas = {win_start.date(), win_end.date()}
+        qs = ConsultaMN.objects.filter(fecha__in=list(fechas))
+
+        cnt = 0
+        for c in qs:
+            try:
+                h = HorarioMN.objects.get(id=c.idhorario)
+            except HorarioMN.DoesNotExist:
+                continue
+
+            appt_dt = combine_dt(c.fecha, h.hora)
+            if not (win_start <= appt_dt <= win_end):
+                continue
+
+            try:
+                u = UsuarioMN.objects.get(codigo=c.codpaciente)
+            except UsuarioMN.DoesNotExist:
+                continue
+            if not (u.recibir_notificaciones and u.notificaciones_push):
+                continue
+
+            mensaje = f"Tienes una consulta el {appt_dt.strftime('%d/%m %H:%M')}"
+            data = {
+                "tipo": tipo_nombre,
+                "consulta_id": c.id,
+                "fecha": c.fecha.isoformat(),
+                "hora": h.hora.strftime("%H:%M:%S"),
+            }
+
+            rows = enqueue_notif_for_user_devices(
+                usuario_codigo=u.codigo,
+                titulo=TITULO,
+                mensaje=mensaje,
+                tipo_nombre=tipo_nombre,
+                data=data,
+                consulta_id=c.id,
+                reminder_kind=kind,
+                empresa_id=c.empresa_id,
+            )
+            cnt += len(rows)
+        return cnt
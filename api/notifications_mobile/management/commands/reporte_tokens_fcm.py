@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from api.models_notifications import DispositivoMovil
+
+
+class Command(BaseCommand):
+    help = "Reporte por empresa de dispositivos con token FCM dado de baja (tasa de tokens muertos)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dias", type=int, default=30, help="Ventana de bajas a contar")
+        parser.add_argument("--empresa", type=int, help="Solo esta empresa (id)")
+
+    def handle(self, *args, **opts):
+        desde = timezone.now() - timedelta(days=opts["dias"])
+        qs = DispositivoMovil.objects.all()
+        if opts.get("empresa"):
+            qs = qs.filter(usuario__empresa_id=opts["empresa"])
+
+        filas = (
+            qs.values("usuario__empresa_id", "usuario__empresa__nombre")
+            .annotate(
+                total=Count("id"),
+                activos=Count("id", filter=Q(activo=True)),
+                bajas=Count("id", filter=Q(fecha_baja__gte=desde)),
+            )
+            .order_by("usuario__empresa__nombre")
+        )
+        motivos = {}
+        for m in (
+            qs.filter(fecha_baja__gte=desde)
+            .values("usuario__empresa_id", "motivo_baja")
+            .annotate(n=Count("id"))
+        ):
+            motivos.setdefault(m["usuario__empresa_id"], []).append(f"{m['motivo_baja']}={m['n']}")
+
+        if not filas:
+            self.stdout.write(self.style.WARNING("No hay dispositivos registrados"))
+            return
+
+        self.stdout.write(f"Bajas de tokens FCM en los últimos {opts['dias']} días")
+        self.stdout.write(f"{'Empresa':<30} {'Disp.':>7} {'Activos':>8} {'Bajas':>7} {'Tasa':>7}  Motivos")
+        for f in filas:
+            nombre = f["usuario__empresa__nombre"] or "(sin empresa)"
+            tasa = 100.0 * f["bajas"] / f["total"] if f["total"] else 0.0
+            detalle = ", ".join(sorted(motivos.get(f["usuario__empresa_id"], [])))
+            linea = f"{nombre[:30]:<30} {f['total']:>7} {f['activos']:>8} {f['bajas']:>7} {tasa:>6.1f}%  {detalle}"
+            self.stdout.write(self.style.WARNING(linea) if tasa >= 20 else linea)
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from api.notifications_mobile.expo_sender import EXPO_LOTE_RECIBOS, revisar_recibos
+
+
+class Command(BaseCommand):
+    help = (
+        "Consulta los recibos de Expo de los tickets guardados al enviar, da de baja los "
+        "dispositivos con DeviceNotRegistered y limpia los tickets resueltos o vencidos (24 h). "
+        "Pensado para cron cada 15-30 minutos."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--min-edad", type=int, default=15,
+                            help="Minutos desde el envío antes de pedir el recibo")
+        parser.add_argument("--lote", type=int, default=EXPO_LOTE_RECIBOS, help="Tickets por consulta")
+
+    def handle(self, *args, **opts):
+        resumen = revisar_recibos(
+            min_edad=timedelta(minutes=opts["min_edad"]),
+            lote=max(1, min(opts["lote"], EXPO_LOTE_RECIBOS)),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Recibos revisados: {resumen['revisados']} (ok={resumen['ok']} errores={resumen['errores']}) "
+            f"dispositivos dados de baja={resumen['bajas']} tickets vencidos={resumen['vencidos']}"
+        ))
@@ -0,0 +1,189 @@
+import heapq
+import logging
+import select
+import signal
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.utils import timezone
+
+from api.notifications_mobile.dispatch import despachar_lote, pendientes_push
+from api.notifications_mobile.token_pruning import desactivar_tokens
+
+logger = logging.getLogger(__name__)
+
+CANAL_NOTIFY = "notif_programada"  # ver migración 0017 (trigger sobre historialnotificacion)
+
+
+class Agenda:
+    """
+    Min-heap de (fecha_envio epoch, id). Reprogramar un id deja la entrada vieja
+    en el heap; se descarta al llegar arriba porque ya no coincide con `programados`.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._programados = {}  # id -> epoch vigente
+
+    def __len__(self):
+        return len(self._programados)
+
+    def agregar(self, id, ts):
+        if self._programados.get(id) == ts:
+            return
+        self._programados[id] = ts
+        heapq.heappush(self._heap, (ts, id))
+
+    def _limpiar_tope(self):
+        while self._heap and self._programados.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def proximo(self):
+        """Epoch del próximo envío, o None si no hay nada agendado."""
+        self._limpiar_tope()
+        return self._heap[0][0] if self._heap else None
+
+    def vencidos(self, ahora_ts, limite):
+        ids = []
+        self._limpiar_tope()
+        while self._heap and self._heap[0][0] <= ahora_ts and len(ids) < limite:
+            _, id = heapq.heappop(self._heap)
+            del self._programados[id]
+            ids.append(id)
+            self._limpiar_tope()
+        return ids
+
+
+class Command(BaseCommand):
+    help = (
+        "Demonio que envía las notificaciones PUSH PENDIENTE a su hora exacta. Mantiene en memoria "
+        "un heap de las próximas fecha_envio (carga incremental por id y por ventana de tiempo), "
+        "duerme hasta el próximo vencimiento y se entera de filas nuevas por LISTEN/NOTIFY."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--horizonte", type=int, default=360,
+                            help="Minutos hacia adelante que se mantienen en memoria")
+        parser.add_argument("--lote", type=int, default=200, help="Máximo de filas por envío")
+        parser.add_argument("--intervalo", type=float, default=60.0,
+                            help="Segundos máximos de espera sin novedades (carga incremental)")
+        parser.add_argument("--resync", type=int, default=30,
+                            help="Minutos entre recargas completas de la ventana (cubre cambios sin NOTIFY)")
+
+    def handle(self, *args, **opts):
+        self.horizonte = timedelta(minutes=opts["horizonte"])
+        self.intervalo = opts["intervalo"]
+        self.resync = timedelta(minutes=opts["resync"])
+        lote = max(1, opts["lote"])
+        self._detener = False
+        signal.signal(signal.SIGTERM, self._pedir_detencion)
+        signal.signal(signal.SIGINT, self._pedir_detencion)
+
+        self.agenda = Agenda()
+        self._reiniciar()
+        self.stdout.write(f"Scheduler iniciado: {len(self.agenda)} notificaciones en memoria "
+                          f"(LISTEN {'activo' if self._conn_listen else 'no disponible, sondeo'})")
+
+        while not self._detener:
+            try:
+                ahora = timezone.now()
+                if ahora - self._ultima_resync >= self.resync:
+                    self._cargar(completa=True)
+                elif ahora + self.horizonte / 2 >= self._cargado_hasta:
+                    self._cargar()
+
+                ids = self.agenda.vencidos(ahora.timestamp(), lote)
+                if ids:
+                    self._despachar(ids, ahora)
+                    continue
+
+                proximo = self.agenda.proximo()
+                espera = self.intervalo if proximo is None else min(self.intervalo, proximo - time.time())
+                if espera > 0:
+                    self._esperar(espera)
+                    if not self._conn_listen:
+                        self._cargar()
+            except Exception as e:
+                logger.exception(f"[Scheduler] Error en el ciclo: {e}")
+                connections.close_all()
+                time.sleep(5)
+                self._reiniciar()
+
+        self.stdout.write("Scheduler detenido")
+
+    def _pedir_detencion(self, *args):
+        self._detener = True
+
+    def _reiniciar(self):
+        self._conn_listen = self._escuchar()
+        self._max_id = 0
+        self._cargar(completa=True)
+
+    def _escuchar(self):
+        if connection.vendor != "postgresql":
+            return None
+        connection.ensure_connection()
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CANAL_NOTIFY}")
+        return connection.connection
+
+    def _cargar(self, completa=False):
+        """
+        Incremental: filas con id > último id visto (cualquier fecha; solo se agendan
+        las que caen en la ventana) y filas ya conocidas que entraron en la ventana
+        al avanzar el tiempo. Completa: toda la ventana desde cero.
+        """
+        ahora = timezone.now()
+        hasta = ahora + self.horizonte
+        qs = pendientes_push().filter(fecha_envio__isnull=False)
+
+        if completa:
+            self.agenda = Agenda()
+            filas = qs.filter(fecha_envio__lte=hasta).values_list("id", "fecha_envio")
+            self._max_id = max(self._max_id, qs.order_by("-id").values_list("id", flat=True).first() or 0)
+            self._ultima_resync = ahora
+        else:
+            nuevas = list(qs.filter(id__gt=self._max_id).values_list("id", "fecha_envio"))
+            if nuevas:
+                self._max_id = max(id for id, _ in nuevas)
+            filas = [(id, f) for id, f in nuevas if f <= hasta] + list(
+                qs.filter(fecha_envio__gt=self._cargado_hasta, fecha_envio__lte=hasta, id__lte=self._max_id)
+                .values_list("id", "fecha_envio")
+            )
+
+        for id, fecha_envio in filas:
+            self.agenda.agregar(id, fecha_envio.timestamp())
+        self._cargado_hasta = hasta
+
+    def _esperar(self, segundos):
+        if not self._conn_listen:
+            time.sleep(segundos)
+            return
+        listos, _, _ = select.select([self._conn_listen], [], [], segundos)
+        if not listos:
+            return
+        self._conn_listen.poll()
+        limite = self._cargado_hasta.timestamp()
+        while self._conn_listen.notifies:
+            aviso = self._conn_listen.notifies.pop(0)
+            try:
+                id_txt, ts_txt = aviso.payload.split(":", 1)
+                id, ts = int(id_txt), float(ts_txt)
+            except ValueError:
+                continue
+            self._max_id = max(self._max_id, id)
+            # Lo que cae fuera de la ventana se carga cuando la ventana lo alcance
+            if ts <= limite:
+                self.agenda.agregar(id, ts)
+
+    def _despachar(self, ids, ahora):
+        muertos = {}
+        resumen = despachar_lote(len(ids), ahora=ahora, ids=ids, muertos=muertos)
+        desactivar_tokens(muertos)
+        if resumen["total"]:
+            self.stdout.write(
+                f"[{timezone.localtime(ahora):%H:%M:%S}] enviadas={resumen['sent']} "
+                f"sin_tokens={resumen['skipped']} errores={resumen['errors']}"
+            )
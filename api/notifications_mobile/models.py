@@ -51,6 +51,8 @@ class DispositivoMovilMN(models.Model):
     fecha_registro = models.DateTimeField()
     ultima_actividad = models.DateTimeField()
     codusuario = models.IntegerField()
+    motivo_baja = models.CharField(max_length=50, blank=True, default="")
+    fecha_baja = models.DateTimeField(null=True)
 
     class Meta:
         managed = False
@@ -95,6 +97,11 @@ class HistorialNotificacionMN(models.Model):
     idtiponotificacion = models.BigIntegerField()
     idcanalnotificacion = models.BigIntegerField()
     iddispositivomovil = models.BigIntegerField(null=True)
+    claimed_by = models.CharField(max_length=100, null=True)
+    claimed_at = models.DateTimeField(null=True)
+    consulta_id = models.IntegerField(null=True)
+    reminder_kind = models.CharField(max_length=20, null=True)
+    empresa_id = models.IntegerField(null=True)
 
     class Meta:
         managed = False
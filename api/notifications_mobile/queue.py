@@ -1,22 +1,33 @@
+from datetime import timedelta
 from typing import Optional, Mapping, Any, Iterable
 from django.utils import timezone
-from django.db import transaction
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Exists, OuterRef, Q
 from .models import (
     HistorialNotificacionMN,
     TipoNotificacionMN,
     CanalNotificacionMN,
     DispositivoMovilMN,
 )
+from .. import catalogo_notificaciones as catalogo
 
 DEFAULT_CANAL = "PUSH_MOBILE"
 
+# reminder_kind de los avisos ligados a una consulta (columna consulta_id)
+RECORDATORIO_CREADA = "CREADA"
+RECORDATORIO_H24 = "H24"
+RECORDATORIO_H2 = "H2"
+# Estados cubiertos por uniq_hist_recordatorio_pendiente
+ESTADOS_PENDIENTES = ("PENDIENTE", "PENDING", "PROCESSING")
+
 def _ensure_catalog(nombre_tipo: str, canal_nombre: str = DEFAULT_CANAL):
-    tipo, _ = TipoNotificacionMN.objects.get_or_create(
-        nombre=nombre_tipo,
+    # Cacheado por worker (api.catalogo_notificaciones): sin consultas tras la primera vez
+    tipo = catalogo.asegurar(
+        TipoNotificacionMN, nombre_tipo,
         defaults={"descripcion": nombre_tipo, "activo": True},
     )
-    canal, _ = CanalNotificacionMN.objects.get_or_create(
-        nombre=canal_nombre,
+    canal = catalogo.asegurar(
+        CanalNotificacionMN, canal_nombre,
         defaults={"descripcion": "Canal push móvil", "activo": True},
     )
     return tipo, canal
@@ -54,6 +65,28 @@ def enqueue_notif(
     )
     return h
 
+def crear_recordatorio(**campos) -> Optional[HistorialNotificacionMN]:
+    """
+    Crea la fila del aviso de una consulta. Si ya hay uno pendiente con la misma
+    (consulta_id, reminder_kind, dispositivo) devuelve None sin romper la transacción
+    que lo contiene (p. ej. la creación de la cita).
+    """
+    try:
+        with transaction.atomic():
+            return HistorialNotificacionMN.objects.create(**campos)
+    except IntegrityError:
+        return None
+
+
+def _sin_aviso_previo(dispositivos, consulta_id, reminder_kind):
+    """Mismo criterio que el NOT EXISTS de queue_reminders.ENCOLAR_SQL."""
+    previos = HistorialNotificacionMN.objects.filter(
+        Q(iddispositivomovil=OuterRef("id")) | Q(iddispositivomovil__isnull=True),
+        consulta_id=consulta_id, reminder_kind=reminder_kind,
+    )
+    return dispositivos.exclude(Exists(previos))
+
+
 @transaction.atomic
 def enqueue_notif_for_user_devices(
     *,
@@ -62,15 +95,23 @@ def enqueue_notif_for_user_devices(
     mensaje: str,
     tipo_nombre: str,
     data: Optional[Mapping[str, Any]] = None,
+    consulta_id: Optional[int] = None,
+    reminder_kind: Optional[str] = None,
+    empresa_id: Optional[int] = None,
 ) -> list[HistorialNotificacionMN]:
     """
     Encola una notificación POR CADA dispositivo activo del usuario,
-    seteando iddispositivomovil en cada fila.
+    seteando iddispositivomovil en cada fila. Con consulta_id + reminder_kind
+    se omiten los dispositivos que ya tienen ese aviso en cualquier estado
+    (pendiente o ya enviado), o todos si hay uno a nivel usuario.
     """
     tipo, canal = _ensure_catalog(tipo_nombre, DEFAULT_CANAL)
     dispositivos: Iterable[DispositivoMovilMN] = DispositivoMovilMN.objects.filter(
         codusuario=usuario_codigo, activo=True
     ).only("id")
+    dedup = consulta_id is not None and reminder_kind is not None
+    if dedup:
+        dispositivos = _sin_aviso_previo(dispositivos, consulta_id, reminder_kind)
     rows: list[HistorialNotificacionMN] = []
     now = timezone.now()
 
@@ -90,7 +131,53 @@ def enqueue_notif_for_user_devices(
             idtiponotificacion=tipo.id,
             idcanalnotificacion=canal.id,
             iddispositivomovil=d.id,
+            consulta_id=consulta_id,
+            reminder_kind=reminder_kind,
+            empresa_id=empresa_id,
         ))
     if rows:
-        HistorialNotificacionMN.objects.bulk_create(rows, batch_size=500)
+        HistorialNotificacionMN.objects.bulk_create(rows, batch_size=500, ignore_conflicts=dedup)
     return rows
+
+
+# Reclamo por lotes para process_notifs: varios workers drenan la cola a la vez
+_CLAIM_SQL = """
+    UPDATE historialnotificacion
+       SET estado = 'PROCESSING', claimed_by = %s, claimed_at = %s
+     WHERE id IN (
+            SELECT id FROM historialnotificacion
+             WHERE estado = 'PENDING'
+                OR (estado = 'PROCESSING' AND claimed_at < %s)
+             ORDER BY id
+             LIMIT %s
+             FOR UPDATE SKIP LOCKED
+     )
+ RETURNING id
+"""
+
+
+def claim_batch(worker: str, limit: int, stale_after: timedelta) -> list[HistorialNotificacionMN]:
+    """
+    Marca como PROCESSING (claimed_by=worker) hasta `limit` filas PENDING, o
+    PROCESSING cuyo reclamo venció (worker caído), y las devuelve ordenadas por id.
+    """
+    now = timezone.now()
+    vencido = now - stale_after
+    if connection.vendor == "postgresql":
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(_CLAIM_SQL, [worker, now, vencido, limit])
+            ids = [row[0] for row in cursor.fetchall()]
+    else:
+        with transaction.atomic():
+            ids = list(
+                HistorialNotificacionMN.objects
+                .filter(Q(estado="PENDING") | Q(estado="PROCESSING", claimed_at__lt=vencido))
+                .order_by("id")
+                .values_list("id", flat=True)[:limit]
+            )
+            HistorialNotificacionMN.objects.filter(id__in=ids).update(
+                estado="PROCESSING", claimed_by=worker, claimed_at=now
+            )
+    if not ids:
+        return []
+    return list(HistorialNotificacionMN.objects.filter(id__in=ids).order_by("id"))
@@ -16,6 +16,7 @@ from .models import (
     HistorialNotificacionMN,
     DispositivoMovilMN,    # <-- AGREGAR ESTA LÍNEA
 )
+from .queue import RECORDATORIO_CREADA, RECORDATORIO_H2, RECORDATORIO_H24, crear_recordatorio
 
 log = logging.getLogger("signals_consulta")
 
@@ -145,6 +146,7 @@ def _enqueue(
     *,
     empresa_id: Optional[int],
     consulta_id: Optional[int],
+    reminder_kind: Optional[str] = None,
     tipo: int = 1,       # 1 = CONSULTA
     canal: int = 1,      # 1 = PUSH
     datos_extra: Optional[dict] = None,
@@ -167,7 +169,8 @@ def _enqueue(
     if datos_extra:
         datos.update(datos_extra)
 
-    HistorialNotificacionMN.objects.create(
+    # Si ya hay uno pendiente igual (uniq_hist_recordatorio_pendiente) no se duplica
+    crear_recordatorio(
         titulo=titulo,
         mensaje=mensaje,
         datos_adicionales=datos,
@@ -182,6 +185,9 @@ def _enqueue(
         idtiponotificacion=tipo,
         idcanalnotificacion=canal,
         iddispositivomovil=device_id,   # <<< ahora se guarda
+        consulta_id=consulta_id,
+        reminder_kind=reminder_kind,
+        empresa_id=empresa_id,
     )
 
 
@@ -216,12 +222,14 @@ def _handler(sender, instance, created: bool, **kwargs):
             fecha_envio=timezone.now(),
             empresa_id=empresa_id,
             consulta_id=getattr(instance, "id", None),
+            reminder_kind=RECORDATORIO_CREADA,
         )
 
         # Recordatorios (24h y 2h antes) si tenemos fecha+hora
         if cita_dt:
             now = timezone.now()
-            for delta, label in ((timedelta(hours=24), "24h"), (timedelta(hours=2), "2h")):
+            for delta, label, kind in ((timedelta(hours=24), "24h", RECORDATORIO_H24),
+                                       (timedelta(hours=2), "2h", RECORDATORIO_H2)):
                 when = cita_dt - delta
                 if when > now:
                     _enqueue(
@@ -231,6 +239,7 @@ def _handler(sender, instance, created: bool, **kwargs):
                         fecha_envio=when,
                         empresa_id=empresa_id,
                         consulta_id=getattr(instance, "id", None),
+                        reminder_kind=kind,
                         datos_extra={"reminder": label},
                     )
     except Exception:
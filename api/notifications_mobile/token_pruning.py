@@ -0,0 +1,41 @@
+# api/notifications_mobile/token_pruning.py
+"""
+Baja de tokens FCM muertos.
+
+Los caminos de despacho juntan los resultados de FCMSender que vienen con
+muerto=True y al final llaman a desactivar_tokens(): un UPDATE por motivo
+(activo=False, motivo_baja, fecha_baja) sobre dispositivomovil, en lugar de
+seguir gastando un request por token en cada envío posterior.
+"""
+import logging
+from typing import Dict, Iterable
+
+from django.utils import timezone
+
+from api.models_notifications import DispositivoMovil
+
+logger = logging.getLogger(__name__)
+
+
+def tokens_muertos(resultados: Iterable[dict]) -> Dict[str, str]:
+    """{token: motivo} de los resultados que FCM marcó como definitivamente inválidos."""
+    return {r["token"]: r.get("codigo") or "INVALIDO" for r in resultados or [] if r.get("muerto")}
+
+
+def desactivar_tokens(muertos: Dict[str, str]) -> int:
+    """Da de baja los dispositivos de esos tokens (agrupados por motivo). Devuelve cuántos."""
+    if not muertos:
+        return 0
+    por_motivo: Dict[str, list] = {}
+    for token, motivo in muertos.items():
+        por_motivo.setdefault(motivo[:50], []).append(token)
+
+    ahora = timezone.now()
+    total = 0
+    for motivo, tokens in por_motivo.items():
+        total += DispositivoMovil.objects.filter(token_fcm__in=tokens, activo=True).update(
+            activo=False, motivo_baja=motivo, fecha_baja=ahora
+        )
+    if total:
+        logger.info(f"[FCM] {total} dispositivos dados de baja por token inválido ({', '.join(por_motivo)})")
+    return total
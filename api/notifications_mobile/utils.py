@@ -1,10 +1,7 @@
-import time
-import json
-import requests
-import jwt  # PyJWT
 from typing import List, Dict, Any
 
 from api.notifications_mobile.config import get_fcm_project_id, get_fcm_sa_info
+from api.notifications_mobile.fcm_sender import get_fcm_sender
 
 
 def mobile_notifications_health() -> Dict[str, Any]:
@@ -33,40 +30,6 @@ def mobile_notifications_health() -> Dict[str, Any]:
     return resp
 
 
-def _get_google_oauth_token(sa_info: dict) -> str:
-    """
-    Intercambia un JWT firmado (service account) por un access_token OAuth2 de Google
-    con scope de Firebase Cloud Messaging.
-    """
-    now = int(time.time())
-    payload = {
-        "iss": sa_info["client_email"],
-        "scope": "https://www.googleapis.com/auth/firebase.messaging",
-        "aud": "https://oauth2.googleapis.com/token",
-        "iat": now,
-        "exp": now + 3600,
-    }
-    additional_headers = {"kid": sa_info.get("private_key_id")}
-    signed_jwt = jwt.encode(
-        payload,
-        sa_info["private_key"],
-        algorithm="RS256",
-        headers=additional_headers,
-    )
-
-    resp = requests.post(
-        "https://oauth2.googleapis.com/token",
-        data={
-            "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
-            "assertion": signed_jwt,
-        },
-        timeout=15,
-    )
-    resp.raise_for_status()
-    data = resp.json()
-    return data["access_token"]
-
-
 def mobile_send_push_fcm(
     tokens: List[str],
     title: str,
@@ -79,51 +42,21 @@ def mobile_send_push_fcm(
 
     Retorna:
       {
-        "sent": <int>,      # cantidad de envíos exitosos
-        "errors": [ ... ]   # lista de errores por token (si hubo)
+        "sent": <int>,        # cantidad de envíos exitosos
+        "errors": [ ... ],    # lista de errores por token (si hubo)
+        "resultados": [ ... ] # un dict por token (ver fcm_sender.FCMSender.enviar_uno)
       }
     """
     if not tokens:
         return {"sent": 0, "errors": ["NO_TOKENS"]}
 
-    project_id = get_fcm_project_id()
-    sa_info = get_fcm_sa_info()
-    access_token = _get_google_oauth_token(sa_info)
-
-    url = f"https://fcm.googleapis.com/v1/projects/{project_id}/messages:send"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json; charset=UTF-8",
+    resultados = get_fcm_sender().enviar(tokens, title, body, data, android_channel_id)
+    errors = [
+        f"{r['token'][:12]}… -> {r['status'] or 'EXC'}: {r['error']}"
+        for r in resultados if not r["ok"]
+    ]
+    return {
+        "sent": sum(1 for r in resultados if r["ok"]),
+        "errors": errors,
+        "resultados": resultados,
     }
-
-    sent = 0
-    errors: List[str] = []
-
-    for tok in tokens:
-        message: Dict[str, Any] = {
-            "message": {
-                "token": tok,
-                "notification": {"title": title, "body": body},
-                "data": {k: str(v) for (k, v) in (data or {}).items()},
-                "android": {"priority": "HIGH"},
-                "apns": {"headers": {"apns-priority": "10"}},
-            }
-        }
-
-        if android_channel_id:
-            message["message"].setdefault("android", {})
-            message["message"]["android"]["notification"] = {
-                "channel_id": android_channel_id,
-                "sound": "default",
-            }
-
-        try:
-            r = requests.post(url, headers=headers, data=json.dumps(message), timeout=15)
-            if r.status_code in (200, 201):
-                sent += 1
-            else:
-                errors.append(f"{tok[:12]}… -> {r.status_code}: {r.text[:200]}")
-        except Exception as e:
-            errors.append(f"{tok[:12]}… -> EXC: {str(e)[:200]}")
-
-    return {"sent": sent, "errors": errors}
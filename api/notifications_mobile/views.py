@@ -7,7 +7,9 @@ from __future__ import annotations
 
 import logging
 import os
+import time
 
+from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
 from django.db.models import F
@@ -25,6 +27,8 @@ from .serializers import (
     MobileRegisterDeviceSerializer,
 )
 from .utils import mobile_send_push_fcm, mobile_notifications_health
+from .token_pruning import desactivar_tokens, tokens_muertos
+from .dispatch import despachar_lote, pendientes_push
 from .models import UsuarioMN, DispositivoMovilMN, HistorialNotificacionMN
 
 logger = logging.getLogger(__name__)
@@ -32,6 +36,10 @@ logger = logging.getLogger(__name__)
 # Secreto para el dispatcher (puedes setear NOTIF_DISPATCH_SECRET en el entorno)
 NOTIF_DISPATCH_SECRET = os.environ.get("NOTIF_DISPATCH_SECRET", "DEV_NOTIF_SECRET")
 
+# mobile_dispatch_due: filas por lote y segundos máximos por llamada
+MOBILE_DISPATCH_LOTE = getattr(settings, "MOBILE_DISPATCH_LOTE", 200)
+MOBILE_DISPATCH_PRESUPUESTO = getattr(settings, "MOBILE_DISPATCH_PRESUPUESTO", 25)
+
 
 class MobileNotificationsHealthView(APIView):
     permission_classes = [permissions.AllowAny]
@@ -132,6 +140,9 @@ class MobileRegisterDeviceView(APIView):
                     d.version_app = version_app; updates.append("version_app")
                 if not d.activo:
                     d.activo = True; updates.append("activo")
+                if d.motivo_baja or d.fecha_baja:
+                    # token re-registrado: deja de contar como baja por FCM
+                    d.motivo_baja, d.fecha_baja = "", None; updates += ["motivo_baja", "fecha_baja"]
                 d.ultima_actividad = now; updates.append("ultima_actividad")
                 if updates:
                     d.save(update_fields=updates)
@@ -156,6 +167,9 @@ class MobileRegisterDeviceView(APIView):
                         d.version_app = version_app; updates.append("version_app")
                     if not d.activo:
                         d.activo = True; updates.append("activo")
+                    if d.motivo_baja or d.fecha_baja:
+                        # token re-registrado: deja de contar como baja por FCM
+                        d.motivo_baja, d.fecha_baja = "", None; updates += ["motivo_baja", "fecha_baja"]
                     d.ultima_actividad = now; updates.append("ultima_actividad")
                     if updates:
                         d.save(update_fields=updates)
@@ -222,6 +236,7 @@ def mobile_dispatch_notification(request, pk: int):
 
     try:
         res = mobile_send_push_fcm(tokens, obj.titulo, obj.mensaje, data)
+        desactivar_tokens(tokens_muertos(res.get("resultados")))
         device_id = devices[0].id if devices else None
         HistorialNotificacionMN.objects.filter(id=obj.id).update(
             estado="ENVIADO",
@@ -248,65 +263,37 @@ def mobile_dispatch_notification(request, pk: int):
 def mobile_dispatch_due(request):
     """
     Envia todas las notificaciones PUSH pendientes (fecha_envio <= now).
-    Filtra SOLO idcanalnotificacion=1. Límite 200 por corrida.
+    Filtra SOLO idcanalnotificacion=1. Procesa lotes de `lote` filas (por defecto
+    MOBILE_DISPATCH_LOTE) hasta vaciar lo vencido o agotar `presupuesto` segundos.
+
+    Cada lote lo resuelve dispatch.despachar_lote (reclamo en una transacción corta,
+    una consulta de dispositivos y los resultados guardados en bloques).
     """
-    now = timezone.now()
-    pendientes = list(
-        HistorialNotificacionMN.objects.filter(
-            estado="PENDIENTE",
-            idcanalnotificacion=1,     # <<< SOLO PUSH
-            fecha_envio__lte=now
-        )
-        .order_by("fecha_envio")[:200]
-    )
+    try:
+        lote = max(1, min(int(request.query_params.get("lote", MOBILE_DISPATCH_LOTE)), 1000))
+        presupuesto = max(1.0, float(request.query_params.get("presupuesto", MOBILE_DISPATCH_PRESUPUESTO)))
+    except ValueError:
+        return Response({"detail": "lote y presupuesto deben ser numéricos"}, status=status.HTTP_400_BAD_REQUEST)
 
-    total = len(pendientes)
-    sent = 0
-    skipped = 0
-    errors = 0
+    inicio = time.monotonic()
+    now = timezone.now()
+    totales = {"total": 0, "sent": 0, "skipped": 0, "errors": 0}
+    batches = 0
+    muertos = {}  # tokens rechazados por FCM en esta corrida (baja en bloque al final)
 
-    for obj in pendientes:
-        data = obj.datos_adicionales or {}
-        codusuario = obj.codusuario or data.get("paciente_codusuario")
+    while time.monotonic() - inicio < presupuesto:
+        resumen = despachar_lote(lote, ahora=now, muertos=muertos)
+        if not resumen["total"]:
+            break
+        batches += 1
+        for k, v in resumen.items():
+            totales[k] += v
 
-        devices = list(
-            DispositivoMovilMN.objects.filter(codusuario=codusuario, activo=True)
-            .exclude(token_fcm__isnull=True)
-            .exclude(token_fcm="")
-            .order_by("-ultima_actividad")
-        )
-        tokens = list(dict.fromkeys([d.token_fcm for d in devices]))
-
-        if not tokens:
-            skipped += 1
-            HistorialNotificacionMN.objects.filter(id=obj.id).update(
-                estado="ERROR",
-                intentos=F("intentos") + 1,
-                error_mensaje="sin tokens activos",
-            )
-            continue
-
-        try:
-            mobile_send_push_fcm(tokens, obj.titulo, obj.mensaje, data)
-            device_id = devices[0].id if devices else None
-            HistorialNotificacionMN.objects.filter(id=obj.id).update(
-                estado="ENVIADO",
-                fecha_entrega=now,
-                intentos=F("intentos") + 1,
-                error_mensaje="",
-                iddispositivomovil=device_id,   # <<< guarda el dispositivo usado
-            )
-            sent += 1
-        except Exception as e:
-            errors += 1
-            HistorialNotificacionMN.objects.filter(id=obj.id).update(
-                estado="ERROR",
-                intentos=F("intentos") + 1,
-                error_mensaje=str(e)[:1000],
-            )
+    bajas = desactivar_tokens(muertos)
+    restantes = pendientes_push().filter(fecha_envio__lte=now).exists()
 
     return Response(
-        {"ok": True, "total": total, "sent": sent, "skipped": skipped, "errors": errors},
+        {"ok": True, **totales, "batches": batches, "pending_left": restantes, "tokens_baja": bajas},
         status=status.HTTP_200_OK
     )
 
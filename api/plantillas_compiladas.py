@@ -0,0 +1,112 @@
+# api/plantillas_compiladas.py
+"""
+Plantillas de notificación compiladas una sola vez por proceso.
+
+NotificationService renderizaba cada asunto/título/mensaje con Template(texto)
+por destinatario y por canal, es decir, volvía a parsear el mismo texto miles
+de veces en un envío masivo. Aquí cada texto se divide una vez con el Lexer de
+Django en una lista de piezas (texto literal o variable ya resuelta a
+django.template.Variable); renderizar es un join sobre esa lista.
+
+Si el texto usa etiquetas ({% if %}...) o filtros ({{ x|date }}) se compila un
+Template completo y también se cachea. En ambos casos la salida es la misma
+que Template(texto).render(Context(datos)): autoescape, localización y
+variables inexistentes como cadena vacía.
+
+Caché:
+  - de_plantilla(): por (id de PlantillaNotificacion, fecha_actualizacion, campo),
+    así una plantilla editada se recompila sola.
+  - compilar(): LRU por texto, para textos sueltos (p. ej. el título por defecto).
+"""
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.template import Context, Template
+from django.template.base import Lexer, TokenType, Variable, VariableDoesNotExist
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+from django.utils.timezone import template_localtime
+
+PLANTILLAS_CACHE_MAX = getattr(settings, 'PLANTILLAS_CACHE_MAX', 512)
+
+_BUILTINS = ('True', 'False', 'None')
+
+_lock = threading.Lock()
+_por_plantilla = {}  # (id, fecha_actualizacion, campo) -> PlantillaCompilada
+
+
+@lru_cache(maxsize=1)
+def _plantilla_vacia():
+    return Template('')
+
+
+def _contexto(datos):
+    """
+    Context ligado a una plantilla: ante excepciones con silent_variable_failure
+    (p. ej. RelatedObjectDoesNotExist) Variable lee context.template.engine.string_if_invalid.
+    """
+    contexto = Context(datos)
+    contexto.template = _plantilla_vacia()
+    return contexto
+
+
+def _variable_simple(contenido):
+    """Sin filtros y sin los literales True/False/None que solo resuelve Context."""
+    return '|' not in contenido and contenido.strip().split('.')[0] not in _BUILTINS
+
+
+class PlantillaCompilada:
+    __slots__ = ('texto', 'piezas', 'template')
+
+    def __init__(self, texto):
+        self.texto = texto or ''
+        self.piezas = []
+        self.template = None
+        for token in Lexer(self.texto).tokenize():
+            if token.token_type == TokenType.TEXT:
+                self.piezas.append(token.contents)
+            elif token.token_type == TokenType.VAR and _variable_simple(token.contents):
+                self.piezas.append(Variable(token.contents))
+            elif token.token_type == TokenType.COMMENT:
+                continue
+            else:
+                # Etiquetas o filtros: motor completo (parseado una sola vez)
+                self.template = Template(self.texto)
+                self.piezas = None
+                return
+
+    def render(self, datos):
+        if self.template is not None:
+            return self.template.render(Context(datos))
+        contexto = _contexto(datos)
+        partes = []
+        for pieza in self.piezas:
+            if pieza.__class__ is str:
+                partes.append(pieza)
+                continue
+            try:
+                valor = pieza.resolve(contexto)
+            except VariableDoesNotExist:
+                continue
+            # Igual que render_value_in_context con autoescape activo
+            partes.append(conditional_escape(str(localize(template_localtime(valor)))))
+        return ''.join(partes)
+
+
+@lru_cache(maxsize=PLANTILLAS_CACHE_MAX)
+def compilar(texto):
+    return PlantillaCompilada(texto)
+
+
+def de_plantilla(plantilla, campo):
+    """Versión compilada de plantilla.<campo> (titulo_template, mensaje_template, asunto_template)."""
+    clave = (plantilla.pk, plantilla.fecha_actualizacion, campo)
+    compilada = _por_plantilla.get(clave)
+    if compilada is None:
+        compilada = PlantillaCompilada(getattr(plantilla, campo))
+        with _lock:
+            if len(_por_plantilla) >= PLANTILLAS_CACHE_MAX:
+                _por_plantilla.clear()
+            _por_plantilla[clave] = compilada
+    return compilada
@@ -0,0 +1,106 @@
+# api/reservas.py
+"""
+Reserva de horarios sin doble agenda.
+
+La unicidad (empresa, odontólogo, fecha, horario) la garantiza la BD con los
+índices únicos parciales de Consulta (uniq_consulta_slot*): dos reservas
+simultáneas del mismo hueco no pueden confirmarse las dos, sin importar cuántos
+workers haya. El SELECT previo de los serializers queda solo como atajo para dar
+un error amable antes de intentar el INSERT.
+
+Al reprogramar se toma además un advisory lock de transacción por
+(odontólogo, día) sobre el día de origen y el de destino, en orden fijo, para que
+dos reprogramaciones cruzadas del mismo odontólogo se ejecuten una tras otra.
+
+Cuando el hueco ya está tomado se responde 409 con los próximos horarios libres
+del mismo odontólogo (api.availability.proximos_libres).
+"""
+import logging
+
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .availability import proximos_libres
+
+logger = logging.getLogger(__name__)
+
+RESTRICCIONES_SLOT = ('uniq_consulta_slot', 'uniq_consulta_slot_sin_empresa')
+ALTERNATIVAS = 5
+# Prefijo de las claves de advisory lock de reservas (evita chocar con otros usos)
+_ESPACIO_BLOQUEO = 0x0C17
+
+
+class HorarioNoDisponible(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'El horario seleccionado ya no está disponible.'
+    default_code = 'horario_no_disponible'
+
+    def __init__(self, detail=None, alternativas=None):
+        super().__init__(detail)
+        # APIException convierte todo el detalle a texto: las alternativas se dejan
+        # tal cual para que idhorario llegue como número
+        self.detail = {'detail': self.detail, 'alternativas': alternativas or []}
+
+
+def clave_bloqueo(odontologo_id, fecha):
+    """Clave bigint del advisory lock de un odontólogo en un día."""
+    return (_ESPACIO_BLOQUEO << 48) | (int(odontologo_id) << 20) | fecha.toordinal()
+
+
+def bloquear_dias(*dias):
+    """
+    Advisory locks de transacción (se liberan solos en COMMIT/ROLLBACK) para cada
+    (odontologo_id, fecha). Debe llamarse dentro de transaction.atomic().
+    """
+    if connection.vendor != 'postgresql':
+        return
+    claves = sorted({clave_bloqueo(od, f) for od, f in dias if od and f})
+    with connection.cursor() as cursor:
+        for clave in claves:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [clave])
+
+
+def es_conflicto_de_horario(error):
+    causa = getattr(error, '__cause__', None)
+    diag = getattr(causa, 'diag', None)
+    nombre = getattr(diag, 'constraint_name', None)
+    if nombre:
+        return nombre in RESTRICCIONES_SLOT
+    texto = str(error)
+    return any(r in texto for r in RESTRICCIONES_SLOT)
+
+
+def alternativas(empresa_id, odontologo_id, fecha, cantidad=ALTERNATIVAS):
+    """Próximos huecos libres del odontólogo desde `fecha`: [{'fecha', 'idhorario', 'hora'}]."""
+    if not odontologo_id:
+        return []
+    try:
+        hoy = timezone.localdate()
+        slots, libres = proximos_libres(
+            empresa_id, [odontologo_id], max(fecha, hoy), cantidad, ahora=timezone.localtime()
+        )
+    except Exception as e:
+        logger.warning(f"[Reservas] No se pudieron calcular alternativas: {e}")
+        return []
+    horas = dict(slots)
+    return [{'fecha': f.isoformat(), 'idhorario': hid, 'hora': horas[hid]} for f, hid, _ in libres]
+
+
+def no_disponible(empresa_id, odontologo_id, fecha, detail=None):
+    return HorarioNoDisponible(detail, alternativas(empresa_id, odontologo_id, fecha))
+
+
+def guardar_reserva(guardar, empresa_id, odontologo_id, fecha, detail=None):
+    """
+    Ejecuta `guardar()` (INSERT/UPDATE de la consulta) en un savepoint y traduce
+    la violación del índice único a HorarioNoDisponible (409).
+    """
+    try:
+        with transaction.atomic():
+            return guardar()
+    except IntegrityError as e:
+        if not es_conflicto_de_horario(e):
+            raise
+        raise no_disponible(empresa_id, odontologo_id, fecha, detail)
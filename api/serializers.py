@@ -10,6 +10,7 @@ from .models import (
 )
 from .models import Estadodeconsulta
 from rest_framework.validators import UniqueTogetherValidator
+from .reservas import no_disponible
 
 # --------- Usuarios / Pacientes ---------
 
@@ -93,16 +94,26 @@ class CreateConsultaSerializer(serializers.ModelSerializer):
     def validate(self, data):
         """
         Validar que no exista ya una consulta para el mismo odontólogo,
-        en la misma fecha y horario.
+        en la misma fecha y horario. Es solo un atajo: la garantía real es el
+        índice único de consulta (ver api.reservas), que la vista traduce a 409.
         """
-        if Consulta.objects.filter(
-            cododontologo=data['cododontologo'],
+        odontologo = data.get('cododontologo')
+        if odontologo is None:
+            return data
+        request = self.context.get('request')
+        tenant = getattr(request, 'tenant', None)
+        ocupados = Consulta.objects.filter(
+            cododontologo=odontologo,
             fecha=data['fecha'],
             idhorario=data['idhorario']
-            # Opcional: Excluir citas canceladas si se permite re-agendar sobre ellas
-            # ).exclude(idestadoconsulta__in=[3, 4]
-        ).exists():
-            raise serializers.ValidationError(
+        )
+        if tenant:
+            ocupados = ocupados.filter(empresa=tenant)
+        if self.instance is not None:
+            ocupados = ocupados.exclude(pk=self.instance.pk)
+        if ocupados.exists():
+            raise no_disponible(
+                tenant.id if tenant else None, odontologo.pk, data['fecha'],
                 "Este horario ya está reservado con el odontólogo seleccionado."
             )
         return data
@@ -153,7 +164,8 @@ class ReprogramarConsultaSerializer(serializers.Serializer):
             fecha=data['fecha'],
             idhorario=data['idhorario']
         ).exclude(pk=consulta.pk).exists(): # Excluimos la cita actual
-            raise serializers.ValidationError(
+            raise no_disponible(
+                consulta.empresa_id, consulta.cododontologo_id, data['fecha'],
                 "El nuevo horario seleccionado no está disponible."
             )
         return data
@@ -709,9 +721,18 @@ from .models import Bitacora
 
 
 class BitacoraSerializer(serializers.ModelSerializer):
+    """
+    Expone los campos reales de Bitacora con los nombres que ya consume el frontend
+    (fecha_hora, modelo_afectado, objeto_id, descripcion, datos_adicionales).
+    """
     usuario_nombre = serializers.SerializerMethodField()
-    accion_display = serializers.CharField(source='get_accion_display', read_only=True)
+    accion_display = serializers.CharField(source='accion', read_only=True)
+    fecha_hora = serializers.DateTimeField(source='timestamp', read_only=True)
     fecha_hora_formatted = serializers.SerializerMethodField()
+    modelo_afectado = serializers.CharField(source='tabla_afectada', read_only=True)
+    objeto_id = serializers.IntegerField(source='registro_id', read_only=True)
+    descripcion = serializers.SerializerMethodField()
+    datos_adicionales = serializers.SerializerMethodField()
 
     class Meta:
         model = Bitacora
@@ -729,23 +750,33 @@ class BitacoraSerializer(serializers.ModelSerializer):
         return "Usuario anónimo"
 
     def get_fecha_hora_formatted(self, obj):
-        return obj.fecha_hora.strftime('%d/%m/%Y %H:%M:%S')
+        return obj.timestamp.strftime('%d/%m/%Y %H:%M:%S') if obj.timestamp else ''
+
+    def get_descripcion(self, obj):
+        from .bitacora_export import descripcion_de
+        return descripcion_de(obj)
+
+    def get_datos_adicionales(self, obj):
+        return obj.valores_nuevos or obj.valores_anteriores or {}
 
 
 # Función auxiliar para crear registros de bitácora manualmente
 def crear_registro_bitacora(accion, usuario=None, ip_address='127.0.0.1', descripcion='',
                             modelo_afectado=None, objeto_id=None, datos_adicionales=None):
     """
-    Función auxiliar para crear registros de bitácora desde las vistas
+    Función auxiliar para crear registros de bitácora desde las vistas.
+    Se encola en api.audit_sink (inserción por lotes en segundo plano).
     """
-    return Bitacora.objects.create(
+    from .audit_sink import registrar_bitacora
+
+    registrar_bitacora(
         accion=accion,
-        descripcion=descripcion,
         usuario=usuario,
+        empresa=getattr(usuario, 'empresa_id', None),
         ip_address=ip_address,
-        modelo_afectado=modelo_afectado,
-        objeto_id=objeto_id,
-        datos_adicionales=datos_adicionales or {}
+        tabla_afectada=modelo_afectado,
+        registro_id=objeto_id,
+        valores_nuevos={'descripcion': descripcion, **(datos_adicionales or {})}
     )
 
 
@@ -88,7 +88,7 @@ class PlantillaNotificacionSerializer(serializers.ModelSerializer):
     class Meta:
         model = PlantillaNotificacion
         fields = [
-            'id', 'tipo_notificacion', 'canal_notificacion', 'nombre',
+            'id', 'tipo_notificacion', 'canal_notificacion', 'empresa', 'nombre',
             'asunto_template', 'titulo_template', 'mensaje_template',
             'variables_disponibles', 'activo', 'fecha_creacion', 'fecha_actualizacion',
             'tipo_notificacion_info', 'canal_notificacion_info'
@@ -1,22 +1,59 @@
 # api/services/notification_service.py
 from api.notifications_mobile.config import get_fcm_project_id, get_fcm_sa_info
 import logging
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
 from typing import List, Dict, Any, Optional
 from datetime import datetime
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.conf import settings
-from django.template import Template, Context
+from django.db import close_old_connections, connection
+from django.db.models import Q
 from django.utils import timezone
 import requests
 import json
 
 from ..models import Usuario
+from .. import catalogo_notificaciones as catalogo
+from .. import plantillas_compiladas
 from ..models_notifications import (
     TipoNotificacion, CanalNotificacion, PreferenciaNotificacion,
     DispositivoMovil, HistorialNotificacion, PlantillaNotificacion
 )
 logger = logging.getLogger(__name__)
 from api.notifications_mobile.utils import mobile_send_push_fcm
+from api.notifications_mobile.token_pruning import desactivar_tokens, tokens_muertos
+from api.notifications_mobile.fcm_sender import construir_mensaje, get_fcm_sender
+from api.notifications_mobile import expo_sender
+
+# Desde cuántos usuarios enviar_notificacion usa el modo masivo si no se indica
+NOTIFICACIONES_MASIVO_UMBRAL = getattr(settings, 'NOTIFICACIONES_MASIVO_UMBRAL', 20)
+# Envío simultáneo de los canales de una notificación (_despachar_canales)
+NOTIF_CANALES_CONCURRENCIA = getattr(settings, 'NOTIF_CANALES_CONCURRENCIA', 8)
+NOTIF_TIMEOUT_CANAL = getattr(settings, 'NOTIF_TIMEOUT_CANAL', {'email': 15, 'push': 10})  # segundos
+NOTIF_TIMEOUT_CANAL_DEFECTO = 10
+
+_ejecutor = None
+_ejecutor_lock = threading.Lock()
+_sesiones_push = threading.local()
+
+
+def _ejecutor_canales() -> ThreadPoolExecutor:
+    """Pool acotado compartido por el proceso para los envíos por canal."""
+    global _ejecutor
+    if _ejecutor is None:
+        with _ejecutor_lock:
+            if _ejecutor is None:
+                _ejecutor = ThreadPoolExecutor(max_workers=NOTIF_CANALES_CONCURRENCIA,
+                                               thread_name_prefix='notif-canal')
+    return _ejecutor
+
+
+# Tokens por request en los envíos agrupados (OneSignal admite hasta 2000 player ids)
+ONESIGNAL_LOTE = min(getattr(settings, 'ONESIGNAL_LOTE', 2000), 2000)
+SUPABASE_PUSH_LOTE = getattr(settings, 'SUPABASE_PUSH_LOTE', 500)
 
 
 
@@ -43,10 +80,14 @@ class NotificationService:
             mensaje: str,
             canales: Optional[List[str]] = None,
             datos_adicionales: Optional[Dict[str, Any]] = None,
-            usar_plantilla: bool = True
+            usar_plantilla: bool = True,
+            masivo: Optional[bool] = None
     ) -> Dict[str, Any]:
         """
-        Envía notificaciones a una lista de usuarios
+        Envía notificaciones a una lista de usuarios.
+        masivo=True (o None con NOTIFICACIONES_MASIVO_UMBRAL usuarios o más) carga
+        preferencias, plantillas y dispositivos de todos en pocas consultas y envía
+        por lotes; el resultado tiene el mismo formato.
         """
 
         resultados = {
@@ -56,12 +97,19 @@ class NotificationService:
             'detalles': []
         }
 
-        try:
-            tipo_notificacion = TipoNotificacion.objects.get(nombre=tipo_notificacion_nombre, activo=True)
-        except TipoNotificacion.DoesNotExist:
+        tipo_notificacion = catalogo.obtener(TipoNotificacion, tipo_notificacion_nombre)
+        if tipo_notificacion is None or not tipo_notificacion.activo:
             logger.error(f"Tipo de notificación '{tipo_notificacion_nombre}' no encontrado")
             return resultados
 
+        if masivo is None:
+            masivo = len(usuarios) >= NOTIFICACIONES_MASIVO_UMBRAL
+        if masivo:
+            return self._enviar_masivo(
+                usuarios, tipo_notificacion, titulo, mensaje, canales,
+                datos_adicionales, usar_plantilla, resultados
+            )
+
         for usuario in usuarios:
             try:
                 resultado_usuario = self._enviar_a_usuario(
@@ -132,19 +180,20 @@ class NotificationService:
 
         # Procesar plantillas si está habilitado
         if usar_plantilla:
-            plantillas = self._obtener_plantillas(tipo_notificacion, canales_activos)
+            plantillas = self._obtener_plantillas(tipo_notificacion, canales_activos, [usuario.empresa_id])
         else:
             plantillas = {}
 
-        # Enviar por cada canal
+        # Preparar cada canal (plantilla + fila de historial); el envío va después, en paralelo
+        tareas = []
         for canal in canales_activos:
             try:
                 # Usar plantilla si está disponible
-                if canal in plantillas:
-                    plantilla = plantillas[canal]
-                    titulo_final = self._procesar_plantilla(plantilla.titulo_template, usuario, datos_adicionales)
-                    mensaje_final = self._procesar_plantilla(plantilla.mensaje_template, usuario, datos_adicionales)
-                    asunto = self._procesar_plantilla(plantilla.asunto_template or titulo, usuario, datos_adicionales)
+                plantilla = self._plantilla_para(plantillas, usuario, canal)
+                if plantilla is not None:
+                    titulo_final, mensaje_final, asunto = self._renderizar_plantilla(
+                        plantilla, titulo, self._contexto_plantilla(usuario, datos_adicionales)
+                    )
                 else:
                     titulo_final = titulo
                     mensaje_final = mensaje
@@ -154,39 +203,383 @@ class NotificationService:
                 historial = HistorialNotificacion.objects.create(
                     usuario=usuario,
                     tipo_notificacion=tipo_notificacion,
-                    canal_notificacion=CanalNotificacion.objects.get(nombre=canal),
+                    canal_notificacion=catalogo.requerir(CanalNotificacion, canal),
                     titulo=titulo_final,
                     mensaje=mensaje_final,
                     datos_adicionales=datos_adicionales or {},
                     estado='pendiente'
                 )
-
-                # Enviar según el canal
-                if canal == 'email':
-                    exito = self._enviar_email(usuario, asunto, titulo_final, mensaje_final, historial)
-                elif canal == 'push':
-                    exito = self._enviar_push(usuario, titulo_final, mensaje_final, datos_adicionales, historial)
-                else:
-                    exito = False
-                    historial.error_mensaje = f"Canal '{canal}' no implementado"
-
-                if exito:
-                    resultado['canales_enviados'].append(canal)
-                    historial.estado = 'enviado'
-                    historial.fecha_envio = timezone.now()
-                else:
-                    resultado['errores'].append(f"Error enviando por {canal}")
-                    historial.estado = 'error'
-
-                historial.save()
+                tareas.append((canal, historial, asunto, titulo_final, mensaje_final))
 
             except Exception as e:
                 logger.error(f"Error enviando por canal {canal} a usuario {usuario.codigo}: {str(e)}")
                 resultado['errores'].append(f"Error en canal {canal}: {str(e)}")
 
+        for canal, (exito, error) in self._despachar_canales(usuario, tareas, datos_adicionales):
+            if exito:
+                resultado['canales_enviados'].append(canal)
+            else:
+                resultado['errores'].append(error)
+
         resultado['exito'] = len(resultado['canales_enviados']) > 0
         return resultado
 
+    def _despachar_canales(self, usuario: Usuario, tareas, datos_adicionales: Optional[Dict[str, Any]]):
+        """
+        Envía los canales de una notificación a la vez en el pool compartido, cada uno con
+        su plazo (NOTIF_TIMEOUT_CANAL, contado desde que la tarea toma un hilo). Cada tarea
+        guarda su propio resultado en el historial, así un canal que vence el plazo sigue en
+        segundo plano y registra su estado al terminar sin demorar a los demás ni la
+        respuesta. Una tarea que en ese plazo ni siquiera empezó (pool ocupado) se cancela.
+        Con un solo canal, o dentro de una transacción (los hilos no verían las filas del
+        historial sin confirmar), se envía en el hilo actual como antes.
+        Devuelve [(canal, (éxito, error))] en el orden de `tareas`.
+        """
+        if len(tareas) <= 1 or connection.in_atomic_block:
+            return [(t[0], self._entregar_canal(usuario, *t, datos_adicionales)) for t in tareas]
+
+        inicio = time.monotonic()
+        futuros = []
+        for tarea in tareas:
+            arranque = {}
+            futuro = _ejecutor_canales().submit(
+                self._entregar_canal_en_hilo, arranque, usuario, *tarea, datos_adicionales
+            )
+            futuros.append((tarea, futuro, arranque))
+
+        salida = []
+        for (canal, historial, *_), futuro, arranque in futuros:
+            plazo = NOTIF_TIMEOUT_CANAL.get(canal, NOTIF_TIMEOUT_CANAL_DEFECTO)
+            try:
+                salida.append((canal, futuro.result(timeout=max(0, inicio + plazo - time.monotonic()))))
+                continue
+            except FuturesTimeout:
+                pass
+
+            if futuro.cancel():
+                # Seguía en cola (pool ocupado): no se envía y la fila no queda pendiente
+                historial.estado = 'error'
+                historial.error_mensaje = f"Sin turno en el pool de envío tras {plazo}s"
+                historial.save(update_fields=['estado', 'error_mensaje'])
+                logger.warning(f"Canal {canal} de usuario {usuario.codigo} cancelado: pool ocupado {plazo}s")
+                salida.append((canal, (False, f"Tiempo agotado en canal {canal} (no se envió)")))
+                continue
+
+            # Ya empezó: el plazo se cuenta desde que tomó un hilo, no desde que se encoló
+            try:
+                restante = arranque.get('t', time.monotonic()) + plazo - time.monotonic()
+                salida.append((canal, futuro.result(timeout=max(0, restante))))
+            except FuturesTimeout:
+                logger.warning(f"Canal {canal} de usuario {usuario.codigo} superó {plazo}s; sigue en segundo plano")
+                salida.append((canal, (False, f"Tiempo agotado en canal {canal} (sigue en segundo plano)")))
+        return salida
+
+    def _entregar_canal_en_hilo(self, arranque, *args):
+        arranque['t'] = time.monotonic()
+        # Conexión a BD propia del hilo del pool: se recicla según CONN_MAX_AGE
+        close_old_connections()
+        try:
+            return self._entregar_canal(*args)
+        finally:
+            close_old_connections()
+
+    def _entregar_canal(self, usuario: Usuario, canal: str, historial: HistorialNotificacion, asunto: str,
+                        titulo: str, mensaje: str, datos_adicionales: Optional[Dict[str, Any]]) -> tuple:
+        """
+        Envía por un canal y deja el resultado en su fila del historial. Devuelve (éxito, error)
+        """
+        try:
+            # Enviar según el canal
+            if canal == 'email':
+                exito = self._enviar_email(usuario, asunto, titulo, mensaje, historial)
+            elif canal == 'push':
+                exito = self._enviar_push(usuario, titulo, mensaje, datos_adicionales, historial)
+            else:
+                exito = False
+                historial.error_mensaje = f"Canal '{canal}' no implementado"
+
+            if exito:
+                historial.estado = 'enviado'
+                historial.fecha_envio = timezone.now()
+            else:
+                historial.estado = 'error'
+
+            historial.save(update_fields=['estado', 'fecha_envio', 'error_mensaje'])
+            return exito, None if exito else f"Error enviando por {canal}"
+
+        except Exception as e:
+            logger.error(f"Error enviando por canal {canal} a usuario {usuario.codigo}: {str(e)}")
+            return False, f"Error en canal {canal}: {str(e)}"
+
+    def _enviar_masivo(
+            self,
+            usuarios: List[Usuario],
+            tipo_notificacion: TipoNotificacion,
+            titulo: str,
+            mensaje: str,
+            canales: Optional[List[str]],
+            datos_adicionales: Optional[Dict[str, Any]],
+            usar_plantilla: bool,
+            resultados: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """
+        Igual que el bucle de _enviar_a_usuario, pero por lotes: una consulta de
+        preferencias, una de plantillas, un bulk_create y un bulk_update del historial,
+        y el envío agrupado por canal (_enviar_emails_lote / _enviar_push_lote).
+        """
+        preferencias = {}
+        for usuario_id, canal in PreferenciaNotificacion.objects.filter(
+                usuario__in=usuarios,
+                tipo_notificacion=tipo_notificacion,
+                activo=True,
+                canal_notificacion__activo=True
+        ).values_list('usuario_id', 'canal_notificacion__nombre'):
+            preferencias.setdefault(usuario_id, []).append(canal)
+
+        detalles = {}
+        pendientes = []  # (historial, usuario, canal, asunto, titulo, mensaje)
+        for usuario in usuarios:
+            detalle = detalles[usuario.codigo] = {'exito': False, 'canales_enviados': [], 'errores': []}
+            activos = preferencias.get(usuario.codigo, [])
+            canales_usuario = activos if canales is None else [c for c in canales if c in activos]
+            if not canales_usuario:
+                detalle['errores'].append("Usuario no tiene canales activos para este tipo de notificación")
+                continue
+            pendientes.extend((usuario, canal) for canal in canales_usuario)
+
+        canales_usados = list(dict.fromkeys(canal for _, canal in pendientes))
+        canal_por_nombre = {c: catalogo.obtener(CanalNotificacion, c) for c in canales_usados}
+        plantillas = {}
+        if usar_plantilla:
+            # Generales y reemplazos de cada clínica presente en el envío, en una consulta
+            empresas = {usuario.empresa_id for usuario, _ in pendientes}
+            plantillas = self._obtener_plantillas(tipo_notificacion, canales_usados, empresas)
+        contexto_base = self._contexto_base()
+
+        envios = []
+        for usuario, canal in pendientes:
+            if canal_por_nombre[canal] is None:
+                detalles[usuario.codigo]['errores'].append(
+                    f"Error en canal {canal}: CanalNotificacion '{canal}' no existe"
+                )
+                continue
+            plantilla = self._plantilla_para(plantillas, usuario, canal)
+            if plantilla is not None:
+                titulo_final, mensaje_final, asunto = self._renderizar_plantilla(
+                    plantilla, titulo, self._contexto_plantilla(usuario, datos_adicionales, contexto_base)
+                )
+            else:
+                titulo_final, mensaje_final, asunto = titulo, mensaje, titulo
+            historial = HistorialNotificacion(
+                usuario=usuario,
+                tipo_notificacion=tipo_notificacion,
+                canal_notificacion=canal_por_nombre[canal],
+                titulo=titulo_final,
+                mensaje=mensaje_final,
+                datos_adicionales=datos_adicionales or {},
+                estado='pendiente'
+            )
+            envios.append((historial, usuario, canal, asunto, titulo_final, mensaje_final))
+
+        HistorialNotificacion.objects.bulk_create([e[0] for e in envios], batch_size=500)
+
+        exitos = {}
+        lote_email = [e for e in envios if e[2] == 'email']
+        lote_push = [e for e in envios if e[2] == 'push']
+        for envio, exito in zip(lote_email, self._enviar_emails_lote(lote_email)):
+            exitos[id(envio[0])] = exito
+        for envio, exito in zip(lote_push, self._enviar_push_lote(lote_push, datos_adicionales)):
+            exitos[id(envio[0])] = exito
+
+        ahora = timezone.now()
+        for historial, usuario, canal, *_ in envios:
+            detalle = detalles[usuario.codigo]
+            if canal not in ('email', 'push'):
+                historial.error_mensaje = f"Canal '{canal}' no implementado"
+            if exitos.get(id(historial)):
+                detalle['canales_enviados'].append(canal)
+                historial.estado = 'enviado'
+                historial.fecha_envio = ahora
+            else:
+                detalle['errores'].append(f"Error enviando por {canal}")
+                historial.estado = 'error'
+        HistorialNotificacion.objects.bulk_update(
+            [e[0] for e in envios], ['estado', 'fecha_envio', 'error_mensaje'], batch_size=500
+        )
+
+        for usuario in usuarios:
+            detalle = detalles[usuario.codigo]
+            detalle['exito'] = len(detalle['canales_enviados']) > 0
+            resultados['enviados' if detalle['exito'] else 'errores'] += 1
+            resultados['detalles'].append({
+                'usuario_id': usuario.codigo,
+                'usuario_email': usuario.correoelectronico,
+                'exito': detalle['exito'],
+                'canales_enviados': detalle['canales_enviados'],
+                'errores': detalle['errores']
+            })
+        return resultados
+
+    def _enviar_emails_lote(self, envios) -> List[bool]:
+        """
+        Envía los correos del modo masivo por una sola conexión SMTP (se reabre una
+        vez si el servidor la corta). Devuelve un bool por envío, en orden.
+        """
+        if not envios:
+            return []
+        conexion = get_connection(fail_silently=False)
+        try:
+            conexion.open()
+        except Exception as e:
+            logger.error(f"Error abriendo conexión SMTP para envío masivo: {str(e)}")
+            for historial, *_ in envios:
+                historial.error_mensaje = str(e)
+            return [False] * len(envios)
+
+        exitos = []
+        try:
+            for historial, usuario, _, asunto, titulo, mensaje in envios:
+                try:
+                    email = self._construir_email(usuario, asunto, titulo, mensaje)
+                    email.connection = conexion
+                    try:
+                        email.send()
+                    except smtplib.SMTPServerDisconnected:
+                        conexion.close()
+                        conexion.open()
+                        email.send()
+                    exitos.append(True)
+                except Exception as e:
+                    logger.error(f"Error enviando email a {usuario.correoelectronico}: {str(e)}")
+                    historial.error_mensaje = str(e)
+                    exitos.append(False)
+        finally:
+            conexion.close()
+        logger.info(f"Envío masivo de email: {sum(exitos)}/{len(envios)} enviados")
+        return exitos
+
+    def _enviar_push_lote(self, envios, datos_adicionales: Optional[Dict[str, Any]]) -> List[bool]:
+        """
+        Push del modo masivo: los dispositivos de todos los usuarios en una consulta.
+        Con FCM todos los mensajes van por el mismo pool (FCMSender.enviar_varios) y con
+        Expo en lotes de 100 para todos los usuarios juntos; con OneSignal / Supabase los
+        mensajes idénticos se agrupan (_enviar_push_agrupado).
+        Devuelve un bool por envío, en orden.
+        """
+        if not envios:
+            return []
+        dispositivos = {}
+        for d in DispositivoMovil.objects.filter(usuario__in={e[1] for e in envios}, activo=True):
+            dispositivos.setdefault(d.usuario_id, []).append(d)
+
+        exitos = [False] * len(envios)
+        con_dispositivos = []
+        for i, (historial, usuario, *_) in enumerate(envios):
+            if dispositivos.get(usuario.codigo):
+                con_dispositivos.append(i)
+            else:
+                historial.error_mensaje = "No hay dispositivos móviles registrados"
+
+        if self.onesignal_app_id and self.onesignal_rest_key:
+            return self._enviar_push_agrupado(
+                envios, con_dispositivos, dispositivos, datos_adicionales, exitos,
+                self._post_onesignal, ONESIGNAL_LOTE, "No hay tokens válidos de OneSignal"
+            )
+        elif self.expo_access_token:
+            return self._enviar_push_expo_lote(envios, con_dispositivos, dispositivos, datos_adicionales, exitos)
+        elif self.supabase_edge_url:
+            return self._enviar_push_agrupado(
+                envios, con_dispositivos, dispositivos, datos_adicionales, exitos,
+                self._post_supabase, SUPABASE_PUSH_LOTE, "No hay tokens válidos"
+            )
+        elif self.fcm_project_id and self.fcm_sa_json:
+            return self._enviar_push_fcm_lote(envios, con_dispositivos, dispositivos, datos_adicionales, exitos)
+        else:
+            logger.error("No hay servicio de push notifications configurado")
+            for i in con_dispositivos:
+                envios[i][0].error_mensaje = "No hay servicio de push notifications configurado"
+            return exitos
+
+    def _enviar_push_agrupado(self, envios, indices, dispositivos, datos_adicionales, exitos,
+                              post, tamano_lote: int, sin_tokens: str) -> List[bool]:
+        """
+        OneSignal / Supabase en modo masivo: los envíos con el mismo título y mensaje
+        se juntan en un solo destino y salen en requests de hasta `tamano_lote` tokens.
+        Los textos personalizados (distintos por usuario) quedan en grupos de uno, es
+        decir, un request por destinatario como antes.
+        """
+        grupos = {}  # (titulo, mensaje) -> [(índice del envío, token)]
+        for i in indices:
+            historial, usuario, _, _, titulo, mensaje = envios[i]
+            tokens = list(dict.fromkeys(d.token_fcm for d in dispositivos[usuario.codigo] if d.token_fcm))
+            if not tokens:
+                historial.error_mensaje = sin_tokens
+                continue
+            grupos.setdefault((titulo, mensaje), []).extend((i, token) for token in tokens)
+
+        for (titulo, mensaje), destinos in grupos.items():
+            for inicio in range(0, len(destinos), tamano_lote):
+                lote = destinos[inicio:inicio + tamano_lote]
+                exito, error = post([token for _, token in lote], titulo, mensaje, datos_adicionales)
+                for i, _ in lote:
+                    if exito:
+                        exitos[i] = True
+                        envios[i][0].error_mensaje = None
+                    elif not exitos[i]:
+                        envios[i][0].error_mensaje = error
+        return exitos
+
+    def _enviar_push_expo_lote(self, envios, indices, dispositivos, datos_adicionales, exitos) -> List[bool]:
+        grupos, posiciones = [], []
+        for i in indices:
+            historial, usuario, _, _, titulo, mensaje = envios[i]
+            tokens = self._tokens_expo(dispositivos[usuario.codigo])
+            if not tokens:
+                historial.error_mensaje = "No hay tokens válidos de Expo"
+                continue
+            grupos.append((historial, tokens, titulo, mensaje, datos_adicionales or {}))
+            posiciones.append(i)
+
+        try:
+            resultados = self._entregar_expo(grupos)
+        except Exception as e:
+            logger.error(f"Error enviando push Expo: {str(e)}")
+            for historial, *_ in grupos:
+                historial.error_mensaje = str(e)
+            return exitos
+        for i, exito in zip(posiciones, resultados):
+            exitos[i] = exito
+        return exitos
+
+    def _enviar_push_fcm_lote(self, envios, indices, dispositivos, datos_adicionales, exitos) -> List[bool]:
+        mensajes = []  # (índice del envío, token, mensaje FCM)
+        for i in indices:
+            historial, usuario, _, _, titulo, mensaje = envios[i]
+            tokens = list(dict.fromkeys(d.token_fcm for d in dispositivos[usuario.codigo] if d.token_fcm))
+            if not tokens:
+                historial.error_mensaje = "No hay tokens FCM válidos"
+                continue
+            cuerpo = construir_mensaje(titulo, mensaje, datos_adicionales or {})
+            mensajes.extend((i, token, cuerpo) for token in tokens)
+
+        try:
+            resultados = get_fcm_sender().enviar_varios([(token, cuerpo) for _, token, cuerpo in mensajes])
+        except Exception as e:
+            for i, _, _ in mensajes:
+                envios[i][0].error_mensaje = f"FCM exception: {str(e)}"
+            return exitos
+        desactivar_tokens(tokens_muertos(resultados))
+
+        errores = {}
+        for (i, _, _), r in zip(mensajes, resultados):
+            if r["ok"]:
+                exitos[i] = True
+            else:
+                errores.setdefault(i, []).append(f"{r['token'][:12]}… -> {r['status'] or 'EXC'}: {r['error']}")
+        for i, lista in errores.items():
+            envios[i][0].error_mensaje = f"FCM errors: {'; '.join(lista)[:500]}"
+        return exitos
+
     def _obtener_canales_activos(self, usuario: Usuario, tipo_notificacion: TipoNotificacion) -> List[str]:
         """
         Obtiene los canales activos para un usuario y tipo de notificación
@@ -212,118 +605,184 @@ class NotificationService:
         canales_activos = self._obtener_canales_activos(usuario, tipo_notificacion)
         return [canal for canal in canales if canal in canales_activos]
 
-    def _obtener_plantillas(self, tipo_notificacion: TipoNotificacion, canales: List[str]) -> Dict[
-        str, PlantillaNotificacion]:
+    def _obtener_plantillas(self, tipo_notificacion: TipoNotificacion, canales: List[str],
+                            empresas=()) -> Dict[tuple, PlantillaNotificacion]:
         """
-        Obtiene las plantillas para los canales especificados
+        Obtiene las plantillas para los canales especificados: las generales y las
+        propias de `empresas`, indexadas por (empresa_id o None, canal)
         """
+        empresas = [e for e in empresas if e]
+        filtro_empresa = Q(empresa__isnull=True)
+        if empresas:
+            filtro_empresa |= Q(empresa_id__in=empresas)
         plantillas = PlantillaNotificacion.objects.filter(
+            filtro_empresa,
             tipo_notificacion=tipo_notificacion,
             canal_notificacion__nombre__in=canales,
             activo=True
         ).select_related('canal_notificacion')
 
-        return {p.canal_notificacion.nombre: p for p in plantillas}
+        return {(p.empresa_id, p.canal_notificacion.nombre): p for p in plantillas}
 
-    def _procesar_plantilla(self, template_str: str, usuario: Usuario,
-                            datos_adicionales: Optional[Dict[str, Any]]) -> str:
+    def _plantilla_para(self, plantillas: Dict[tuple, PlantillaNotificacion], usuario: Usuario,
+                        canal: str) -> Optional[PlantillaNotificacion]:
         """
-        Procesa una plantilla con las variables del usuario y datos adicionales
+        La plantilla de la clínica del usuario si existe; si no, la general
         """
-        if not template_str:
-            return ""
+        if usuario.empresa_id:
+            plantilla = plantillas.get((usuario.empresa_id, canal))
+            if plantilla is not None:
+                return plantilla
+        return plantillas.get((None, canal))
 
+    def _contexto_base(self) -> Dict[str, Any]:
+        """
+        Variables comunes a todos los destinatarios (se arma una vez por envío)
+        """
         # Información de la clínica desde settings
         clinic_info = getattr(settings, 'CLINIC_INFO', {})
-
-        context_data = {
-            'usuario': usuario,
-            'nombre': usuario.nombre,
-            'apellido': usuario.apellido,
-            'email': usuario.correoelectronico,
-            'telefono': usuario.telefono,
-            'fecha_actual': timezone.now().strftime('%d/%m/%Y'),
-            'hora_actual': timezone.now().strftime('%H:%M'),
+        ahora = timezone.now()
+        return {
+            'fecha_actual': ahora.strftime('%d/%m/%Y'),
+            'hora_actual': ahora.strftime('%H:%M'),
             'clinica_nombre': clinic_info.get('name', 'Clínica Dental'),
             'clinica_telefono': clinic_info.get('phone', ''),
             'clinica_email': clinic_info.get('email', ''),
             'clinica_direccion': clinic_info.get('address', ''),
         }
 
+    def _contexto_plantilla(self, usuario: Usuario, datos_adicionales: Optional[Dict[str, Any]],
+                            base: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Variables del usuario y datos adicionales para renderizar una plantilla
+        """
+        context_data = dict(base or self._contexto_base())
+        context_data.update({
+            'usuario': usuario,
+            'nombre': usuario.nombre,
+            'apellido': usuario.apellido,
+            'email': usuario.correoelectronico,
+            'telefono': usuario.telefono,
+        })
         if datos_adicionales:
             context_data.update(datos_adicionales)
+        return context_data
 
+    def _renderizar(self, template_str: str, contexto: Dict[str, Any],
+                    plantilla: Optional[PlantillaNotificacion] = None, campo: str = '') -> str:
+        """
+        Renderiza con la versión compilada: la de plantilla.<campo> (cacheada por
+        id y fecha_actualizacion) o, para textos sueltos, la cacheada por texto
+        """
+        if not template_str:
+            return ""
         try:
-            template = Template(template_str)
-            context = Context(context_data)
-            return template.render(context)
+            if plantilla is not None:
+                compilada = plantillas_compiladas.de_plantilla(plantilla, campo)
+            else:
+                compilada = plantillas_compiladas.compilar(template_str)
+            return compilada.render(contexto)
         except Exception as e:
             logger.error(f"Error procesando plantilla: {str(e)}")
             return template_str
 
+    def _renderizar_plantilla(self, plantilla: PlantillaNotificacion, titulo: str,
+                              contexto: Dict[str, Any]) -> tuple:
+        """
+        (título, mensaje, asunto) de una PlantillaNotificacion
+        """
+        titulo_final = self._renderizar(plantilla.titulo_template, contexto, plantilla, 'titulo_template')
+        mensaje_final = self._renderizar(plantilla.mensaje_template, contexto, plantilla, 'mensaje_template')
+        if plantilla.asunto_template:
+            asunto = self._renderizar(plantilla.asunto_template, contexto, plantilla, 'asunto_template')
+        else:
+            asunto = self._renderizar(titulo, contexto)
+        return titulo_final, mensaje_final, asunto
+
+    def _procesar_plantilla(self, template_str: str, usuario: Usuario,
+                            datos_adicionales: Optional[Dict[str, Any]]) -> str:
+        """
+        Procesa una plantilla con las variables del usuario y datos adicionales
+        """
+        return self._renderizar(template_str, self._contexto_plantilla(usuario, datos_adicionales))
+
     def _enviar_email(self, usuario: Usuario, asunto: str, titulo: str, mensaje: str,
                       historial: HistorialNotificacion) -> bool:
         """
         Envía notificación por email usando tu configuración actual
         """
         try:
-            # Información de la clínica
-            clinic_info = getattr(settings, 'CLINIC_INFO', {})
-
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="utf-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>{titulo}</title>
-            </head>
-            <body style="font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f5f5f5;">
-                <div style="max-width: 600px; margin: 0 auto; background-color: white; border-radius: 10px; overflow: hidden; box-shadow: 0 4px 6px rgba(0,0,0,0.1);">
-
-                    <!-- Header -->
-                    <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; text-align: center;">
-                        <h1 style="color: white; margin: 0; font-size: 24px; font-weight: normal;">{titulo}</h1>
-                    </div>
+            self._construir_email(usuario, asunto, titulo, mensaje).send()
 
-                    <!-- Content -->
-                    <div style="padding: 30px;">
-                        <p style="color: #333; line-height: 1.6; margin-bottom: 20px; font-size: 16px;">
-                            Hola <strong>{usuario.nombre}</strong>,
-                        </p>
-
-                        <div style="background-color: #f8f9fa; padding: 20px; border-radius: 8px; border-left: 4px solid #667eea; margin: 20px 0;">
-                            <p style="color: #555; line-height: 1.6; margin: 0; font-size: 15px;">{mensaje.replace(chr(10), '<br>')}</p>
-                        </div>
-
-                        <div style="margin: 30px 0; text-align: center;">
-                            <a href="{settings.FRONTEND_URL}" 
-                               style="background-color: #667eea; color: white; padding: 12px 24px; text-decoration: none; border-radius: 5px; display: inline-block; font-weight: bold;">
-                                Ver en el Sistema
-                            </a>
-                        </div>
+            logger.info(f"Email enviado exitosamente a {usuario.correoelectronico}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error enviando email a {usuario.correoelectronico}: {str(e)}")
+            historial.error_mensaje = str(e)
+            return False
+
+    def _construir_email(self, usuario: Usuario, asunto: str, titulo: str, mensaje: str) -> EmailMultiAlternatives:
+        """
+        Arma el correo (texto + HTML) de una notificación
+        """
+        # Información de la clínica
+        clinic_info = getattr(settings, 'CLINIC_INFO', {})
+
+        html_content = f"""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="utf-8">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>{titulo}</title>
+        </head>
+        <body style="font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f5f5f5;">
+            <div style="max-width: 600px; margin: 0 auto; background-color: white; border-radius: 10px; overflow: hidden; box-shadow: 0 4px 6px rgba(0,0,0,0.1);">
+
+                <!-- Header -->
+                <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; text-align: center;">
+                    <h1 style="color: white; margin: 0; font-size: 24px; font-weight: normal;">{titulo}</h1>
+                </div>
+
+                <!-- Content -->
+                <div style="padding: 30px;">
+                    <p style="color: #333; line-height: 1.6; margin-bottom: 20px; font-size: 16px;">
+                        Hola <strong>{usuario.nombre}</strong>,
+                    </p>
+
+                    <div style="background-color: #f8f9fa; padding: 20px; border-radius: 8px; border-left: 4px solid #667eea; margin: 20px 0;">
+                        <p style="color: #555; line-height: 1.6; margin: 0; font-size: 15px;">{mensaje.replace(chr(10), '<br>')}</p>
                     </div>
 
-                    <!-- Footer -->
-                    <div style="background-color: #f8f9fa; padding: 20px; text-align: center; border-top: 1px solid #e9ecef;">
-                        <p style="color: #6c757d; font-size: 14px; margin: 5px 0;">
-                            <strong>{clinic_info.get('name', 'Clínica Dental')}</strong>
-                        </p>
-                        <p style="color: #6c757d; font-size: 13px; margin: 5px 0;">
-                            📍 {clinic_info.get('address', 'Santa Cruz, Bolivia')} | 
-                            📞 {clinic_info.get('phone', '')} | 
-                            📧 {clinic_info.get('email', '')}
-                        </p>
-                        <p style="color: #adb5bd; font-size: 12px; margin: 15px 0 0 0;">
-                            Puedes cambiar tus preferencias de notificación en tu perfil.
-                        </p>
+                    <div style="margin: 30px 0; text-align: center;">
+                        <a href="{settings.FRONTEND_URL}" 
+                           style="background-color: #667eea; color: white; padding: 12px 24px; text-decoration: none; border-radius: 5px; display: inline-block; font-weight: bold;">
+                            Ver en el Sistema
+                        </a>
                     </div>
                 </div>
-            </body>
-            </html>
-            """
 
-            text_content = f"""
+                <!-- Footer -->
+                <div style="background-color: #f8f9fa; padding: 20px; text-align: center; border-top: 1px solid #e9ecef;">
+                    <p style="color: #6c757d; font-size: 14px; margin: 5px 0;">
+                        <strong>{clinic_info.get('name', 'Clínica Dental')}</strong>
+                    </p>
+                    <p style="color: #6c757d; font-size: 13px; margin: 5px 0;">
+                        📍 {clinic_info.get('address', 'Santa Cruz, Bolivia')} | 
+                        📞 {clinic_info.get('phone', '')} | 
+                        📧 {clinic_info.get('email', '')}
+                    </p>
+                    <p style="color: #adb5bd; font-size: 12px; margin: 15px 0 0 0;">
+                        Puedes cambiar tus preferencias de notificación en tu perfil.
+                    </p>
+                </div>
+            </div>
+        </body>
+        </html>
+        """
+
+        text_content = f"""
 {titulo}
 
 Hola {usuario.nombre},
@@ -337,24 +796,16 @@ Hola {usuario.nombre},
 {clinic_info.get('email', '')}
 
 Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
-            """
-
-            email = EmailMultiAlternatives(
-                subject=asunto,
-                body=text_content,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                to=[usuario.correoelectronico]
-            )
-            email.attach_alternative(html_content, "text/html")
-            email.send()
-
-            logger.info(f"Email enviado exitosamente a {usuario.correoelectronico}")
-            return True
+        """
 
-        except Exception as e:
-            logger.error(f"Error enviando email a {usuario.correoelectronico}: {str(e)}")
-            historial.error_mensaje = str(e)
-            return False
+        email = EmailMultiAlternatives(
+            subject=asunto,
+            body=text_content,
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to=[usuario.correoelectronico]
+        )
+        email.attach_alternative(html_content, "text/html")
+        return email
 
     def _enviar_push(
             self,
@@ -426,6 +877,7 @@ Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
                 data=datos_adicionales or {},
                 android_channel_id="smilestudio_default",
             )
+            desactivar_tokens(tokens_muertos(result.get("resultados")))
 
             if result.get("sent", 0) > 0 and not result.get("errors"):
                 return True
@@ -450,14 +902,24 @@ Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
         """
         Envía push notification usando OneSignal
         """
-        try:
-            # Obtener tokens de los dispositivos
-            player_ids = [d.token_fcm for d in dispositivos if d.token_fcm]
+        # Obtener tokens de los dispositivos
+        player_ids = [d.token_fcm for d in dispositivos if d.token_fcm]
 
-            if not player_ids:
-                historial.error_mensaje = "No hay tokens válidos de OneSignal"
-                return False
+        if not player_ids:
+            historial.error_mensaje = "No hay tokens válidos de OneSignal"
+            return False
+
+        exito, error = self._post_onesignal(player_ids, titulo, mensaje, datos_adicionales)
+        if not exito:
+            historial.error_mensaje = error
+        return exito
 
+    def _post_onesignal(self, player_ids: List[str], titulo: str, mensaje: str,
+                        datos_adicionales: Optional[Dict[str, Any]]) -> tuple:
+        """
+        Un request a OneSignal para hasta ONESIGNAL_LOTE player ids. Devuelve (éxito, error)
+        """
+        try:
             payload = {
                 "app_id": self.onesignal_app_id,
                 "include_player_ids": player_ids,
@@ -473,7 +935,7 @@ Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
                 "Content-Type": "application/json"
             }
 
-            response = requests.post(
+            response = self._session_push().post(
                 "https://onesignal.com/api/v1/notifications",
                 headers=headers,
                 data=json.dumps(payload),
@@ -483,17 +945,15 @@ Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
             if response.status_code == 200:
                 response_data = response.json()
                 logger.info(f"Push OneSignal enviado: {response_data.get('recipients', 0)} recipients")
-                return True
+                return True, None
             else:
                 error_msg = f"OneSignal error: {response.status_code} - {response.text}"
                 logger.error(error_msg)
-                historial.error_mensaje = error_msg
-                return False
+                return False, error_msg
 
         except Exception as e:
             logger.error(f"Error enviando push OneSignal: {str(e)}")
-            historial.error_mensaje = str(e)
-            return False
+            return False, str(e)
 
     def _enviar_push_expo(
             self,
@@ -507,49 +967,53 @@ Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
         Envía push notification usando Expo Push Service
         """
         try:
-            expo_tokens = [d.token_fcm for d in dispositivos if d.token_fcm.startswith('ExponentPushToken')]
+            expo_tokens = self._tokens_expo(dispositivos)
 
             if not expo_tokens:
                 historial.error_mensaje = "No hay tokens válidos de Expo"
                 return False
 
-            messages = []
-            for token in expo_tokens:
-                messages.append({
-                    "to": token,
-                    "title": titulo,
-                    "body": mensaje,
-                    "data": datos_adicionales or {},
-                    "sound": "default",
-                    "badge": 1
-                })
-
-            headers = {
-                "Authorization": f"Bearer {self.expo_access_token}",
-                "Content-Type": "application/json"
-            }
-
-            response = requests.post(
-                "https://exp.host/--/api/v2/push/send",
-                headers=headers,
-                data=json.dumps(messages),
-                timeout=10
-            )
-
-            if response.status_code == 200:
-                logger.info(f"Push Expo enviado a {len(messages)} dispositivos")
-                return True
-            else:
-                error_msg = f"Expo error: {response.status_code} - {response.text}"
-                logger.error(error_msg)
-                historial.error_mensaje = error_msg
-                return False
+            exito = self._entregar_expo([(historial, expo_tokens, titulo, mensaje, datos_adicionales or {})])[0]
+            if exito:
+                logger.info(f"Push Expo enviado a {len(expo_tokens)} dispositivos")
+            return exito
 
         except Exception as e:
             logger.error(f"Error enviando push Expo: {str(e)}")
             historial.error_mensaje = str(e)
             return False
 
+    def _tokens_expo(self, dispositivos) -> List[str]:
+        return list(dict.fromkeys(d.token_fcm for d in dispositivos if expo_sender.es_token_expo(d.token_fcm)))
+
+    def _entregar_expo(self, grupos) -> List[bool]:
+        """
+        grupos: [(historial, tokens, titulo, mensaje, datos)]. Todos los mensajes salen
+        juntos en lotes de 100 (ExpoSender); los tickets aceptados quedan registrados para
+        revisar_recibos_expo y los DeviceNotRegistered se dan de baja en el acto.
+        Devuelve un bool por grupo (al menos un ticket aceptado).
+        """
+        mensajes, duenos = [], []
+        for g, (_, tokens, titulo, mensaje, datos) in enumerate(grupos):
+            for token in tokens:
+                mensajes.append(expo_sender.construir_mensaje(token, titulo, mensaje, datos))
+                duenos.append(g)
+
+        resultados = expo_sender.get_expo_sender().enviar(mensajes)
+        expo_sender.guardar_tickets(resultados)
+        desactivar_tokens(tokens_muertos(resultados))
+
+        exitos = [False] * len(grupos)
+        errores = {}
+        for g, r in zip(duenos, resultados):
+            if r["ok"]:
+                exitos[g] = True
+            else:
+                errores.setdefault(g, []).append(f"{r['token'][:22]}… -> {r['codigo']}: {r['error']}")
+        for g, lista in errores.items():
+            grupos[g][0].error_mensaje = f"Expo errors: {'; '.join(lista)[:500]}"
+        return exitos
+
     def _enviar_push_supabase(
             self,
             dispositivos,
@@ -561,13 +1025,23 @@ Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
         """
         Envía push notification usando Supabase Edge Function
         """
-        try:
-            tokens = [d.token_fcm for d in dispositivos if d.token_fcm]
+        tokens = [d.token_fcm for d in dispositivos if d.token_fcm]
 
-            if not tokens:
-                historial.error_mensaje = "No hay tokens válidos"
-                return False
+        if not tokens:
+            historial.error_mensaje = "No hay tokens válidos"
+            return False
+
+        exito, error = self._post_supabase(tokens, titulo, mensaje, datos_adicionales)
+        if not exito:
+            historial.error_mensaje = error
+        return exito
 
+    def _post_supabase(self, tokens: List[str], titulo: str, mensaje: str,
+                       datos_adicionales: Optional[Dict[str, Any]]) -> tuple:
+        """
+        Un request a la Edge Function para hasta SUPABASE_PUSH_LOTE tokens. Devuelve (éxito, error)
+        """
+        try:
             payload = {
                 "tokens": tokens,
                 "title": titulo,
@@ -580,7 +1054,7 @@ Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
                 "Content-Type": "application/json"
             }
 
-            response = requests.post(
+            response = self._session_push().post(
                 self.supabase_edge_url,
                 headers=headers,
                 data=json.dumps(payload),
@@ -589,17 +1063,25 @@ Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
 
             if response.status_code == 200:
                 logger.info(f"Push Supabase enviado a {len(tokens)} dispositivos")
-                return True
+                return True, None
             else:
                 error_msg = f"Supabase Edge Function error: {response.status_code} - {response.text}"
                 logger.error(error_msg)
-                historial.error_mensaje = error_msg
-                return False
+                return False, error_msg
 
         except Exception as e:
             logger.error(f"Error enviando push Supabase: {str(e)}")
-            historial.error_mensaje = str(e)
-            return False
+            return False, str(e)
+
+    def _session_push(self) -> requests.Session:
+        """
+        Session para OneSignal / Supabase (reutiliza conexiones entre lotes). Una por hilo:
+        requests.Session no es segura entre hilos y los canales corren en el pool notif-canal
+        """
+        sesion = getattr(_sesiones_push, 'sesion', None)
+        if sesion is None:
+            sesion = _sesiones_push.sesion = requests.Session()
+        return sesion
 
     def registrar_dispositivo_movil(
             self,
@@ -620,6 +1102,8 @@ Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
                 'modelo_dispositivo': modelo_dispositivo,
                 'version_app': version_app,
                 'activo': True,
+                'motivo_baja': '',
+                'fecha_baja': None,
                 'ultima_actividad': timezone.now()
             }
         )
@@ -704,8 +1188,8 @@ Puedes cambiar tus preferencias de notificación en: {settings.FRONTEND_URL}
                 tipo_nombre, canal_nombre = mapeo_preferencias[pref_key]
 
                 try:
-                    tipo_notificacion = TipoNotificacion.objects.get(nombre=tipo_nombre)
-                    canal_notificacion = CanalNotificacion.objects.get(nombre=canal_nombre)
+                    tipo_notificacion = catalogo.requerir(TipoNotificacion, tipo_nombre)
+                    canal_notificacion = catalogo.requerir(CanalNotificacion, canal_nombre)
 
                     pref, created = PreferenciaNotificacion.objects.update_or_create(
                         usuario=usuario,
@@ -0,0 +1,89 @@
+# api/tenant_cache.py
+"""
+Caché en proceso (por worker) de la resolución subdominio -> Empresa.
+
+TenantMiddleware resuelve el tenant en cada request; como las empresas casi
+nunca cambian, guardamos el resultado en memoria con un TTL:
+  - Acierto: la Empresa activa encontrada (TENANT_CACHE_TTL segundos).
+  - Negativo: subdominio desconocido o inactivo (TENANT_CACHE_NEGATIVE_TTL).
+
+Invalidación: post_save / post_delete de Empresa vacían la caché de todos los
+workers (version stamp de api.cache_local, revisado como mucho cada
+TENANT_CACHE_VERSION_CHECK segundos).
+"""
+import copy
+import logging
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .cache_local import CacheLocal
+from .models import Empresa
+
+logger = logging.getLogger(__name__)
+
+TENANT_CACHE_TTL = getattr(settings, 'TENANT_CACHE_TTL', 300)
+TENANT_CACHE_NEGATIVE_TTL = getattr(settings, 'TENANT_CACHE_NEGATIVE_TTL', 30)
+TENANT_CACHE_VERSION_CHECK = getattr(settings, 'TENANT_CACHE_VERSION_CHECK', 5)
+TENANT_CACHE_MAX_ENTRIES = getattr(settings, 'TENANT_CACHE_MAX_ENTRIES', 1024)
+
+_cache = CacheLocal('tenant_cache:version', TENANT_CACHE_VERSION_CHECK, 'TenantCache')
+_entries = _cache.entradas  # subdomain -> (Empresa | None, expira_en)
+
+
+def _store(subdomain, empresa, now):
+    ttl = TENANT_CACHE_TTL if empresa is not None else TENANT_CACHE_NEGATIVE_TTL
+    with _cache.lock:
+        if len(_entries) >= TENANT_CACHE_MAX_ENTRIES:
+            # Primero liberar expiradas; si sigue lleno (p. ej. Host aleatorios), empezar de cero
+            for key in [k for k, (_, exp) in _entries.items() if exp <= now]:
+                del _entries[key]
+            if len(_entries) >= TENANT_CACHE_MAX_ENTRIES:
+                _entries.clear()
+        _entries[subdomain] = (empresa, now + ttl)
+
+
+def _fetch_empresa(subdomain):
+    empresas = list(
+        Empresa.objects.filter(subdomain__iexact=subdomain, activo=True).order_by('id')[:2]
+    )
+    if not empresas:
+        logger.warning(f"[TenantCache] Subdominio '{subdomain}' no encontrado o inactivo")
+        return None
+    if len(empresas) > 1:
+        logger.error(f"[TenantCache] Múltiples empresas con subdomain '{subdomain}' - ERROR DE CONFIGURACIÓN")
+    return empresas[0]
+
+
+def get_empresa_por_subdomain(subdomain):
+    """
+    Devuelve la Empresa activa para el subdominio (o None), usando la caché del worker.
+    Cada llamada recibe su propia copia para que ninguna vista modifique la compartida.
+    """
+    if not subdomain:
+        return None
+    subdomain = subdomain.strip().lower()
+    now = time.monotonic()
+    _cache.sincronizar(now)
+
+    entry = _entries.get(subdomain)
+    if entry is not None and entry[1] > now:
+        empresa = entry[0]
+    else:
+        empresa = _fetch_empresa(subdomain)
+        _store(subdomain, empresa, now)
+
+    return copy.copy(empresa) if empresa is not None else None
+
+
+def invalidate_tenant_cache():
+    """Vacía la caché local y avisa al resto de workers."""
+    _cache.invalidar()
+
+
+@receiver(post_save, sender=Empresa, dispatch_uid='tenant_cache_empresa_saved')
+@receiver(post_delete, sender=Empresa, dispatch_uid='tenant_cache_empresa_deleted')
+def _empresa_changed(sender, instance, **kwargs):
+    invalidate_tenant_cache()
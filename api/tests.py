@@ -1,9 +1,11 @@
 from django.contrib.auth import get_user_model
-from django.test import TestCase, TransactionTestCase
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
 from rest_framework.test import APITestCase
 from rest_framework import status
 from django.db import transaction
-from .models import Paciente, Tipodeusuario
+from .models import Empresa, Paciente, Tipodeusuario
 
 User = get_user_model()
 
@@ -87,4 +89,1201 @@ class AuthTests(APITestCase):
 
         # Verificamos que la respuesta sea un conflicto (HTTP 409 CONFLICT)
         self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
-        self.assertEqual(response.data['detail'], 'Ya existe un usuario con este email')
\ No newline at end of file
+        self.assertEqual(response.data['detail'], 'Ya existe un usuario con este email')
+
+class TenantCacheTests(SimpleTestCase):
+    """Caché por worker de subdominio -> Empresa (sin BD: se parchea la consulta)."""
+
+    def setUp(self):
+        from . import tenant_cache
+        self.tenant_cache = tenant_cache
+        tenant_cache.invalidate_tenant_cache()
+
+    def test_acierto_y_negativo_se_cachean(self):
+        empresa = Empresa(id=7, nombre='Norte', subdomain='norte')
+        with patch.object(self.tenant_cache, '_fetch_empresa',
+                          side_effect=lambda s: empresa if s == 'norte' else None) as fetch:
+            self.assertEqual(self.tenant_cache.get_empresa_por_subdomain('Norte').id, 7)
+            self.assertEqual(self.tenant_cache.get_empresa_por_subdomain('norte').id, 7)
+            self.assertIsNone(self.tenant_cache.get_empresa_por_subdomain('desconocido'))
+            self.assertIsNone(self.tenant_cache.get_empresa_por_subdomain('desconocido'))
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_invalidacion_vacia_la_cache(self):
+        empresa = Empresa(id=7, nombre='Norte', subdomain='norte')
+        with patch.object(self.tenant_cache, '_fetch_empresa', return_value=empresa) as fetch:
+            self.tenant_cache.get_empresa_por_subdomain('norte')
+            self.tenant_cache.invalidate_tenant_cache()
+            self.tenant_cache.get_empresa_por_subdomain('norte')
+        self.assertEqual(fetch.call_count, 2)
+
+
+class CacheLocalTests(SimpleTestCase):
+    def test_otro_worker_invalida_via_version_compartida(self):
+        from django.core.cache import cache
+        from .cache_local import CacheLocal
+
+        local, otro = CacheLocal('test:cache_local', 5, 'Test'), CacheLocal('test:cache_local', 5, 'Test')
+        self.addCleanup(cache.delete, 'test:cache_local')
+        local.sincronizar(100.0)
+        local.entradas['a'] = 1
+        otro.invalidar()
+        local.sincronizar(102.0)  # antes del intervalo: no consulta la versión
+        self.assertEqual(local.entradas, {'a': 1})
+        local.sincronizar(106.0)
+        self.assertEqual(local.entradas, {})
+
+    def test_detecta_cache_por_proceso(self):
+        from django.test import override_settings
+        from .cache_local import cache_default_compartida
+
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertFalse(cache_default_compartida())
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                                   'LOCATION': '/tmp/cache-test'}}):
+            self.assertTrue(cache_default_compartida())
+
+
+class RequestIdentityTests(SimpleTestCase):
+    """La identidad del request se resuelve una sola vez y se comparte entre capas."""
+
+    def test_identidad_memoizada_por_request(self):
+        from django.test import RequestFactory
+        from . import identity
+
+        request = RequestFactory().get('/api/consultas/')
+        request.user = type('U', (), {'is_authenticated': True, 'pk': 3, 'email': 'a@b.com'})()
+        usuario = type('Usuario', (), {'empresa_id': 5, 'idtipousuario': None})()
+        with patch.object(identity, '_fetch_usuario', return_value=usuario) as fetch:
+            self.assertIs(identity.get_identity(request), identity.get_identity(request))
+            self.assertEqual(identity.get_identity(request).empresa_id, 5)
+            self.assertIs(identity.get_identity(request).usuario, usuario)
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_sin_credenciales_es_anonimo(self):
+        from django.test import RequestFactory
+        from django.contrib.auth.models import AnonymousUser
+        from .identity import get_identity
+
+        request = RequestFactory().get('/api/consultas/')
+        request.user = AnonymousUser()
+        self.assertFalse(get_identity(request).is_authenticated)
+        self.assertIsNone(get_identity(request).empresa_id)
+
+    def test_token_de_usuario_inactivo_no_autentica_ni_se_cachea(self):
+        from types import SimpleNamespace
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        from . import identity
+
+        request = RequestFactory().get('/api/consultas/', HTTP_AUTHORIZATION='Token abc')
+        request.user = AnonymousUser()
+        token = SimpleNamespace(user_id=3, user=SimpleNamespace(is_active=False, email='a@b.com', username='a'))
+        with patch.object(identity.Token.objects, 'select_related') as tokens, \
+                patch.object(identity, 'cache') as cache, \
+                patch.object(identity, '_fetch_usuario') as fetch:
+            cache.get.return_value = None
+            tokens.return_value.get.return_value = token
+            self.assertFalse(identity.get_identity(request).is_authenticated)
+        cache.set.assert_not_called()
+        fetch.assert_not_called()
+
+    def test_invalidacion_busca_tokens_por_username_y_email(self):
+        from .models import Usuario
+        from . import identity
+
+        with patch.object(identity.Token.objects, 'filter') as tokens, \
+                patch.object(identity, 'invalidate_token_identity') as invalidar:
+            tokens.return_value.values_list.return_value = ['k1']
+            identity._usuario_changed(Usuario, Usuario(correoelectronico='Ana@Clinica.com'))
+            identity._user_changed(User, User(pk=9, username='ana'))
+        filtro_usuario, filtro_user = [c.args[0] for c in tokens.call_args_list]
+        self.assertEqual(sorted(k for k, _ in filtro_usuario.children),
+                         ['user__email__iexact', 'user__username__iexact'])
+        self.assertEqual(filtro_user.children, [('user_id', 9)])
+        self.assertEqual(invalidar.call_count, 2)
+
+
+class AuditSinkTests(SimpleTestCase):
+    """Si la BD falla el lote va al spool y se reinserta en el siguiente vuelco."""
+
+    def test_spool_y_reinsercion(self):
+        import os
+        import tempfile
+        from . import audit_sink
+
+        spool = os.path.join(tempfile.mkdtemp(), 'audit_spool.jsonl')
+        fila = audit_sink._fila('crear_cita', usuario=4, empresa=2, ip_address='10.0.0.1')
+        with patch.object(audit_sink, 'AUDIT_SPOOL_PATH', spool), \
+                patch.object(audit_sink, 'close_old_connections'):
+            with patch.object(audit_sink, '_insertar', side_effect=Exception('BD caída')):
+                audit_sink._flush([fila])
+            self.assertTrue(os.path.exists(spool))
+
+            with patch.object(audit_sink, '_insertar') as insertar:
+                audit_sink._flush([audit_sink._fila('login')])
+            self.assertEqual(insertar.call_count, 2)
+            replay_args, replay_kwargs = insertar.call_args
+            self.assertEqual(replay_args[0][0]['usuario_id'], 4)
+            self.assertTrue(replay_kwargs['preservar_fecha'])
+            self.assertFalse(os.path.exists(spool))
+
+    def test_retoma_replay_huerfano_y_salta_lineas_corruptas(self):
+        import json
+        import os
+        import tempfile
+        from . import audit_sink
+
+        spool = os.path.join(tempfile.mkdtemp(), 'audit_spool.jsonl')
+        fila = audit_sink._fila('crear_cita', usuario=4)
+        with open(f"{spool}.999999.replay", 'w', encoding='utf-8') as f:
+            f.write(json.dumps(fila, default=str) + '\n{"accion": "cortad\n')
+        with open(f"{spool}.1.replay", 'w', encoding='utf-8') as f:  # pid vivo: no se toca
+            f.write(json.dumps(fila, default=str) + '\n')
+
+        with patch.object(audit_sink, 'AUDIT_SPOOL_PATH', spool), \
+                patch.object(audit_sink, '_proceso_vivo', side_effect=lambda pid: pid == 1), \
+                patch.object(audit_sink, '_insertar') as insertar:
+            audit_sink._replay_spool()
+
+        insertar.assert_called_once()
+        self.assertEqual([f['usuario_id'] for f in insertar.call_args.args[0]], [4])
+        self.assertEqual(sorted(os.listdir(os.path.dirname(spool))), ['audit_spool.jsonl.1.replay'])
+
+
+class BitacoraParticionesTests(SimpleTestCase):
+    def test_rangos_mensuales(self):
+        from .bitacora_partitions import nombre_particion, rango_mes, sumar_meses
+
+        self.assertEqual(sumar_meses(2025, 11, 3), (2026, 2))
+        self.assertEqual(sumar_meses(2025, 1, -1), (2024, 12))
+        inicio, fin = rango_mes(2025, 12)
+        self.assertEqual((inicio.month, fin.year, fin.month), (12, 2026, 1))
+        self.assertEqual(nombre_particion(2025, 3), 'bitacora_y2025m03')
+
+
+class BitacoraExportTests(SimpleTestCase):
+    def test_csv_en_streaming_comprimido(self):
+        import gzip
+        from datetime import datetime, timezone as dt_timezone
+        from unittest.mock import MagicMock
+        from .bitacora_export import gzip_stream, stream_csv
+        from .models import Bitacora
+
+        filas = [
+            Bitacora(id=i, accion='login', ip_address='10.0.0.1', user_agent='ua',
+                     valores_nuevos={'descripcion': f'evento {i}'},
+                     timestamp=datetime(2025, 1, 1, 12, tzinfo=dt_timezone.utc))
+            for i in range(1200)
+        ]
+        queryset = MagicMock()
+        queryset.select_related.return_value.iterator.return_value = iter(filas)
+
+        contenido = gzip.decompress(b''.join(gzip_stream(stream_csv(queryset)))).decode('utf-8')
+        lineas = contenido.splitlines()
+        self.assertEqual(len(lineas), 1201)  # encabezado + todas las filas, sin tope
+        self.assertIn('evento 1199', lineas[-1])
+
+
+class BitacoraResumenTests(SimpleTestCase):
+    def test_acumular_agrupa_por_hora_y_hace_upsert(self):
+        from datetime import datetime, timezone as dt_timezone
+        from unittest.mock import MagicMock
+        from . import bitacora_resumen
+
+        utc = dt_timezone.utc
+        registros = [
+            (1, 7, 'login', datetime(2025, 1, 1, 10, 5, tzinfo=utc)),
+            (1, 7, 'login', datetime(2025, 1, 1, 10, 55, tzinfo=utc)),
+            (None, None, 'login', datetime(2025, 1, 1, 11, 0, tzinfo=utc)),
+            (1, 7, 'login', None),
+        ]
+        conexion = MagicMock(vendor='postgresql')
+        with patch.object(bitacora_resumen, 'connection', conexion):
+            bitacora_resumen.acumular(registros)
+        filas = conexion.cursor.return_value.__enter__.return_value.executemany.call_args.args[1]
+        self.assertEqual(sorted(filas), [
+            (0, datetime(2025, 1, 1, 11, tzinfo=utc), 'login', 0, 1),
+            (1, datetime(2025, 1, 1, 10, tzinfo=utc), 'login', 7, 2),
+        ])
+
+        # Sin PostgreSQL: UPDATE y, si no había fila, INSERT
+        with patch.object(bitacora_resumen, 'connection', MagicMock(vendor='sqlite')), \
+                patch.object(bitacora_resumen, 'BitacoraResumen') as modelo:
+            modelo.objects.filter.return_value.update.side_effect = [1, 0]
+            bitacora_resumen.acumular(registros)
+        modelo.objects.create.assert_called_once()
+        self.assertEqual(modelo.objects.create.call_args.kwargs['total'], 1)
+
+    def test_recalcular_dia_reemplaza_el_dia_completo(self):
+        from datetime import date, datetime, timezone as dt_timezone
+        from . import bitacora_resumen
+
+        utc = dt_timezone.utc
+        conteos = [
+            {'empresa_id': 1, 'hora': datetime(2025, 1, 1, 9, tzinfo=utc), 'accion': 'login', 'usuario_id': 7, 'total': 3},
+            {'empresa_id': None, 'hora': datetime(2025, 1, 1, 9, tzinfo=utc), 'accion': 'login', 'usuario_id': None, 'total': 1},
+        ]
+        with patch.object(bitacora_resumen, 'Bitacora') as bitacora, \
+                patch.object(bitacora_resumen.BitacoraResumen, 'objects') as resumen, \
+                patch.object(bitacora_resumen.transaction, 'atomic'):
+            bitacora.objects.filter.return_value.annotate.return_value.values.return_value \
+                .annotate.return_value = conteos
+            self.assertEqual(bitacora_resumen.recalcular_dia(date(2025, 1, 1)), 2)
+
+        rango = {'timestamp__gte': datetime(2025, 1, 1, tzinfo=utc), 'timestamp__lt': datetime(2025, 1, 2, tzinfo=utc)}
+        bitacora.objects.filter.assert_called_once_with(**rango)
+        resumen.filter.assert_called_once_with(hora__gte=rango['timestamp__gte'], hora__lt=rango['timestamp__lt'])
+        resumen.filter.return_value.delete.assert_called_once()
+        nuevos = resumen.bulk_create.call_args.args[0]
+        self.assertEqual([(n.empresa_id, n.usuario_id, n.total) for n in nuevos], [(1, 7, 3), (0, 0, 1)])
+
+    def test_estadisticas_lee_solo_el_resumen(self):
+        from datetime import date, datetime, timezone as dt_timezone
+        from . import bitacora_resumen
+        from .models import Usuario
+
+        with patch.object(bitacora_resumen.BitacoraResumen, 'objects') as resumen, \
+                patch.object(bitacora_resumen.Usuario, 'objects') as usuarios:
+            qs = resumen.filter.return_value.filter.return_value
+            qs.values.return_value.annotate.return_value.order_by.return_value = [
+                {'accion': 'login', 'n': 5}, {'accion': 'crear', 'n': 2},
+            ]
+            qs.exclude.return_value.values.return_value.annotate.return_value.order_by.return_value \
+                .__getitem__.return_value = [{'usuario_id': 7, 'n': 4}, {'usuario_id': 8, 'n': 3}]
+            usuarios.filter.return_value.only.return_value = [Usuario(codigo=7, nombre='Ana', apellido='Paz')]
+            qs.annotate.return_value.values.return_value.annotate.return_value.order_by.return_value = [
+                {'periodo': date(2025, 1, 1), 'n': 7},
+            ]
+            desde, hasta = datetime(2025, 1, 1, tzinfo=dt_timezone.utc), datetime(2025, 1, 2, tzinfo=dt_timezone.utc)
+            datos = bitacora_resumen.estadisticas(3, desde, hasta)
+
+        resumen.filter.assert_called_once_with(hora__gte=desde, hora__lt=hasta)
+        resumen.filter.return_value.filter.assert_called_once_with(empresa_id=3)
+        self.assertEqual(datos, {
+            'total_registros': 7,
+            'acciones': {'login': 5, 'crear': 2},
+            'usuarios_activos': {'Ana Paz': 4, 'Usuario #8': 3},
+            'serie': [{'periodo': '2025-01-01', 'total': 7}],
+        })
+
+    def test_endpoint_valida_fechas_y_arma_la_serie_diaria(self):
+        from datetime import date, timedelta
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from . import views
+
+        vista = views.BitacoraViewSet.as_view({'get': 'estadisticas'})
+
+        def pedir(**params):
+            request = APIRequestFactory().get('/api/bitacora/estadisticas/', params)
+            force_authenticate(request, user=User(username='admin'))
+            return vista(request)
+
+        datos = {'total_registros': 3, 'acciones': {'login': 3}, 'usuarios_activos': {},
+                 'serie': [{'periodo': '2025-03-10', 'total': 3}]}
+        with patch.object(views, '_es_admin_por_tabla', return_value=True), \
+                patch.object(views, 'estadisticas_bitacora', return_value=datos) as estadisticas:
+            for params in ({'fecha_desde': '2025-13-01'}, {'fecha_hasta': '10/03/2025'},
+                           {'fecha_desde': '2025-03-10', 'fecha_hasta': '2025-03-01'},
+                           {'granularidad': 'mes'}):
+                self.assertEqual(pedir(**params).status_code, status.HTTP_400_BAD_REQUEST, params)
+            estadisticas.assert_not_called()
+
+            respuesta = pedir(fecha_desde='2025-03-01', fecha_hasta='2025-03-10')
+            self.assertEqual(respuesta.status_code, status.HTTP_200_OK)
+            self.assertEqual(respuesta.data['actividad_diaria']['10/03'], 3)
+            self.assertEqual(respuesta.data['actividad_diaria']['04/03'], 0)
+            kwargs = estadisticas.call_args.kwargs
+            self.assertIsNone(kwargs['empresa_id'])
+            self.assertEqual((kwargs['hasta'] - kwargs['desde']).days, 10)
+
+            # Sin fechas: últimos 30 días hasta hoy
+            respuesta = pedir()
+            self.assertEqual(respuesta.data['fecha_hasta'], views.timezone.localdate().isoformat())
+            self.assertEqual(date.fromisoformat(respuesta.data['fecha_desde']),
+                             views.timezone.localdate() - timedelta(days=29))
+
+
+class ReporteBitacoraPDFTests(SimpleTestCase):
+    def test_pdf_multipagina_sin_tope(self):
+        import os
+        import tempfile
+        from datetime import datetime, timezone as dt_timezone
+        from unittest.mock import MagicMock
+        from .bitacora_reportes import renderizar_pdf
+        from .models import Bitacora
+
+        filas = [
+            Bitacora(id=i, accion='crear_cita', ip_address='10.0.0.1', user_agent='ua',
+                     valores_nuevos={'descripcion': 'x' * 300},
+                     timestamp=datetime(2025, 1, 1, 12, tzinfo=dt_timezone.utc))
+            for i in range(500)
+        ]
+        queryset = MagicMock()
+        queryset.select_related.return_value.iterator.return_value = iter(filas)
+
+        destino = os.path.join(tempfile.mkdtemp(), 'reporte.pdf')
+        total, paginas = renderizar_pdf(queryset, destino)
+        self.assertEqual(total, 500)
+        self.assertGreater(paginas, 5)
+        with open(destino, 'rb') as f:
+            self.assertEqual(f.read(4), b'%PDF')
+
+
+class ReporteBitacoraReclamoTests(SimpleTestCase):
+    """Un reporte reclamado de nuevo (sin latido) no deja que el render viejo publique ni pise el estado."""
+
+    def _procesar(self, actualizados):
+        import tempfile
+        import uuid
+        from datetime import datetime, timezone as dt_timezone
+        from unittest.mock import MagicMock
+        from . import bitacora_reportes
+        from .models import ReporteBitacora
+
+        directorio = tempfile.mkdtemp()
+        reporte = ReporteBitacora(id=uuid.uuid4(), filtros={})
+        filas = MagicMock()
+        filas.order_by.return_value.select_related.return_value.iterator.return_value = iter([])
+        with patch.object(bitacora_reportes, 'REPORTES_BITACORA_DIR', directorio), \
+                patch.object(bitacora_reportes, '_usa_s3', return_value=False), \
+                patch.object(bitacora_reportes, 'aplicar_filtros', return_value=filas), \
+                patch.object(bitacora_reportes, 'Bitacora'), \
+                patch.object(ReporteBitacora, 'objects') as objetos:
+            objetos.get.return_value = reporte
+            objetos.filter.return_value.update.side_effect = actualizados
+            inicio = datetime(2025, 1, 1, 12, tzinfo=dt_timezone.utc)
+            estado = bitacora_reportes.procesar_reporte(reporte.id, 'host:1', inicio)
+        return estado, directorio, reporte, objetos
+
+    def test_publica_y_completa_con_el_reclamo_vigente(self):
+        import os
+        from datetime import datetime, timezone as dt_timezone
+
+        estado, directorio, reporte, objetos = self._procesar([1, 1])
+        self.assertEqual(estado, 'COMPLETADO')
+        self.assertEqual(os.listdir(directorio), [f'{reporte.id}.pdf'])
+        primer_filtro = objetos.filter.call_args_list[0].kwargs
+        self.assertEqual((primer_filtro['procesado_por'], primer_filtro['fecha_inicio']),
+                         ('host:1', datetime(2025, 1, 1, 12, tzinfo=dt_timezone.utc)))
+        self.assertEqual(objetos.filter.return_value.update.call_args.kwargs['estado'], 'COMPLETADO')
+
+    def test_reclamo_perdido_no_publica_ni_cambia_el_estado(self):
+        import os
+
+        # El latido forzado antes de publicar ya no encuentra el reclamo (otro worker lo tomó)
+        estado, directorio, _, objetos = self._procesar([0])
+        self.assertEqual(estado, 'ABANDONADO')
+        self.assertEqual(os.listdir(directorio), [])  # ni {id}.pdf ni el temporal
+        self.assertNotIn('estado', objetos.filter.return_value.update.call_args.kwargs)
+
+
+class AvailabilityBitmapTests(SimpleTestCase):
+    def test_con_cache_por_proceso_usa_el_ttl_corto(self):
+        from django.conf import settings
+        from . import availability
+
+        # Los tests corren con LocMemCache: los refrescos on_commit no llegarían a otros workers
+        self.assertEqual(availability.AVAILABILITY_CACHE_TTL, settings.AVAILABILITY_CACHE_TTL_LOCAL)
+
+    def test_bitmap_y_firma_del_catalogo(self):
+        from datetime import date
+        from django.core.cache import cache
+        from . import availability
+
+        cache.clear()
+        slots = [(10, '08:00:00'), (11, '09:00:00'), (12, '10:00:00')]
+        self.assertEqual(availability.mascara_desde_ids(slots, [12, 10, 99]), 0b101)
+
+        with patch.object(availability, 'slots_empresa', return_value=slots), \
+                patch.object(availability, 'recalcular_ocupacion', return_value=0b010) as recalcular:
+            libres = availability.horarios_disponibles(1, 5, date(2025, 3, 3))
+        self.assertEqual([h['id'] for h in libres], [10, 12])
+        self.assertEqual(recalcular.call_count, 1)
+
+        # Bitmap guardado con otro catálogo: se descarta y se recalcula
+        availability.guardar_ocupaciones(1, slots[:2], {(5, date(2025, 3, 3)): 0})
+        with patch.object(availability, 'recalcular_ocupacion', return_value=0) as recalcular:
+            availability.ocupacion(1, 5, date(2025, 3, 3), slots)
+        self.assertEqual(recalcular.call_count, 1)
+
+        availability.guardar_ocupaciones(1, slots, {(5, date(2025, 3, 3)): 0b001})
+        self.assertEqual(availability.ocupacion(1, 5, date(2025, 3, 3), slots), 0b001)
+
+    def test_proximos_libres_recorre_por_bloques(self):
+        from datetime import date, datetime
+        from . import availability
+
+        slots = [(10, '08:00:00'), (11, '09:00:00')]
+        dia1, dia2 = date(2025, 3, 3), date(2025, 3, 4)
+
+        def matriz(empresa_id, ids, desde, hasta):
+            # Odontólogo 5 lleno el primer día; 6 con las 08:00 ocupadas
+            ocupado = {(5, dia1): 0b11, (6, dia1): 0b01, (5, dia2): 0, (6, dia2): 0}
+            fechas = [f for f in (dia1, dia2) if desde <= f <= hasta]
+            return slots, fechas, {(o, f): ocupado[(o, f)] for o in ids for f in fechas}
+
+        with patch.object(availability, 'slots_empresa', return_value=slots), \
+                patch.object(availability, 'matriz_disponibilidad', side_effect=matriz) as m:
+            _, libres = availability.proximos_libres(1, [5, 6], dia1, 3, dias_max=2, bloque_dias=1)
+        self.assertEqual(libres, [(dia1, 11, 6), (dia2, 10, 5), (dia2, 10, 6)])
+        self.assertEqual(m.call_count, 2)
+
+        # Hoy a las 08:30 el slot de las 08:00 ya pasó
+        with patch.object(availability, 'slots_empresa', return_value=slots), \
+                patch.object(availability, 'matriz_disponibilidad', side_effect=matriz):
+            _, libres = availability.proximos_libres(
+                1, [5, 6], dia2, 1, dias_max=1, ahora=datetime(2025, 3, 4, 8, 30)
+            )
+        self.assertEqual(libres, [(dia2, 11, 5)])
+
+
+class ReservaSlotTests(SimpleTestCase):
+    def test_clave_bloqueo_distingue_odontologo_y_dia(self):
+        from datetime import date
+        from .reservas import clave_bloqueo
+
+        claves = {
+            clave_bloqueo(od, f)
+            for od in (1, 2, 3000)
+            for f in (date(2025, 3, 3), date(2025, 3, 4))
+        }
+        self.assertEqual(len(claves), 6)
+        self.assertTrue(all(0 < c < 2 ** 63 for c in claves))
+
+    def test_conflicto_de_indice_se_traduce_a_409(self):
+        from datetime import date
+        from django.db import IntegrityError
+        from . import reservas
+
+        def guardar():
+            raise IntegrityError('duplicate key value violates unique constraint "uniq_consulta_slot"')
+
+        alternativas = [{'fecha': '2025-03-04', 'idhorario': 10, 'hora': '08:00:00'}]
+        with patch.object(reservas.transaction, 'atomic'), \
+                patch.object(reservas, 'alternativas', return_value=alternativas):
+            with self.assertRaises(reservas.HorarioNoDisponible) as ctx:
+                reservas.guardar_reserva(guardar, 1, 5, date(2025, 3, 3))
+        self.assertEqual(ctx.exception.status_code, 409)
+        self.assertEqual(ctx.exception.detail['alternativas'][0]['idhorario'], 10)
+
+        # Otras violaciones de integridad no se disfrazan de conflicto de horario
+        def guardar_otro():
+            raise IntegrityError('null value in column "codpaciente"')
+
+        with patch.object(reservas.transaction, 'atomic'):
+            with self.assertRaises(IntegrityError):
+                reservas.guardar_reserva(guardar_otro, 1, 5, date(2025, 3, 3))
+
+
+class EmailOutboxTests(SimpleTestCase):
+    def test_backoff_exponencial_con_tope(self):
+        from .email_outbox import EMAIL_OUTBOX_BACKOFF_MAX, espera_reintento
+
+        self.assertEqual([espera_reintento(i) for i in (1, 2, 3)], [30, 60, 120])
+        self.assertEqual(espera_reintento(30), EMAIL_OUTBOX_BACKOFF_MAX)
+
+    def test_lote_usa_una_conexion_y_reintenta_fallidos(self):
+        from types import SimpleNamespace
+        from unittest.mock import MagicMock
+        from . import email_outbox
+
+        correos = [
+            SimpleNamespace(id=i, asunto='Cita', cuerpo='Hola', cuerpo_html='', remitente='a@b.c',
+                            destinatarios=[f'p{i}@x.com'], intentos=0)
+            for i in (1, 2, 3)
+        ]
+        conexion = MagicMock()
+        enviados = []
+
+        def enviar(mensajes):
+            if mensajes[0].to == ['p2@x.com']:
+                raise Exception('550 rechazado')
+            enviados.extend(mensajes)
+            return len(mensajes)
+
+        conexion.send_messages.side_effect = enviar
+        with patch.object(email_outbox, 'CorreoSaliente') as modelo, \
+                patch.object(email_outbox, '_marcar_fallo') as fallo:
+            resultado = email_outbox.enviar_lote(correos, conexion)
+
+        self.assertEqual(resultado, (2, 1))
+        self.assertEqual(conexion.open.call_count, 1)
+        self.assertEqual(len(enviados), 2)
+        self.assertEqual(fallo.call_args[0][0].id, 2)
+        modelo.objects.filter.assert_called_with(id__in=[1, 3])
+
+
+class FCMTokenProviderTests(SimpleTestCase):
+    def test_token_cacheado_y_renovacion_single_flight(self):
+        import threading
+        import time
+        from unittest.mock import MagicMock
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from api.notifications_mobile.fcm_auth import GoogleTokenProvider
+
+        pem = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ).decode()
+        sa = {'client_email': 'sa@x.iam', 'private_key': pem, 'private_key_id': 'k1'}
+        llamadas = []
+
+        def post(url, data, timeout):
+            llamadas.append(data['assertion'])
+            time.sleep(0.05)  # los demás hilos llegan mientras se renueva
+            return MagicMock(json=lambda: {'access_token': f'tok{len(llamadas)}', 'expires_in': 3600})
+
+        provider = GoogleTokenProvider(sa_loader=lambda: sa, session=MagicMock(post=post))
+        hilos = [threading.Thread(target=provider.token) for _ in range(8)]
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        self.assertEqual(len(llamadas), 1)
+        self.assertEqual(provider.token(), 'tok1')
+
+        # Invalidar un token viejo no descarta el vigente; invalidar el vigente sí
+        provider.invalidar('otro')
+        self.assertEqual(provider.token(), 'tok1')
+        provider.invalidar('tok1')
+        self.assertEqual(provider.token(), 'tok2')
+        self.assertEqual(len(llamadas), 2)
+
+
+class FCMSenderTests(SimpleTestCase):
+    """El motor contra un servidor FCM falso en 127.0.0.1."""
+
+    def setUp(self):
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.vistos = []
+        vistos = self.vistos
+
+        class FakeFCM(BaseHTTPRequestHandler):
+            def do_POST(self):
+                mensaje = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['message']
+                token = mensaje['token']
+                vistos.append(token)
+                if token == 'lento' and vistos.count('lento') == 1:
+                    self._responder(429, {'error': {'status': 'RESOURCE_EXHAUSTED'}}, {'Retry-After': '0'})
+                elif token == 'perdido':
+                    # 404 sin detalle de FCM (proyecto o URL mal configurados, proxy)
+                    self._responder(404, {'error': {'status': 'NOT_FOUND'}})
+                elif token == 'muerto':
+                    self._responder(404, {'error': {'status': 'NOT_FOUND', 'details': [
+                        {'@type': 'type.googleapis.com/google.firebase.fcm.v1.FcmError', 'errorCode': 'UNREGISTERED'}
+                    ]}})
+                else:
+                    self._responder(200, {'name': f'projects/p/messages/{token}'})
+
+            def _responder(self, status, cuerpo, headers=None):
+                datos = json.dumps(cuerpo).encode()
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(datos)))
+                self.end_headers()
+                self.wfile.write(datos)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeFCM)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_resultados_por_token_y_reintento_tras_429(self):
+        from unittest.mock import MagicMock
+        from api.notifications_mobile.fcm_sender import FCMSender
+
+        sender = FCMSender(
+            project_id='p', base_url=f'http://127.0.0.1:{self.server.server_port}',
+            concurrencia=4, token_provider=MagicMock(token=lambda: 'x'),
+        )
+        tokens = ['a', 'lento', 'muerto', 'b', 'c', 'perdido']
+        resultados = sender.enviar(tokens, 'Hola', 'Mundo', {'consulta_id': 1})
+
+        self.assertEqual([r['token'] for r in resultados], tokens)
+        self.assertEqual([r['ok'] for r in resultados], [True, True, False, True, True, False])
+        self.assertEqual(resultados[2]['codigo'], 'UNREGISTERED')
+        self.assertEqual([r['muerto'] for r in resultados], [False, False, True, False, False, False])
+        self.assertEqual(self.vistos.count('lento'), 2)
+        self.assertEqual(self.vistos.count('muerto'), 1)  # error permanente: sin reintento
+
+
+class FCMTokenPruningTests(SimpleTestCase):
+    def test_clasificacion_y_baja_por_motivo(self):
+        from api.notifications_mobile import token_pruning
+        from api.notifications_mobile.fcm_sender import es_token_muerto
+
+        self.assertTrue(es_token_muerto('UNREGISTERED', ''))
+        self.assertTrue(es_token_muerto(
+            'INVALID_ARGUMENT', 'The registration token is not a valid FCM registration token'))
+        # Un 404 "pelado" (sin errorCode) no prueba nada sobre el token
+        self.assertFalse(es_token_muerto('NOT_FOUND', '{"error": {"status": "NOT_FOUND"}}'))
+        self.assertFalse(es_token_muerto('HTTP_404', '<html>Not Found</html>'))
+        self.assertFalse(es_token_muerto('SENDER_ID_MISMATCH', ''))
+        self.assertFalse(es_token_muerto('INVALID_ARGUMENT', 'Invalid JSON payload received'))
+        self.assertFalse(es_token_muerto('UNAVAILABLE', ''))
+
+        resultados = [
+            {'token': 'a', 'ok': True, 'muerto': False},
+            {'token': 'b', 'ok': False, 'codigo': 'UNREGISTERED', 'muerto': True},
+            {'token': 'c', 'ok': False, 'codigo': 'NOT_FOUND', 'muerto': False},
+            {'token': 'd', 'ok': False, 'codigo': 'UNREGISTERED', 'muerto': True},
+            {'token': 'e', 'ok': False, 'codigo': 'DeviceNotRegistered', 'muerto': True},
+        ]
+        muertos = token_pruning.tokens_muertos(resultados)
+        self.assertEqual(muertos, {'b': 'UNREGISTERED', 'd': 'UNREGISTERED', 'e': 'DeviceNotRegistered'})
+
+        with patch.object(token_pruning, 'DispositivoMovil') as modelo:
+            modelo.objects.filter.return_value.update.return_value = 1
+            token_pruning.desactivar_tokens(muertos)
+        filtros = sorted(sorted(c.kwargs['token_fcm__in']) for c in modelo.objects.filter.call_args_list)
+        self.assertEqual(filtros, [['b', 'd'], ['e']])
+
+
+class ProcessNotifsBatchTests(SimpleTestCase):
+    def test_lote_con_carga_en_bloque_y_resultados_por_tramos(self):
+        from types import SimpleNamespace
+        from api.notifications_mobile.management.commands import process_notifs
+
+        def fila(id, usuario, dispositivo=None):
+            return SimpleNamespace(id=id, codusuario=usuario, iddispositivomovil=dispositivo, intentos=0,
+                                   titulo='t', mensaje='m', datos_adicionales={}, estado='PROCESSING',
+                                   error_mensaje=None, fecha_envio=None)
+
+        lote = [fila(1, 10), fila(2, 11), fila(3, 12), fila(4, 10, dispositivo=2)]
+        usuarios = {
+            10: SimpleNamespace(codigo=10, recibir_notificaciones=True, notificaciones_push=True),
+            11: SimpleNamespace(codigo=11, recibir_notificaciones=True, notificaciones_push=False),
+        }
+        dispositivos = [
+            SimpleNamespace(id=1, codusuario=10, token_fcm='tok-a'),
+            SimpleNamespace(id=2, codusuario=10, token_fcm='tok-b'),
+        ]
+        enviados = []
+
+        def enviar(tokens, **kwargs):
+            enviados.append(tokens)
+            return {'sent': len(tokens), 'errors': [], 'resultados': []}
+
+        with patch.object(process_notifs, 'UsuarioMN') as usuario_mn, \
+                patch.object(process_notifs, 'DispositivoMovilMN') as disp_mn, \
+                patch.object(process_notifs, 'HistorialNotificacionMN') as hist_mn, \
+                patch.object(process_notifs, 'RESULTADOS_POR_UPDATE', 3), \
+                patch.object(process_notifs, 'mobile_send_push_fcm', side_effect=enviar):
+            usuario_mn.objects.in_bulk.return_value = usuarios
+            disp_mn.objects.filter.return_value.only.return_value.order_by.return_value = dispositivos
+            process_notifs.Command()._procesar_lote(lote, {}, 'w1')
+
+        self.assertEqual([h.estado for h in lote], ['SENT', 'SKIPPED_PREF', 'ERROR', 'SENT'])
+        self.assertEqual(enviados, [['tok-a', 'tok-b'], ['tok-b']])
+        self.assertEqual(usuario_mn.objects.in_bulk.call_count, 1)
+        # Un UPDATE por tramo y renovación del reclamo de lo que faltaba tras el primero
+        self.assertEqual([c.args[0] for c in hist_mn.objects.bulk_update.call_args_list], [lote[:3], lote[3:]])
+        hist_mn.objects.filter.assert_called_once_with(id__in=[4], estado='PROCESSING', claimed_by='w1')
+
+
+class MobileDispatchDueTests(SimpleTestCase):
+    def test_drena_por_lotes_con_consultas_en_bloque(self):
+        from types import SimpleNamespace
+        from rest_framework.test import APIRequestFactory
+        from api.notifications_mobile import dispatch, views
+
+        def fila(id, usuario):
+            return SimpleNamespace(id=id, codusuario=usuario, datos_adicionales={}, titulo='t', mensaje='m',
+                                   intentos=0, estado='PENDIENTE', error_mensaje=None,
+                                   fecha_entrega=None, iddispositivomovil=None)
+
+        lotes = [[fila(1, 10), fila(2, 11)], [fila(3, 10)], []]
+        dispositivos = [SimpleNamespace(id=7, codusuario=10, token_fcm='tok-a')]
+        pendientes = patch.object(dispatch, 'pendientes_push').start()
+        self.addCleanup(patch.stopall)
+        patch.object(views, 'pendientes_push', pendientes).start()
+        qs = pendientes.return_value.filter.return_value
+        qs.select_for_update.return_value.order_by.return_value.__getitem__.side_effect = lotes
+        qs.exists.return_value = False
+
+        en_transaccion = []
+
+        class Atomic:
+            def __enter__(self):
+                en_transaccion.append(True)
+
+            def __exit__(self, *exc):
+                en_transaccion.pop()
+
+        def enviar_fcm(*args):
+            self.assertEqual(en_transaccion, [])  # el reclamo ya se confirmó
+            return {'sent': 1, 'errors': [], 'resultados': []}
+
+        with patch.object(dispatch, 'HistorialNotificacionMN') as hist, \
+                patch.object(dispatch, 'DispositivoMovilMN') as disp, \
+                patch.object(dispatch.transaction, 'atomic', Atomic), \
+                patch.object(views, 'desactivar_tokens', return_value=0), \
+                patch.object(dispatch, 'mobile_send_push_fcm', side_effect=enviar_fcm) as enviar:
+            disp.objects.filter.return_value.exclude.return_value.exclude.return_value \
+                .only.return_value.order_by.return_value = dispositivos
+            request = APIRequestFactory().post('/api/mobile-notif/dispatch-due/?lote=2')
+            respuesta = views.mobile_dispatch_due(request)
+
+        self.assertEqual(respuesta.data['batches'], 2)
+        self.assertEqual((respuesta.data['sent'], respuesta.data['skipped']), (2, 1))
+        self.assertEqual(enviar.call_count, 2)
+        self.assertEqual(disp.objects.filter.call_count, 2)  # una consulta de dispositivos por lote
+        self.assertEqual(hist.objects.bulk_update.call_count, 2)
+        reclamos = hist.objects.filter.return_value.update.call_args_list
+        self.assertEqual([sorted(c.kwargs) for c in reclamos], [['claimed_at', 'claimed_by']] * 2)
+
+
+class NotificationSchedulerAgendaTests(SimpleTestCase):
+    def test_heap_ordena_reprograma_y_respeta_el_limite(self):
+        from api.notifications_mobile.management.commands.run_notification_scheduler import Agenda
+
+        agenda = Agenda()
+        agenda.agregar(1, 300.0)
+        agenda.agregar(2, 100.0)
+        agenda.agregar(3, 200.0)
+        agenda.agregar(2, 400.0)  # reprogramada: la entrada vieja queda huérfana en el heap
+        self.assertEqual(agenda.proximo(), 200.0)
+        self.assertEqual(len(agenda), 3)
+
+        self.assertEqual(agenda.vencidos(350.0, limite=1), [3])
+        self.assertEqual(agenda.vencidos(350.0, limite=10), [1])
+        self.assertEqual(agenda.vencidos(350.0, limite=10), [])
+        self.assertEqual(agenda.proximo(), 400.0)
+        self.assertEqual(agenda.vencidos(400.0, limite=10), [2])
+        self.assertIsNone(agenda.proximo())
+
+
+class QueueRemindersTests(SimpleTestCase):
+    """Ventanas H24/H2 de queue_reminders: parámetros del INSERT ... SELECT y el camino fila a fila."""
+
+    def _ahora(self):
+        from datetime import datetime
+        from django.utils import timezone
+        # 23:58 hora local: la ventana de ±5 min cruza la medianoche
+        return timezone.make_aware(datetime(2025, 3, 9, 23, 58))
+
+    def test_sql_recibe_ventana_fechas_y_zona_horaria(self):
+        from datetime import date, timedelta
+        from io import StringIO
+        from types import SimpleNamespace
+        from unittest.mock import MagicMock
+        from django.utils import timezone
+        from api.notifications_mobile.management.commands import queue_reminders
+
+        ahora = self._ahora()
+        conexion = MagicMock(vendor='postgresql')
+        cursor = conexion.cursor.return_value.__enter__.return_value
+        cursor.rowcount = 2
+        salida = StringIO()
+        with patch.object(queue_reminders, 'connection', conexion), \
+                patch.object(queue_reminders.timezone, 'localtime', return_value=ahora), \
+                patch.object(queue_reminders, '_ensure_catalog',
+                             return_value=(SimpleNamespace(id=3), SimpleNamespace(id=1))):
+            queue_reminders.Command(stdout=salida).handle(tolerance_min=5, only='ALL')
+
+        (sql_h24, h24), (sql_h2, h2) = [c.args for c in cursor.execute.call_args_list]
+        self.assertIs(sql_h24, queue_reminders.ENCOLAR_SQL)
+        self.assertIn('ON CONFLICT (consulta_id, reminder_kind, COALESCE(iddispositivomovil, 0))', sql_h24)
+        self.assertEqual((h24['tipo'], h24['kind'], h2['tipo'], h2['kind']),
+                         ('REMINDER_H24', 'H24', 'REMINDER_H2', 'H2'))
+        self.assertEqual((h24['inicio'], h24['fin']),
+                         (ahora + timedelta(hours=24, minutes=-5), ahora + timedelta(hours=24, minutes=5)))
+        # La cita se compara en hora local: las fechas cubren ambos lados de la medianoche
+        self.assertEqual((h24['fecha_desde'], h24['fecha_hasta']), (date(2025, 3, 10), date(2025, 3, 11)))
+        self.assertEqual((h2['fecha_desde'], h2['fecha_hasta']), (date(2025, 3, 10), date(2025, 3, 10)))
+        self.assertEqual(h24['tz'], timezone.get_current_timezone_name())
+        self.assertEqual((h24['tipo_id'], h24['canal_id']), (3, 1))
+        self.assertIn('Total encoladas: 4', salida.getvalue())
+
+    def test_recorrida_no_repite_avisos_ya_enviados(self):
+        from api.notifications_mobile import queue
+        from api.notifications_mobile.management.commands.queue_reminders import ENCOLAR_SQL
+        from api.notifications_mobile.models import DispositivoMovilMN
+
+        # SQL: el NOT EXISTS mira cualquier estado (también SENT), no solo los pendientes
+        no_existe = ENCOLAR_SQL[ENCOLAR_SQL.index('NOT EXISTS'):ENCOLAR_SQL.index('ON CONFLICT')]
+        self.assertIn('x.reminder_kind = %(kind)s', no_existe)
+        self.assertIn('COALESCE(x.iddispositivomovil, d.id) = d.id', no_existe)
+        self.assertNotIn('estado', no_existe)
+
+        # Camino fila a fila: mismo criterio en enqueue_notif_for_user_devices
+        qs = queue._sin_aviso_previo(DispositivoMovilMN.objects.filter(codusuario=1, activo=True), 7, 'H24')
+        sql = str(qs.query)
+        self.assertIn('NOT (EXISTS', sql)
+        self.assertIn('"iddispositivomovil" IS NULL', sql)
+        self.assertIn('"reminder_kind" = H24', sql)
+        self.assertNotIn('"estado"', sql)
+
+    def test_sin_postgres_filtra_ventana_y_preferencias_fila_a_fila(self):
+        from datetime import date, time
+        from io import StringIO
+        from types import SimpleNamespace
+        from unittest.mock import MagicMock
+        from api.notifications_mobile.management.commands import queue_reminders
+        from api.notifications_mobile.models import ConsultaMN, HorarioMN, UsuarioMN
+
+        consultas = [
+            SimpleNamespace(id=1, fecha=date(2025, 3, 10), idhorario=10, codpaciente=100, empresa_id=5),  # 01:55: dentro
+            SimpleNamespace(id=2, fecha=date(2025, 3, 10), idhorario=11, codpaciente=100, empresa_id=5),  # 03:00: fuera
+            SimpleNamespace(id=3, fecha=date(2025, 3, 10), idhorario=10, codpaciente=101, empresa_id=5),  # sin push
+            SimpleNamespace(id=4, fecha=date(2025, 3, 10), idhorario=99, codpaciente=100, empresa_id=5),  # sin horario
+        ]
+        horarios = {10: SimpleNamespace(hora=time(1, 55)), 11: SimpleNamespace(hora=time(3, 0))}
+        usuarios = {
+            100: SimpleNamespace(codigo=100, recibir_notificaciones=True, notificaciones_push=True),
+            101: SimpleNamespace(codigo=101, recibir_notificaciones=True, notificaciones_push=False),
+        }
+
+        def obtener(tabla, modelo):
+            def get(id=None, codigo=None):
+                try:
+                    return tabla[id if codigo is None else codigo]
+                except KeyError:
+                    raise modelo.DoesNotExist
+            return get
+
+        with patch.object(queue_reminders, 'connection', MagicMock(vendor='sqlite')), \
+                patch.object(queue_reminders.timezone, 'localtime', return_value=self._ahora()), \
+                patch.object(ConsultaMN, 'objects') as consulta_mn, \
+                patch.object(HorarioMN, 'objects') as horario_mn, \
+                patch.object(UsuarioMN, 'objects') as usuario_mn, \
+                patch.object(queue_reminders, 'enqueue_notif_for_user_devices', return_value=[1, 2]) as encolar:
+            consulta_mn.filter.return_value = consultas
+            horario_mn.get.side_effect = obtener(horarios, HorarioMN)
+            usuario_mn.get.side_effect = obtener(usuarios, UsuarioMN)
+            queue_reminders.Command(stdout=StringIO()).handle(tolerance_min=5, only='H2')
+
+        self.assertEqual(sorted(consulta_mn.filter.call_args.kwargs['fecha__in']), [date(2025, 3, 10)])
+        encolar.assert_called_once()
+        kwargs = encolar.call_args.kwargs
+        self.assertEqual((kwargs['consulta_id'], kwargs['reminder_kind'], kwargs['empresa_id']), (1, 'H2', 5))
+        self.assertEqual(kwargs['mensaje'], 'Tienes una consulta el 10/03 01:55')
+        self.assertEqual(kwargs['data'], {'tipo': 'REMINDER_H2', 'consulta_id': 1,
+                                          'fecha': '2025-03-10', 'hora': '01:55:00'})
+
+
+class RecordatorioColumnasTests(SimpleTestCase):
+    def test_backfill_mapea_las_claves_json_al_reminder_kind(self):
+        import importlib
+        migracion = importlib.import_module('api.migrations.0019_historialnotificacion_recordatorio_columnas')
+
+        tipo = migracion._tipo_recordatorio
+        self.assertEqual(tipo({'consulta_id': 1, 'reminder': '24h'}, 'Recordatorio de consulta'), 'H24')
+        self.assertEqual(tipo({'consulta_id': 1, 'tipo': 'REMINDER_H2'}, 'Recordatorio de consulta'), 'H2')
+        self.assertEqual(tipo({'consulta_id': 1}, 'Consulta creada'), 'CREADA')
+        self.assertIsNone(tipo({'paciente_codusuario': 3}, 'Aviso'))
+        self.assertIsNone(migracion._entero('abc'))
+
+    def test_crear_recordatorio_ignora_el_pendiente_duplicado(self):
+        from contextlib import nullcontext
+        from django.db import IntegrityError
+        from api.notifications_mobile import queue
+
+        with patch.object(queue.transaction, 'atomic', return_value=nullcontext()), \
+                patch.object(queue.HistorialNotificacionMN.objects, 'create', side_effect=IntegrityError) as create:
+            self.assertIsNone(queue.crear_recordatorio(consulta_id=7, reminder_kind=queue.RECORDATORIO_H24))
+        create.assert_called_once_with(consulta_id=7, reminder_kind='H24')
+
+
+class CatalogoNotificacionesTests(SimpleTestCase):
+    """Caché de tipos/canales: una sola consulta por nombre hasta que se guarda un catálogo."""
+
+    def setUp(self):
+        from . import catalogo_notificaciones
+        self.catalogo = catalogo_notificaciones
+        catalogo_notificaciones.invalidate_catalogo_cache()
+
+    def test_cachea_aciertos_y_negativos_hasta_invalidar(self):
+        from django.db.models.signals import post_save
+        from .models_notifications import TipoNotificacion
+        from .notifications_mobile.models import CanalNotificacionMN
+
+        tipo = TipoNotificacion(id=3, nombre='Cita', activo=True)
+        with patch.object(TipoNotificacion.objects, 'filter') as filtro, \
+                patch.object(CanalNotificacionMN.objects, 'filter') as filtro_mn:
+            filtro.return_value.first.return_value = tipo
+            filtro_mn.return_value.first.return_value = None
+            for _ in range(3):
+                self.assertEqual(self.catalogo.obtener(TipoNotificacion, 'Cita').id, 3)
+                self.assertIsNone(self.catalogo.obtener(CanalNotificacionMN, 'PUSH_MOBILE'))
+            self.assertIsNot(self.catalogo.obtener(TipoNotificacion, 'Cita'), tipo)
+            self.assertEqual((filtro.call_count, filtro_mn.call_count), (1, 1))
+
+            post_save.send(sender=CanalNotificacionMN, instance=CanalNotificacionMN(nombre='PUSH_MOBILE'),
+                           created=True)
+            self.catalogo.obtener(TipoNotificacion, 'Cita')
+            self.assertEqual(filtro.call_count, 2)
+
+        with self.assertRaises(TipoNotificacion.DoesNotExist), \
+                patch.object(TipoNotificacion.objects, 'filter') as filtro:
+            filtro.return_value.first.return_value = None
+            self.catalogo.requerir(TipoNotificacion, 'Inexistente')
+
+
+class EnvioMasivoNotificacionesTests(SimpleTestCase):
+    """Modo masivo: preferencias, historial y envíos por lote; el resultado por usuario no cambia."""
+
+    def test_agrupa_por_canal_y_reporta_por_usuario(self):
+        from .models import Usuario
+        from .models_notifications import CanalNotificacion, HistorialNotificacion, PreferenciaNotificacion, TipoNotificacion
+        from .services import notification_service as modulo
+
+        servicio = modulo.NotificationService()
+        tipo = TipoNotificacion(id=1, nombre='Sistema', activo=True)
+        usuarios = [Usuario(codigo=c, nombre=f'U{c}', correoelectronico=f'u{c}@x.com') for c in (1, 2, 3)]
+        canales = {'email': CanalNotificacion(id=1, nombre='email'), 'push': CanalNotificacion(id=2, nombre='push')}
+        preferencias = [(1, 'email'), (1, 'push'), (2, 'push')]  # el usuario 3 no tiene canales
+
+        with patch.object(modulo.catalogo, 'obtener', side_effect=lambda m, n: tipo if m is TipoNotificacion else canales.get(n)), \
+                patch.object(PreferenciaNotificacion.objects, 'filter') as prefs, \
+                patch.object(HistorialNotificacion.objects, 'bulk_create') as bulk_create, \
+                patch.object(HistorialNotificacion.objects, 'bulk_update') as bulk_update, \
+                patch.object(servicio, '_enviar_emails_lote', side_effect=lambda envios: [True] * len(envios)) as emails, \
+                patch.object(servicio, '_enviar_push_lote', return_value=[True, False]) as pushes:
+            prefs.return_value.values_list.return_value = preferencias
+            resultado = servicio.enviar_notificacion(usuarios, 'Sistema', 'Aviso', 'Cerrado', usar_plantilla=False,
+                                                     masivo=True)
+
+        self.assertEqual((resultado['enviados'], resultado['errores']), (1, 2))
+        detalles = {d['usuario_id']: d for d in resultado['detalles']}
+        self.assertEqual(detalles[1]['canales_enviados'], ['email', 'push'])
+        self.assertEqual(detalles[2]['errores'], ['Error enviando por push'])
+        self.assertFalse(detalles[3]['exito'])
+        self.assertEqual(len(emails.call_args[0][0]), 1)
+        self.assertEqual([e[1].codigo for e in pushes.call_args[0][0]], [1, 2])
+        self.assertEqual(bulk_create.call_count, 1)
+        self.assertEqual([h.estado for h in bulk_update.call_args[0][0]], ['enviado', 'enviado', 'error'])
+
+
+class PlantillasCompiladasTests(SimpleTestCase):
+    def test_misma_salida_que_template_y_recompila_al_editar(self):
+        from datetime import datetime, timezone as dt_timezone
+        from django.template import Context, Template
+        from . import plantillas_compiladas
+        from .models_notifications import PlantillaNotificacion
+
+        datos = {'nombre': "O'Brien <b>", 'monto': 1234567, 'usuario': Empresa(nombre='Norte')}
+        for texto in ('Hola {{ nombre }} {{ usuario.nombre }} {{ falta }}{# nota #} {{ monto }}',
+                      '{% if nombre %}{{ nombre|upper }}{% endif %} {{ None }}'):
+            self.assertEqual(plantillas_compiladas.compilar(texto).render(datos), Template(texto).render(Context(datos)))
+
+        # Fallos "silenciosos" (silent_variable_failure) se renderizan vacíos, como en Template
+        class SinPaciente(Exception):
+            silent_variable_failure = True
+
+        class Usuario:
+            @property
+            def paciente(self):
+                raise SinPaciente()
+
+        texto, datos_sin_paciente = 'Hola {{ usuario.paciente.x }}!', {'usuario': Usuario()}
+        self.assertEqual(plantillas_compiladas.compilar(texto).render(datos_sin_paciente), 'Hola !')
+        self.assertEqual(Template(texto).render(Context(datos_sin_paciente)), 'Hola !')
+
+        plantilla = PlantillaNotificacion(id=9, titulo_template='Hola {{ nombre }}',
+                                          fecha_actualizacion=datetime(2025, 1, 1, tzinfo=dt_timezone.utc))
+        primera = plantillas_compiladas.de_plantilla(plantilla, 'titulo_template')
+        self.assertIs(plantillas_compiladas.de_plantilla(plantilla, 'titulo_template'), primera)
+        plantilla.titulo_template = 'Chau {{ nombre }}'
+        plantilla.fecha_actualizacion = datetime(2025, 1, 2, tzinfo=dt_timezone.utc)
+        self.assertEqual(plantillas_compiladas.de_plantilla(plantilla, 'titulo_template').render(datos),
+                         'Chau O&#x27;Brien &lt;b&gt;')
+
+    def test_la_plantilla_de_la_empresa_reemplaza_a_la_general(self):
+        from .models import Usuario
+        from .models_notifications import PlantillaNotificacion
+        from .services.notification_service import NotificationService
+
+        general, propia = PlantillaNotificacion(id=1), PlantillaNotificacion(id=2, empresa_id=5)
+        plantillas = {(None, 'email'): general, (5, 'email'): propia}
+        servicio = NotificationService()
+        self.assertIs(servicio._plantilla_para(plantillas, Usuario(codigo=1, empresa_id=5), 'email'), propia)
+        self.assertIs(servicio._plantilla_para(plantillas, Usuario(codigo=2, empresa_id=6), 'email'), general)
+        self.assertIsNone(servicio._plantilla_para(plantillas, Usuario(codigo=3), 'push'))
+
+
+class ExpoSenderTests(SimpleTestCase):
+    """Lotes de 100 contra un Expo falso en 127.0.0.1, tickets por mensaje y recibos."""
+
+    def test_lotes_de_100_tickets_y_recibos(self):
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from api.notifications_mobile.expo_sender import ExpoSender, construir_mensaje
+
+        lotes = []
+
+        class FakeExpo(BaseHTTPRequestHandler):
+            def do_POST(self):
+                cuerpo = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if self.path == '/send':
+                    lotes.append(len(cuerpo))
+                    datos = [
+                        {'status': 'error', 'message': 'no registrado', 'details': {'error': 'DeviceNotRegistered'}}
+                        if m['to'].endswith('[7]') else {'status': 'ok', 'id': f"t-{m['to']}"}
+                        for m in cuerpo
+                    ]
+                else:
+                    datos = {i: {'status': 'ok'} for i in cuerpo['ids'][:1]}
+                salida = json.dumps({'data': datos}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(salida)))
+                self.end_headers()
+                self.wfile.write(salida)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeExpo)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base = f'http://127.0.0.1:{server.server_port}'
+
+        sender = ExpoSender(access_token='x', push_url=f'{base}/send', receipts_url=f'{base}/receipts')
+        tokens = [f'ExponentPushToken[{i}]' for i in range(150)]
+        resultados = sender.enviar([construir_mensaje(t, 'Hola', 'Mundo') for t in tokens])
+
+        self.assertEqual(lotes, [100, 50])
+        self.assertEqual([r['token'] for r in resultados], tokens)
+        self.assertFalse(resultados[7]['ok'])
+        self.assertTrue(resultados[7]['muerto'])
+        self.assertEqual(resultados[8]['ticket_id'], 't-ExponentPushToken[8]')
+        self.assertEqual(sender.recibos(['a', 'b']), {'a': {'status': 'ok'}})
+
+    def test_session_propia_de_cada_hilo(self):
+        import threading
+        from api.notifications_mobile.expo_sender import ExpoSender
+
+        sender, sesiones = ExpoSender(), []
+        hilo = threading.Thread(target=lambda: sesiones.append(sender.session))
+        hilo.start()
+        hilo.join()
+        self.assertIs(sender.session, sender.session)
+        self.assertIsNot(sesiones[0], sender.session)
+
+
+class PushAgrupadoTests(SimpleTestCase):
+    def test_mensajes_iguales_se_agrupan_y_los_personalizados_van_solos(self):
+        from types import SimpleNamespace
+        from .models import Usuario
+        from .services.notification_service import NotificationService
+
+        def envio(codigo, mensaje):
+            return (SimpleNamespace(error_mensaje=None), Usuario(codigo=codigo), 'push', 'Aviso', 'Aviso', mensaje)
+
+        envios = [envio(1, 'Cerrado'), envio(2, 'Cerrado'), envio(3, 'Hola Ana'), envio(4, 'Cerrado')]
+        dispositivos = {
+            1: [SimpleNamespace(token_fcm='a1'), SimpleNamespace(token_fcm='a2')],
+            2: [SimpleNamespace(token_fcm='b1')],
+            3: [SimpleNamespace(token_fcm='c1')],
+            4: [SimpleNamespace(token_fcm='')],
+        }
+        llamadas = []
+
+        def post(tokens, titulo, mensaje, datos):
+            llamadas.append((tokens, mensaje))
+            return (False, 'caído') if tokens == ['b1'] else (True, None)
+
+        exitos = NotificationService()._enviar_push_agrupado(
+            envios, [0, 1, 2, 3], dispositivos, {}, [False] * 4, post, 2, 'sin tokens'
+        )
+        self.assertEqual(llamadas, [(['a1', 'a2'], 'Cerrado'), (['b1'], 'Cerrado'), (['c1'], 'Hola Ana')])
+        self.assertEqual(exitos, [True, False, True, False])
+        self.assertEqual([e[0].error_mensaje for e in envios], [None, 'caído', None, 'sin tokens'])
+
+
+class CanalesParalelosTests(SimpleTestCase):
+    def test_email_lento_no_demora_el_push_y_registra_al_terminar(self):
+        import threading
+        import time
+        from types import SimpleNamespace
+        from unittest import mock
+        from .models import Usuario
+        from .services import notification_service
+        from .services.notification_service import NotificationService
+
+        liberar, guardados = threading.Event(), []
+
+        def historial(canal):
+            h = SimpleNamespace(estado='pendiente', fecha_envio=None, error_mensaje=None)
+            h.save = lambda update_fields: guardados.append((canal, h.estado))
+            return h
+
+        def email_lento(usuario, asunto, titulo, mensaje, h):
+            liberar.wait(5)
+            return True
+
+        servicio = NotificationService()
+        tareas = [('email', historial('email'), 'A', 'A', 'm'), ('push', historial('push'), 'A', 'A', 'm')]
+        with mock.patch.object(notification_service, 'NOTIF_TIMEOUT_CANAL', {'email': 0.2, 'push': 2}), \
+                mock.patch.object(servicio, '_enviar_email', side_effect=email_lento), \
+                mock.patch.object(servicio, '_enviar_push', return_value=True):
+            inicio = time.monotonic()
+            salida = servicio._despachar_canales(Usuario(codigo=1), tareas, {})
+            self.assertLess(time.monotonic() - inicio, 2)
+            self.assertEqual(salida[1], ('push', (True, None)))
+            self.assertEqual(salida[0][0], 'email')
+            self.assertFalse(salida[0][1][0])
+            self.assertIn('Tiempo agotado', salida[0][1][1])
+            self.assertEqual(guardados, [('push', 'enviado')])
+
+            liberar.set()
+            for _ in range(50):
+                if len(guardados) == 2:
+                    break
+                time.sleep(0.05)
+        self.assertEqual(guardados[1], ('email', 'enviado'))
+
+    def test_con_el_pool_ocupado_cancela_lo_que_no_llego_a_empezar(self):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from types import SimpleNamespace
+        from unittest import mock
+        from .models import Usuario
+        from .services import notification_service
+        from .services.notification_service import NotificationService
+
+        liberar, guardados = threading.Event(), []
+        self.addCleanup(liberar.set)
+
+        def historial(canal):
+            h = SimpleNamespace(estado='pendiente', fecha_envio=None, error_mensaje=None)
+            h.save = lambda update_fields: guardados.append((canal, h.estado))
+            return h
+
+        pool = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(pool.shutdown)
+        servicio = NotificationService()
+        tareas = [('email', historial('email'), 'A', 'A', 'm'), ('push', historial('push'), 'A', 'A', 'm')]
+        with mock.patch.object(notification_service, '_ejecutor', pool), \
+                mock.patch.object(notification_service, 'NOTIF_TIMEOUT_CANAL', {'email': 0.1, 'push': 0.2}), \
+                mock.patch.object(servicio, '_enviar_email', side_effect=lambda *a: liberar.wait(5)), \
+                mock.patch.object(servicio, '_enviar_push', return_value=True) as push:
+            salida = servicio._despachar_canales(Usuario(codigo=1), tareas, {})
+            liberar.set()
+
+        # El email ocupa el único hilo; el push sigue en cola al vencer su plazo y no se envía
+        self.assertIn('sigue en segundo plano', salida[0][1][1])
+        self.assertEqual(salida[1], ('push', (False, 'Tiempo agotado en canal push (no se envió)')))
+        push.assert_not_called()
+        self.assertEqual(guardados[0], ('push', 'error'))
+
+    def test_session_push_es_propia_de_cada_hilo(self):
+        import threading
+        from .services.notification_service import NotificationService
+
+        servicio, sesiones = NotificationService(), []
+        hilo = threading.Thread(target=lambda: sesiones.append(servicio._session_push()))
+        hilo.start()
+        hilo.join()
+        self.assertIs(servicio._session_push(), servicio._session_push())
+        self.assertIsNot(sesiones[0], servicio._session_push())
@@ -0,0 +1,8 @@
+# api/utils_procesos.py
+import os
+import socket
+
+
+def nombre_worker():
+    """Identificador del proceso (host:pid) con el que las colas marcan las filas que reclaman."""
+    return f"{socket.gethostname()}:{os.getpid()}"[:100]
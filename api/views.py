@@ -1,7 +1,6 @@
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse, FileResponse
 from django.contrib.auth import get_user_model
-from django.db import connection
-from django.core.mail import send_mail
+from django.db import connection, transaction
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
@@ -9,8 +8,6 @@ from django.db.models import Q
 from django.utils.timezone import make_aware
 from django.utils import timezone  # <-- necesario (usado en reprogramar)
 from datetime import datetime, timedelta
-import csv
-from io import BytesIO
 
 from rest_framework import status, serializers
 from rest_framework.generics import RetrieveUpdateAPIView
@@ -18,6 +15,7 @@ from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.filters import SearchFilter, OrderingFilter
 from rest_framework.response import Response
+from rest_framework.renderers import JSONRenderer
 from rest_framework.decorators import action
 from rest_framework import viewsets, mixins
 from rest_framework.viewsets import GenericViewSet
@@ -25,7 +23,7 @@ from django_filters.rest_framework import DjangoFilterBackend
 
 from .models import (
     Paciente, Consulta, Odontologo, Horario, Tipodeconsulta, Estadodeconsulta,  # <-- añadido Estadodeconsulta
-    Usuario, Tipodeusuario, Bitacora, Historialclinico, Consentimiento
+    Usuario, Tipodeusuario, Bitacora, Historialclinico, Consentimiento, ReporteBitacora
 )
 
 from .serializers import (
@@ -45,6 +43,18 @@ from .serializers import (
     ConsentimientoSerializer,
     EstadodeconsultaSerializer,  # <-- añadido
 )
+from .identity import get_identity
+from .audit_sink import registrar_bitacora
+from .availability import (
+    horarios_disponibles, matriz_disponibilidad, proximos_libres as buscar_proximos_libres, slots_empresa
+)
+from .email_outbox import encolar_correo
+from .reservas import bloquear_dias, guardar_reserva, no_disponible
+from .bitacora_export import EXPORT_RENDERERS, aplicar_filtros as aplicar_filtros_bitacora, gzip_stream, stream_csv, stream_ndjson
+from .bitacora_reportes import crear_reporte as crear_reporte_bitacora, url_descarga as url_descarga_reporte
+from .bitacora_resumen import GRANULARIDADES as GRANULARIDADES_BITACORA, estadisticas as estadisticas_bitacora
+from .notifications_mobile.models import DispositivoMovilMN, HistorialNotificacionMN
+from .notifications_mobile.queue import ESTADOS_PENDIENTES, RECORDATORIO_H2, RECORDATORIO_H24, crear_recordatorio
 
 
 # -------------------- Health / Utils --------------------
@@ -160,22 +170,11 @@ def _es_admin_por_tabla(request) -> bool:
     Compara por nombre de rol (no por id) y misma empresa que el tenant.
     """
     t = _tenant(request)
-    if not t or not request.user or not request.user.is_authenticated:
-        return False
-
-    email = (getattr(request.user, "email", None) or getattr(request.user, "username", "")).strip().lower()
-    if not email:
-        return False
-    try:
-        u = Usuario.objects.select_related("idtipousuario").get(correoelectronico__iexact=email)
-    except Usuario.DoesNotExist:
+    if not t:
         return False
 
-    return (
-            u.empresa_id == t.id and
-            u.idtipousuario is not None and
-            (u.idtipousuario.rol or "").strip().lower() == "administrador"
-    )
+    identidad = get_identity(request)
+    return identidad.usuario is not None and identidad.empresa_id == t.id and identidad.es_admin
 
 
 # -------------------- Pacientes --------------------
@@ -234,14 +233,23 @@ class ConsultaViewSet(ModelViewSet):
 
     def perform_create(self, serializer):
         """Asigna automáticamente la empresa del tenant al crear una consulta"""
-        # Asignar empresa del tenant
-        if hasattr(self.request, 'tenant') and self.request.tenant:
-            serializer.save(empresa=self.request.tenant)
-        else:
-            serializer.save()
+        # Asignar empresa del tenant. El índice único de consulta resuelve las
+        # reservas simultáneas del mismo hueco: la que pierde recibe 409.
+        tenant = getattr(self.request, 'tenant', None)
+        extra = {'empresa': tenant} if tenant else {}
+        datos = serializer.validated_data
+        with transaction.atomic():
+            guardar_reserva(
+                lambda: serializer.save(**extra),
+                tenant.id if tenant else None,
+                getattr(datos.get('cododontologo'), 'pk', None),
+                datos['fecha'],
+            )
+            # El correo de confirmación va a la bandeja de salida en la misma
+            # transacción; lo envía el comando despachar_correos
+            self._encolar_confirmacion(serializer.instance)
 
-        # Enviar email de confirmación (código existente)
-        consulta = serializer.instance
+    def _encolar_confirmacion(self, consulta):
         paciente = consulta.codpaciente
         usuario_paciente = paciente.codusuario
 
@@ -268,12 +276,25 @@ Recuerda llegar 15 minutos antes de tu cita.
 Si necesitas cancelar o reprogramar tu cita, ponte en contacto con nosotros.
                 """
 
-                from_email = settings.DEFAULT_FROM_EMAIL
-                recipient_list = [usuario_paciente.correoelectronico]
-                send_mail(subject, message, from_email, recipient_list, fail_silently=False)
+                # Savepoint propio: un fallo al encolar no revierte la cita
+                with transaction.atomic():
+                    encolar_correo(
+                        subject, message, [usuario_paciente.correoelectronico],
+                        empresa=consulta.empresa, referencia=f"consulta:{consulta.pk}"
+                    )
 
             except Exception as e:
-                print(f"Error al enviar correo de notificación: {e}")
+                print(f"Error al encolar correo de notificación: {e}")
+
+    def perform_update(self, serializer):
+        instancia = serializer.instance
+        datos = serializer.validated_data
+        guardar_reserva(
+            serializer.save,
+            instancia.empresa_id,
+            getattr(datos.get('cododontologo'), 'pk', instancia.cododontologo_id),
+            datos.get('fecha', instancia.fecha),
+        )
 
     def get_serializer_class(self):
         # --- MODIFICACIÓN: Añadir el nuevo serializador ---
@@ -300,22 +321,44 @@ Si necesitas cancelar o reprogramar tu cita, ponte en contacto con nosotros.
         nueva_fecha = serializer.validated_data['fecha']
         nuevo_horario = serializer.validated_data['idhorario']
 
-        # Actualizar la consulta
-        consulta.fecha = nueva_fecha
-        consulta.idhorario = nuevo_horario
+        with transaction.atomic():
+            # Lock del día de origen y del de destino del odontólogo; dentro del lock
+            # se vuelve a mirar la fila y el hueco (otra petición pudo moverlos)
+            bloquear_dias(
+                (consulta.cododontologo_id, consulta.fecha),
+                (consulta.cododontologo_id, nueva_fecha),
+            )
+            consulta = Consulta.objects.select_for_update().get(pk=consulta.pk)
+            if consulta.cododontologo_id and Consulta.objects.filter(
+                cododontologo_id=consulta.cododontologo_id,
+                fecha=nueva_fecha,
+                idhorario=nuevo_horario
+            ).exclude(pk=consulta.pk).exists():
+                raise no_disponible(
+                    consulta.empresa_id, consulta.cododontologo_id, nueva_fecha,
+                    "El nuevo horario seleccionado no está disponible."
+                )
 
-        # Opcional: Cambiar estado a 'Reprogramada' si existe (ej. id=5)
-        # consulta.idestadoconsulta_id = 5
-        consulta.save()
+            # Actualizar la consulta
+            consulta.fecha = nueva_fecha
+            consulta.idhorario = nuevo_horario
+
+            # Opcional: Cambiar estado a 'Reprogramada' si existe (ej. id=5)
+            # consulta.idestadoconsulta_id = 5
+            guardar_reserva(
+                consulta.save, consulta.empresa_id, consulta.cododontologo_id, nueva_fecha,
+                "El nuevo horario seleccionado no está disponible."
+            )
 
         # Refrescar desde la BD para obtener todas las relaciones
         consulta.refresh_from_db()
 
-        # 1) borrar pendientes anteriores de esta consulta
+        # 1) borrar pendientes anteriores de esta consulta (PENDIENTE de signals/views y
+        #    PENDING/PROCESSING de queue_reminders: si no, el índice único bloquea los nuevos)
         try:
             HistorialNotificacionMN.objects.filter(
-                estado="PENDIENTE",
-                datos_adicionales__consulta_id=consulta.id
+                estado__in=ESTADOS_PENDIENTES,
+                consulta_id=consulta.id
             ).delete()
         except Exception:
             pass  # No fallar si hay error con notificaciones
@@ -337,14 +380,15 @@ Si necesitas cancelar o reprogramar tu cita, ponte en contacto con nosotros.
                     .first()
                 )
 
-                def _mk(title, body, when, label):
-                    HistorialNotificacionMN.objects.create(
+                empresa_id = getattr(consulta, "empresa_id", None) or getattr(consulta.empresa, "id", None)
+
+                def _mk(title, body, when, label, kind):
+                    crear_recordatorio(
                         titulo=title,
                         mensaje=body,
                         datos_adicionales={
                             "consulta_id": consulta.id,
-                            "empresa_id": getattr(consulta, "empresa_id", None) or getattr(consulta.empresa, "id",
-                                                                                           None),
+                            "empresa_id": empresa_id,
                             "reminder": label,
                         },
                         estado="PENDIENTE",
@@ -358,17 +402,22 @@ Si necesitas cancelar o reprogramar tu cita, ponte en contacto con nosotros.
                         idtiponotificacion=1,
                         idcanalnotificacion=1,
                         iddispositivomovil=device_id,
+                        consulta_id=consulta.id,
+                        reminder_kind=kind,
+                        empresa_id=empresa_id,
                     )
 
                 now = timezone.now()
-                for delta, label in ((timedelta(hours=24), "24h"), (timedelta(hours=2), "2h")):
+                for delta, label, kind in ((timedelta(hours=24), "24h", RECORDATORIO_H24),
+                                           (timedelta(hours=2), "2h", RECORDATORIO_H2)):
                     when = cita_dt - delta
                     if when > now:
                         _mk(
                             "Recordatorio de consulta",
                             f"Tienes una consulta el {cita_dt:%d/%m %H:%M}. Recordatorio {label}.",
                             when,
-                            label
+                            label,
+                            kind
                         )
         except Exception as e:
             print(f"Error al gestionar notificaciones móviles: {e}")
@@ -395,25 +444,21 @@ Si necesitas cancelar o reprogramar tu cita, ponte en contacto con nosotros.
 
         # Registrar en bitácora antes de eliminar
         try:
-            usuario = None
-            if request.user.is_authenticated:
-                try:
-                    usuario = Usuario.objects.get(correoelectronico=request.user.email)
-                except Usuario.DoesNotExist:
-                    pass
+            usuario = get_identity(request).usuario
 
             from api.middleware import get_client_ip
-            Bitacora.objects.create(
+            registrar_bitacora(
                 accion='cancelar_cita',
-                descripcion=f'Cita cancelada: {consulta_info}',
                 usuario=usuario,
+                empresa=consulta.empresa_id,
                 ip_address=get_client_ip(request),
                 user_agent=request.META.get('HTTP_USER_AGENT', ''),
-                modelo_afectado='Consulta',
-                objeto_id=consulta_id,
-                datos_adicionales={
+                tabla_afectada='Consulta',
+                registro_id=consulta_id,
+                valores_anteriores={
+                    'descripcion': f'Cita cancelada: {consulta_info}',
                     'fecha': str(consulta.fecha),
-                    'horario': consulta.idhorario.hora if consulta.idhorario else 'N/A',
+                    'horario': str(consulta.idhorario.hora) if consulta.idhorario else 'N/A',
                     'odontologo': f"{consulta.cododontologo.codusuario.nombre} {consulta.cododontologo.codusuario.apellido}" if consulta.cododontologo else 'N/A'
                 }
             )
@@ -423,8 +468,8 @@ Si necesitas cancelar o reprogramar tu cita, ponte en contacto con nosotros.
         # borrar recordatorios pendientes asociados a esta consulta
         try:
             HistorialNotificacionMN.objects.filter(
-                estado="PENDIENTE",
-                datos_adicionales__consulta_id=consulta.pk
+                estado__in=ESTADOS_PENDIENTES,
+                consulta_id=consulta.pk
             ).delete()
         except Exception:
             pass  # No fallar si hay error con notificaciones
@@ -460,22 +505,18 @@ Si necesitas cancelar o reprogramar tu cita, ponte en contacto con nosotros.
 
         # Registrar en bitácora
         try:
-            usuario = None
-            if request.user.is_authenticated:
-                try:
-                    usuario = Usuario.objects.get(correoelectronico=request.user.email)
-                except Usuario.DoesNotExist:
-                    pass
+            usuario = get_identity(request).usuario
 
             from api.middleware import get_client_ip
-            Bitacora.objects.create(
+            registrar_bitacora(
                 accion='limpiar_citas_vencidas',
-                descripcion=f'Eliminadas {cantidad} citas vencidas',
                 usuario=usuario,
+                empresa=usuario.empresa_id if usuario else None,
                 ip_address=get_client_ip(request),
                 user_agent=request.META.get('HTTP_USER_AGENT', ''),
-                modelo_afectado='Consulta',
-                datos_adicionales={
+                tabla_afectada='Consulta',
+                valores_nuevos={
+                    'descripcion': f'Eliminadas {cantidad} citas vencidas',
                     'cantidad_eliminadas': cantidad,
                     'fecha_limpieza': str(date.today())
                 }
@@ -537,8 +578,6 @@ class HorarioViewSet(ReadOnlyModelViewSet):
         # 1. OBTENER PARÁMETROS
         fecha = request.query_params.get('fecha')
         odontologo_id = request.query_params.get('odontologo_id')
-        # Log de parámetros recibidos
-        logger.info(f"[Horarios Disponibles] Parámetros recibidos - fecha: '{fecha}', odontologo_id: '{odontologo_id}'")
 
         # Validar que existan los parámetros
         if not fecha or not odontologo_id:
@@ -548,12 +587,18 @@ class HorarioViewSet(ReadOnlyModelViewSet):
                 {"detail": "Se requieren los parámetros 'fecha' y 'odontologo_id'."},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        try:
+            odontologo_id = int(odontologo_id)
+        except ValueError:
+            return Response(
+                {"detail": "odontologo_id debe ser numérico."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
         # 2. VALIDAR FORMATO DE FECHA
         try:
             # Intentar parsear la fecha en formato YYYY-MM-DD
             fecha_obj = dt.strptime(fecha, '%Y-%m-%d').date()
-            logger.info(f"[Horarios Disponibles] Fecha parseada correctamente: {fecha_obj}")
         except ValueError as e:
             logger.error(f"[Horarios Disponibles] Error al parsear fecha '{fecha}': {str(e)}")
             return Response(
@@ -565,21 +610,14 @@ class HorarioViewSet(ReadOnlyModelViewSet):
             )
 
         # 3. VERIFICAR TENANT
-        tenant_detected = hasattr(request, 'tenant') and request.tenant
-        logger.info(f"[Horarios Disponibles] Tenant detectado: {tenant_detected}")
-        if tenant_detected:
-            logger.info(f"[Horarios Disponibles] Tenant: {request.tenant.nombre} (ID: {request.tenant.id})")
-        else:
+        tenant_detected = bool(getattr(request, 'tenant', None))
+        empresa_id = request.tenant.id if tenant_detected else None
+        if not tenant_detected:
             logger.warning(f"[Horarios Disponibles] No se detectó tenant para el usuario: {request.user}")
 
-        # 4. OBTENER HORARIOS DEL TENANT
+        # 4. DISPONIBILIDAD DESDE EL BITMAP (api.availability): sin consultas con la caché caliente
         try:
-            todos_horarios = self.get_queryset()
-            count_horarios = todos_horarios.count()
-            logger.info(f"[Horarios Disponibles] Total horarios encontrados: {count_horarios}")
-
-            # Si no hay horarios, puede ser problema de tenant
-            if count_horarios == 0:
+            if not slots_empresa(empresa_id):
                 error_msg = "No hay horarios configurados."
                 if not tenant_detected:
                     error_msg += " Además, no se detectó el tenant. Verifica la configuración de tu clínica."
@@ -588,47 +626,132 @@ class HorarioViewSet(ReadOnlyModelViewSet):
                     {"detail": error_msg, "tenant_detected": tenant_detected},
                     status=status.HTTP_404_NOT_FOUND
                 )
+            disponibles = horarios_disponibles(empresa_id, odontologo_id, fecha_obj)
         except Exception as e:
-            logger.error(f"[Horarios Disponibles] Error al obtener horarios del tenant: {str(e)}")
+            logger.error(f"[Horarios Disponibles] Error al calcular disponibilidad: {str(e)}")
             return Response(
-                {"detail": f"Error al consultar horarios: {str(e)}"},
+                {"detail": f"Error al procesar horarios disponibles: {str(e)}"},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-        # 5. FILTRAR HORARIOS OCUPADOS
-        try:
-            horarios_ocupados_query = Consulta.objects.filter(
-                cododontologo_id=odontologo_id,
-                fecha=fecha_obj  # Usar objeto date en lugar de string
+        logger.debug(f"[Horarios Disponibles] {len(disponibles)} libres - odontologo {odontologo_id}, {fecha_obj}")
+        return Response(disponibles, status=status.HTTP_200_OK)
+
+
+    # --- Disponibilidad por rango (calendario semanal / búsqueda de huecos) ---
+    DISPONIBILIDAD_MAX_DIAS = 62
+
+    def _odontologos_para_disponibilidad(self, request):
+        """[(id, nombre)] del tenant, opcionalmente limitados por ?odontologos=1,2,3."""
+        qs = Odontologo.objects.all()
+        if getattr(request, 'tenant', None):
+            qs = qs.filter(empresa=request.tenant)
+        ids = request.query_params.get('odontologos')
+        if ids:
+            qs = qs.filter(codusuario_id__in=[int(i) for i in ids.split(',') if i.strip()])
+        return [
+            (cod, f"{nombre} {apellido}")
+            for cod, nombre, apellido in qs.order_by('codusuario_id').values_list(
+                'codusuario_id', 'codusuario__nombre', 'codusuario__apellido'
             )
+        ]
 
-            # Filtrar por tenant
-            if tenant_detected:
-                horarios_ocupados_query = horarios_ocupados_query.filter(empresa=request.tenant)
+    def _validar_tipo_consulta(self, request):
+        tipo_id = request.query_params.get('tipo_consulta')
+        if not tipo_id:
+            return None
+        tipos = Tipodeconsulta.objects.filter(id=tipo_id)
+        if getattr(request, 'tenant', None):
+            tipos = tipos.filter(empresa=request.tenant)
+        if not tipos.exists():
+            raise serializers.ValidationError({"tipo_consulta": "Tipo de consulta inexistente."})
+        return int(tipo_id)
+
+    @action(detail=False, methods=['get'], url_path='disponibilidad')
+    def disponibilidad(self, request):
+        """
+        Matriz de disponibilidad de varios odontólogos en un rango de fechas.
+        GET /api/horarios/disponibilidad/?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD
+            [&odontologos=1,2][&tipo_consulta=3]
 
-            horarios_ocupados = horarios_ocupados_query.values_list('idhorario_id', flat=True)
-            logger.info(f"[Horarios Disponibles] Horarios ocupados IDs: {list(horarios_ocupados)}")
-        except Exception as e:
-            logger.error(f"[Horarios Disponibles] Error al filtrar horarios ocupados: {str(e)}")
+        Formato compacto: `libres[o][d]` son los índices (en `horarios`) libres del
+        odontólogo `odontologos[o]` el día `fechas[d]`.
+        """
+        from datetime import datetime as dt
+
+        try:
+            desde = dt.strptime(request.query_params.get('date_from', ''), '%Y-%m-%d').date()
+            hasta = dt.strptime(request.query_params.get('date_to', ''), '%Y-%m-%d').date()
+        except ValueError:
             return Response(
-                {"detail": f"Error al consultar horarios ocupados: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                {"detail": "Se requieren date_from y date_to con formato YYYY-MM-DD."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if desde > hasta or (hasta - desde).days >= self.DISPONIBILIDAD_MAX_DIAS:
+            return Response(
+                {"detail": f"Rango inválido (máximo {self.DISPONIBILIDAD_MAX_DIAS} días)."},
+                status=status.HTTP_400_BAD_REQUEST
             )
-
-        # 6. CALCULAR HORARIOS DISPONIBLES
         try:
-            horarios_disponibles = todos_horarios.exclude(id__in=horarios_ocupados)
-            count_disponibles = horarios_disponibles.count()
-            logger.info(f"[Horarios Disponibles] Horarios disponibles: {count_disponibles}")
+            odontologos = self._odontologos_para_disponibilidad(request)
+            tipo_consulta = self._validar_tipo_consulta(request)
+        except ValueError:
+            return Response({"detail": "odontologos debe ser una lista de ids."}, status=status.HTTP_400_BAD_REQUEST)
 
-            serializer = self.get_serializer(horarios_disponibles, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        except Exception as e:
-            logger.error(f"[Horarios Disponibles] Error al serializar horarios: {str(e)}")
+        empresa_id = request.tenant.id if getattr(request, 'tenant', None) else None
+        ids = [cod for cod, _ in odontologos]
+        slots, fechas, mascaras = matriz_disponibilidad(empresa_id, ids, desde, hasta)
+
+        return Response({
+            'horarios': [[hid, hora] for hid, hora in slots],
+            'fechas': [f.isoformat() for f in fechas],
+            'odontologos': [[cod, nombre] for cod, nombre in odontologos],
+            'tipo_consulta': tipo_consulta,
+            'libres': [
+                [
+                    [i for i in range(len(slots)) if not (mascaras[(od, f)] >> i) & 1]
+                    for f in fechas
+                ]
+                for od in ids
+            ],
+        })
+
+    @action(detail=False, methods=['get'], url_path='proximos-libres')
+    def proximos_libres(self, request):
+        """
+        Próximos N huecos libres con cualquier odontólogo (o los indicados).
+        GET /api/horarios/proximos-libres/?n=5[&desde=YYYY-MM-DD][&odontologos=1,2][&tipo_consulta=3]
+
+        `resultados` = [[fecha, horario_id, odontologo_id], ...] ordenados por fecha y hora.
+        """
+        from datetime import datetime as dt
+
+        try:
+            cantidad = min(max(int(request.query_params.get('n', 5)), 1), 100)
+            desde_param = request.query_params.get('desde')
+            hoy = timezone.localdate()
+            desde = dt.strptime(desde_param, '%Y-%m-%d').date() if desde_param else hoy
+            odontologos = self._odontologos_para_disponibilidad(request)
+            tipo_consulta = self._validar_tipo_consulta(request)
+        except ValueError:
             return Response(
-                {"detail": f"Error al procesar horarios disponibles: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                {"detail": "Parámetros inválidos (n entero, desde YYYY-MM-DD, odontologos lista de ids)."},
+                status=status.HTTP_400_BAD_REQUEST
             )
+        desde = max(desde, hoy)
+
+        empresa_id = request.tenant.id if getattr(request, 'tenant', None) else None
+        slots, resultados = buscar_proximos_libres(
+            empresa_id, [cod for cod, _ in odontologos], desde, cantidad,
+            dias_max=self.DISPONIBILIDAD_MAX_DIAS, ahora=timezone.localtime()
+        )
+        horas = dict(slots)
+        return Response({
+            'odontologos': [[cod, nombre] for cod, nombre in odontologos],
+            'tipo_consulta': tipo_consulta,
+            'resultados': [[f.isoformat(), hid, od] for f, hid, od in resultados],
+            'horas': {hid: horas[hid] for _, hid, _ in resultados},
+        })
 
 
 class TipodeconsultaViewSet(ReadOnlyModelViewSet):
@@ -736,11 +859,7 @@ class UserProfileView(RetrieveUpdateAPIView):
         En lugar de devolver request.user directamente, buscamos el perfil 'Usuario'
         que está vinculado a ese usuario de autenticación.
         """
-        try:
-            usuario_perfil = Usuario.objects.get(correoelectronico__iexact=self.request.user.email)
-            return usuario_perfil
-        except Usuario.DoesNotExist:
-            return None
+        return get_identity(self.request).usuario
 
 
 # -------------------- Historias Clínicas (HCE) --------------------
@@ -962,9 +1081,11 @@ class BitacoraViewSet(ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = BitacoraSerializer
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
-    search_fields = ['descripcion', 'usuario__nombre', 'usuario__apellido', 'ip_address']
-    ordering_fields = ['fecha_hora', 'accion', 'usuario__nombre']
-    ordering = ['-fecha_hora']  # Más recientes primero
+    search_fields = ['accion', 'tabla_afectada', 'usuario__nombre', 'usuario__apellido', 'ip_address']
+    ordering_fields = ['timestamp', 'accion', 'usuario__nombre']
+    # Más recientes primero. Filtrar/ordenar por "timestamp" (clave de partición) permite
+    # que PostgreSQL solo lea las particiones mensuales del rango (ver api.bitacora_partitions)
+    ordering = ['-timestamp']
 
     def get_queryset(self):
         # Solo admins pueden ver la bitácora
@@ -977,41 +1098,17 @@ class BitacoraViewSet(ReadOnlyModelViewSet):
         if hasattr(self.request, 'tenant') and self.request.tenant:
             queryset = queryset.filter(empresa=self.request.tenant)
 
-        # Filtros opcionales por parámetros GET
-        accion = self.request.query_params.get('accion', None)
-        if accion:
-            queryset = queryset.filter(accion=accion)
-
-        usuario_id = self.request.query_params.get('usuario_id', None)
-        if usuario_id:
-            queryset = queryset.filter(usuario_id=usuario_id)
-
-        # Filtro por fechas
-        fecha_desde = self.request.query_params.get('fecha_desde', None)
-        fecha_hasta = self.request.query_params.get('fecha_hasta', None)
-
-        if fecha_desde:
-            try:
-                fecha_desde = datetime.strptime(fecha_desde, '%Y-%m-%d')
-                fecha_desde = make_aware(fecha_desde)
-                queryset = queryset.filter(fecha_hora__gte=fecha_desde)
-            except ValueError:
-                pass
-
-        if fecha_hasta:
-            try:
-                fecha_hasta = datetime.strptime(fecha_hasta, '%Y-%m-%d')
-                fecha_hasta = make_aware(fecha_hasta.replace(hour=23, minute=59, second=59))
-                queryset = queryset.filter(fecha_hora__lte=fecha_hasta)
-            except ValueError:
-                pass
+        # Filtros opcionales por parámetros GET (la búsqueda la hace SearchFilter)
+        params = {k: v for k, v in self.request.query_params.items() if k != 'search'}
+        queryset = aplicar_filtros_bitacora(queryset, params)
 
         return queryset
 
     @action(detail=False, methods=['get'], url_path='estadisticas')
     def estadisticas(self, request):
         """
-        Endpoint para obtener estadísticas de la bitácora
+        Endpoint para obtener estadísticas de la bitácora.
+        Query params: fecha_desde, fecha_hasta (YYYY-MM-DD) y granularidad (dia | hora).
         """
         if not _es_admin_por_tabla(request):
             return Response(
@@ -1019,48 +1116,70 @@ class BitacoraViewSet(ReadOnlyModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        # Estadísticas de los últimos 30 días
-        fecha_limite = make_aware(datetime.now() - timedelta(days=30))
-        queryset = Bitacora.objects.filter(fecha_hora__gte=fecha_limite)
-
-        # Contar por acción
-        acciones = {}
-        for registro in queryset:
-            accion = registro.get_accion_display()
-            acciones[accion] = acciones.get(accion, 0) + 1
+        # Rango [fecha_desde, fecha_hasta] (YYYY-MM-DD, hasta inclusive); por defecto últimos 30 días
+        hoy = timezone.localdate()
+        fechas = {}
+        for nombre, defecto in (('fecha_desde', hoy - timedelta(days=29)), ('fecha_hasta', hoy)):
+            valor = request.query_params.get(nombre)
+            if not valor:
+                fechas[nombre] = defecto
+                continue
+            try:
+                fechas[nombre] = datetime.strptime(valor, '%Y-%m-%d').date()
+            except ValueError:
+                return Response(
+                    {"detail": f"{nombre} debe tener el formato YYYY-MM-DD."},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        fecha_desde, fecha_hasta = fechas['fecha_desde'], fechas['fecha_hasta']
+        if fecha_desde > fecha_hasta:
+            return Response(
+                {"detail": "fecha_desde no puede ser posterior a fecha_hasta."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        # Usuarios más activos
-        usuarios_activos = {}
-        for registro in queryset.filter(usuario__isnull=False).select_related('usuario'):
-            nombre = f"{registro.usuario.nombre} {registro.usuario.apellido}"
-            usuarios_activos[nombre] = usuarios_activos.get(nombre, 0) + 1
+        granularidad = request.query_params.get('granularidad', 'dia')
+        if granularidad not in GRANULARIDADES_BITACORA:
+            return Response(
+                {"detail": f"granularidad debe ser una de: {', '.join(GRANULARIDADES_BITACORA)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        # Ordenar usuarios por actividad
-        usuarios_activos = dict(sorted(usuarios_activos.items(), key=lambda x: x[1], reverse=True)[:10])
+        tenant = getattr(request, 'tenant', None)
+        # Se responde desde el resumen pre-agregado (api.bitacora_resumen), no desde bitacora
+        datos = estadisticas_bitacora(
+            empresa_id=tenant.id if tenant else None,
+            desde=make_aware(datetime.combine(fecha_desde, datetime.min.time())),
+            hasta=make_aware(datetime.combine(fecha_hasta + timedelta(days=1), datetime.min.time())),
+            granularidad=granularidad,
+        )
 
-        # Actividad por día (últimos 7 días)
+        # Compatibilidad con el gráfico actual: últimos 7 días del rango, clave dd/mm
         actividad_diaria = {}
-        for i in range(7):
-            fecha = datetime.now() - timedelta(days=i)
-            fecha_str = fecha.strftime('%d/%m')
-            inicio_dia = make_aware(fecha.replace(hour=0, minute=0, second=0, microsecond=0))
-            fin_dia = make_aware(fecha.replace(hour=23, minute=59, second=59, microsecond=999999))
-
-            count = queryset.filter(fecha_hora__range=[inicio_dia, fin_dia]).count()
-            actividad_diaria[fecha_str] = count
+        if granularidad == 'dia':
+            por_dia = {p['periodo']: p['total'] for p in datos['serie']}
+            for i in range(7):
+                dia = fecha_hasta - timedelta(days=i)
+                actividad_diaria[dia.strftime('%d/%m')] = por_dia.get(dia.isoformat(), 0)
 
         return Response({
-            'total_registros': queryset.count(),
-            'acciones': acciones,
-            'usuarios_activos': usuarios_activos,
+            'total_registros': datos['total_registros'],
+            'acciones': datos['acciones'],
+            'usuarios_activos': datos['usuarios_activos'],
             'actividad_diaria': actividad_diaria,
-            'periodo': 'Últimos 30 días'
+            'serie': datos['serie'],
+            'granularidad': granularidad,
+            'fecha_desde': fecha_desde.isoformat(),
+            'fecha_hasta': fecha_hasta.isoformat(),
+            'periodo': f"{fecha_desde:%d/%m/%Y} - {fecha_hasta:%d/%m/%Y}"
         })
 
-    @action(detail=False, methods=['get'], url_path='export')
+    @action(detail=False, methods=['get'], url_path='export',
+            renderer_classes=[JSONRenderer, *EXPORT_RENDERERS])
     def export(self, request):
         """
-        Endpoint para exportar bitácora en CSV o PDF
+        Endpoint para exportar bitácora en CSV, NDJSON o PDF.
+        CSV/NDJSON se envían en streaming y sin tope de filas; gzip=1 los comprime al vuelo.
         """
         if not _es_admin_por_tabla(request):
             return Response(
@@ -1070,164 +1189,98 @@ class BitacoraViewSet(ReadOnlyModelViewSet):
 
         format_type = request.query_params.get('format', 'csv').lower()
 
-        # Obtener datos con filtros aplicados
-        queryset = self.get_queryset()
-
-        # Aplicar filtros de la query
-        accion = request.query_params.get('accion', None)
-        if accion:
-            queryset = queryset.filter(accion=accion)
-
-        fecha_desde = request.query_params.get('fecha_desde', None)
-        fecha_hasta = request.query_params.get('fecha_hasta', None)
-
-        if fecha_desde:
-            try:
-                fecha_desde = datetime.strptime(fecha_desde, '%Y-%m-%d')
-                fecha_desde = make_aware(fecha_desde)
-                queryset = queryset.filter(fecha_hora__gte=fecha_desde)
-            except ValueError:
-                pass
-
-        if fecha_hasta:
-            try:
-                fecha_hasta = datetime.strptime(fecha_hasta, '%Y-%m-%d')
-                fecha_hasta = make_aware(fecha_hasta.replace(hour=23, minute=59, second=59))
-                queryset = queryset.filter(fecha_hora__lte=fecha_hasta)
-            except ValueError:
-                pass
-
-        search = request.query_params.get('search', None)
-        if search:
-            queryset = queryset.filter(
-                Q(descripcion__icontains=search) |
-                Q(usuario__nombre__icontains=search) |
-                Q(usuario__apellido__icontains=search) |
-                Q(ip_address__icontains=search)
+        if format_type == 'pdf':
+            # El PDF se genera fuera del request (comando procesar_reportes_bitacora)
+            reporte = crear_reporte_bitacora(
+                empresa=getattr(request, 'tenant', None),
+                usuario=get_identity(request).usuario,
+                params=request.query_params,
+            )
+            return Response(
+                self._reporte_data(reporte, request),
+                status=status.HTTP_202_ACCEPTED
             )
 
-        if format_type == 'csv':
-            return self._export_csv(queryset)
-        elif format_type == 'pdf':
-            return self._export_pdf(queryset)
+        # get_queryset ya aplica tenant, accion, usuario_id y el rango de fechas
+        queryset = self.get_queryset()
+        queryset = aplicar_filtros_bitacora(queryset, {'search': request.query_params.get('search')})
+
+        if format_type in ('csv', 'ndjson'):
+            comprimir = request.query_params.get('gzip', '').lower() in ('1', 'true', 'si')
+            return self._export_stream(queryset.order_by('-timestamp', '-id'), format_type, comprimir)
         else:
             return Response({"detail": "Formato no soportado"}, status=status.HTTP_400_BAD_REQUEST)
 
-    def _export_csv(self, queryset):
-        """Exportar a CSV"""
-        response = HttpResponse(content_type='text/csv; charset=utf-8')
-        response['Content-Disposition'] = f'attachment; filename="bitacora_{datetime.now().strftime("%Y%m%d")}.csv"'
-
-        # Agregar BOM para Excel
-        response.write('\ufeff')
-
-        writer = csv.writer(response)
-
-        # Escribir headers
-        writer.writerow([
-            'Fecha/Hora',
-            'Acción',
-            'Usuario',
-            'Descripción',
-            'IP',
-            'Navegador',
-            'Modelo Afectado',
-            'Objeto ID'
-        ])
-
-        # Escribir datos
-        for entry in queryset[:1000]:  # Limitar a 1000 registros
-            usuario_nombre = f"{entry.usuario.nombre} {entry.usuario.apellido}" if entry.usuario else "Usuario anónimo"
-
-            writer.writerow([
-                entry.fecha_hora.strftime('%d/%m/%Y %H:%M:%S'),
-                entry.get_accion_display(),
-                usuario_nombre,
-                entry.descripcion or '',
-                entry.ip_address,
-                entry.user_agent or '',
-                entry.modelo_afectado or '',
-                entry.objeto_id or ''
-            ])
-
+    def _export_stream(self, queryset, format_type, comprimir):
+        """Exportar a CSV o NDJSON en streaming (sin límite de filas, memoria constante)"""
+        if format_type == 'csv':
+            chunks = stream_csv(queryset)
+            content_type = 'text/csv; charset=utf-8'
+        else:
+            chunks = stream_ndjson(queryset)
+            content_type = 'application/x-ndjson; charset=utf-8'
+
+        filename = f'bitacora_{datetime.now().strftime("%Y%m%d")}.{format_type}'
+        if comprimir:
+            chunks = gzip_stream(chunks)
+            content_type = 'application/gzip'
+            filename += '.gz'
+
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        # Evita que nginx acumule la respuesta completa antes de enviarla
+        response['X-Accel-Buffering'] = 'no'
         return response
 
-    def _export_pdf(self, queryset):
-        """Exportar a PDF"""
-        try:
-            from reportlab.lib.pagesizes import A4
-            from reportlab.lib import colors
-            from reportlab.lib.units import inch
-            from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-            from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-        except ImportError:
-            return Response(
-                {"detail": "PDF export no disponible. Instale reportlab: pip install reportlab"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        elements = []
-
-        styles = getSampleStyleSheet()
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=16,
-            spaceAfter=30,
-            alignment=1  # Centrado
-        )
+    def _reporte_data(self, reporte, request):
+        return {
+            'id': str(reporte.id),
+            'estado': reporte.estado,
+            'total_registros': reporte.total_registros,
+            'paginas': reporte.paginas,
+            'error': reporte.error or None,
+            'fecha_creacion': reporte.fecha_creacion,
+            'fecha_fin': reporte.fecha_fin,
+            'status_url': request.build_absolute_uri(f"/api/bitacora/reportes/{reporte.id}/"),
+            'download_url': url_descarga_reporte(reporte, request),
+        }
 
-        # Título
-        title = Paragraph("Bitácora de Auditoría", title_style)
-        elements.append(title)
-
-        # Fecha de generación
-        fecha_gen = Paragraph(f"Generado el: {datetime.now().strftime('%d/%m/%Y %H:%M')}", styles['Normal'])
-        elements.append(fecha_gen)
-        elements.append(Spacer(1, 20))
-
-        # Datos de la tabla
-        data = [['Fecha/Hora', 'Acción', 'Usuario', 'Descripción', 'IP']]
-
-        for entry in queryset[:100]:  # Limitar a 100 para PDF
-            usuario_nombre = f"{entry.usuario.nombre} {entry.usuario.apellido}" if entry.usuario else "Anónimo"
-
-            data.append([
-                entry.fecha_hora.strftime('%d/%m/%Y %H:%M'),
-                entry.get_accion_display(),
-                usuario_nombre,
-                (entry.descripcion or '')[:50] + '...' if len(entry.descripcion or '') > 50 else (
-                        entry.descripcion or ''),
-                entry.ip_address
-            ])
-
-        # Crear tabla
-        table = Table(data, colWidths=[1.2 * inch, 1 * inch, 1.2 * inch, 2 * inch, 1 * inch])
-
-        # Estilo de tabla
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 1), (-1, -1), 8),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-
-        elements.append(table)
-        doc.build(elements)
-
-        buffer.seek(0)
-        response = HttpResponse(buffer.read(), content_type='application/pdf')
-        response['Content-Disposition'] = f'attachment; filename="bitacora_{datetime.now().strftime("%Y%m%d")}.pdf"'
+    def _get_reporte(self, request, reporte_id):
+        reportes = ReporteBitacora.objects.all()
+        tenant = getattr(request, 'tenant', None)
+        if tenant:
+            reportes = reportes.filter(empresa=tenant)
+        return reportes.filter(id=reporte_id).first()
 
-        return response
+    @action(detail=False, methods=['get'], url_path=r'reportes/(?P<reporte_id>[0-9a-f-]{36})')
+    def reporte(self, request, reporte_id=None):
+        """
+        Estado de un reporte PDF solicitado con export?format=pdf.
+        Cuando estado == COMPLETADO incluye download_url.
+        """
+        if not _es_admin_por_tabla(request):
+            return Response({"detail": "No tienes permisos para ver reportes."}, status=status.HTTP_403_FORBIDDEN)
+        reporte = self._get_reporte(request, reporte_id)
+        if not reporte:
+            return Response({"detail": "Reporte no encontrado."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(self._reporte_data(reporte, request))
+
+    @action(detail=False, methods=['get'], url_path=r'reportes/(?P<reporte_id>[0-9a-f-]{36})/descargar')
+    def descargar_reporte(self, request, reporte_id=None):
+        """Descarga de reportes guardados en disco (los de S3 usan URL firmada)."""
+        if not _es_admin_por_tabla(request):
+            return Response({"detail": "No tienes permisos para ver reportes."}, status=status.HTTP_403_FORBIDDEN)
+        reporte = self._get_reporte(request, reporte_id)
+        if not reporte or reporte.estado != 'COMPLETADO' or reporte.almacenamiento != 'local':
+            return Response({"detail": "Reporte no disponible."}, status=status.HTTP_404_NOT_FOUND)
+        if not os.path.exists(reporte.archivo):
+            return Response({"detail": "El archivo del reporte ya no existe."}, status=status.HTTP_410_GONE)
+        return FileResponse(
+            open(reporte.archivo, 'rb'),
+            as_attachment=True,
+            filename=f"bitacora_{reporte.fecha_creacion:%Y%m%d_%H%M}.pdf",
+            content_type='application/pdf'
+        )
 
 
 # ============================================================================
@@ -1335,14 +1388,7 @@ class DocumentoClinicoViewSet(ModelViewSet):
             url_s3 = f"https://{settings.AWS_STORAGE_BUCKET_NAME}.s3.{settings.AWS_S3_REGION_NAME}.amazonaws.com/{nombre_s3}"
 
             # Buscar el Usuario (modelo de negocio) del usuario autenticado
-            usuario_profesional = None
-            if request.user.is_authenticated:
-                try:
-                    usuario_profesional = Usuario.objects.get(
-                        correoelectronico__iexact=request.user.email
-                    )
-                except Usuario.DoesNotExist:
-                    pass
+            usuario_profesional = get_identity(request).usuario
 
             # Crear registro en la base de datos
             documento = DocumentoClinico.objects.create(
@@ -1565,14 +1611,15 @@ class DocumentoClinicoViewSet(ModelViewSet):
     def _crear_bitacora(self, request, accion, descripcion, modelo, objeto_id):
         """Método auxiliar para crear registros en la bitácora"""
         try:
-            Bitacora.objects.create(
+            registrar_bitacora(
                 accion=accion,
                 tabla_afectada=modelo,
-                registro_id=objeto_id,
-                usuario=request.user,
+                registro_id=int(objeto_id) if objeto_id else None,
+                usuario=get_identity(request).usuario,
                 ip_address=self._get_client_ip(request),
                 user_agent=request.META.get('HTTP_USER_AGENT', '')[:255],
-                empresa=getattr(request, 'tenant', None)
+                empresa=getattr(request, 'tenant', None),
+                valores_nuevos={'descripcion': descripcion}
             )
         except Exception:
             pass  # No fallar si hay error en bitácora
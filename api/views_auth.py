@@ -28,7 +28,6 @@ from .models import (
     Paciente,
     Odontologo,
     Recepcionista,
-    Bitacora,
     BloqueoUsuario,  # Import del modelo de bloqueo
 )
 from .serializers import (
@@ -37,6 +36,7 @@ from .serializers import (
     NotificationPreferencesSerializer,
 )
 from .serializers_auth import RegisterSerializer
+from .audit_sink import registrar_bitacora
 
 User = get_user_model()
 
@@ -281,13 +281,19 @@ def auth_login(request):
 
         # Log de login (tolerante a fallos: jamás rompe el login)
         try:
-            Bitacora.objects.create(
+            registrar_bitacora(
                 accion='login',
-                descripcion=f'Login exitoso - {usuario.nombre} {usuario.apellido}',
-                codusuario=usuario.codigo,
+                usuario=usuario,
+                empresa=usuario.empresa_id,
                 ip_address=_client_ip(request),
                 user_agent=request.META.get('HTTP_USER_AGENT', ''),
-                datos_adicionales={'email': email, 'metodo': 'manual_login_view'}
+                tabla_afectada='Usuario',
+                registro_id=usuario.codigo,
+                valores_nuevos={
+                    'descripcion': f'Login exitoso - {usuario.nombre} {usuario.apellido}',
+                    'email': email,
+                    'metodo': 'manual_login_view',
+                }
             )
         except Exception as log_error:
             # Importante: NO lanzar excepción aquí
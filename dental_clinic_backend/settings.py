@@ -4,6 +4,7 @@ Django settings for dental_clinic_backend project.
 
 from pathlib import Path
 import os
+import sys
 from dotenv import load_dotenv
 
 # Cargar variables de entorno desde archivo .env
@@ -187,6 +188,19 @@ DATABASES = {
     }
 }
 
+# ------------------------------------
+# Caché
+# ------------------------------------
+# Por defecto LocMemCache (por proceso). En producción con varios workers
+# conviene una caché compartida (Redis/Memcached) para que las invalidaciones
+# (p. ej. la versión de la caché de tenants) lleguen a todos los workers.
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("DJANGO_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.environ.get("DJANGO_CACHE_LOCATION", ""),
+    }
+}
+
 # ------------------------------------
 # Password validators
 # ------------------------------------
@@ -253,6 +267,20 @@ SAAS_BASE_DOMAIN = "notificct.dpdns.org"
 # Este es el dominio SIN subdominio donde los clientes se registran
 SAAS_PUBLIC_URL = f"https://{SAAS_BASE_DOMAIN}"
 
+# Caché de resolución subdominio -> Empresa (api.tenant_cache)
+TENANT_CACHE_TTL = int(os.environ.get('TENANT_CACHE_TTL', 300))  # segundos (acierto)
+TENANT_CACHE_NEGATIVE_TTL = int(os.environ.get('TENANT_CACHE_NEGATIVE_TTL', 30))  # subdominio desconocido
+TENANT_CACHE_VERSION_CHECK = 5  # cada cuántos segundos se consulta la versión compartida
+
+# Catálogos TipoNotificacion / CanalNotificacion en memoria (api.catalogo_notificaciones)
+NOTIF_CATALOG_TTL = int(os.environ.get('NOTIF_CATALOG_TTL', 600))  # segundos
+NOTIF_CATALOG_VERSION_CHECK = 5  # cada cuántos segundos se consulta la versión compartida
+
+# Bitmaps de disponibilidad de horarios (api.availability). El TTL largo solo aplica con
+# caché compartida; con LocMemCache los cambios no llegan a los demás workers y se usa el corto
+AVAILABILITY_CACHE_TTL = int(os.environ.get('AVAILABILITY_CACHE_TTL', 600))  # segundos
+AVAILABILITY_CACHE_TTL_LOCAL = int(os.environ.get('AVAILABILITY_CACHE_TTL_LOCAL', 10))  # segundos
+
 # Ejemplo de URLs resultantes:
 # - Sitio público: https://notificct.dpdns.org
 # - Tenant "norte": https://norte.notificct.dpdns.org
@@ -269,6 +297,32 @@ EMAIL_HOST_PASSWORD = ""  # IMPORTANTE: Agrega aquí tu API key de email
 EMAIL_USE_TLS = True
 EMAIL_USE_SSL = False
 
+# Bandeja de salida (api.email_outbox, comando despachar_correos)
+EMAIL_OUTBOX_LOTE = int(os.environ.get('EMAIL_OUTBOX_LOTE', 50))  # correos por conexión SMTP
+EMAIL_OUTBOX_MAX_INTENTOS = int(os.environ.get('EMAIL_OUTBOX_MAX_INTENTOS', 8))
+EMAIL_OUTBOX_BACKOFF_BASE = 30  # segundos; se duplica en cada fallo
+EMAIL_OUTBOX_BACKOFF_MAX = 3600
+
+# ------------------------------------
+# Bitácora (api.audit_sink)
+# ------------------------------------
+# Los registros se encolan por worker y se insertan por lotes en segundo plano.
+# En tests se escriben de forma síncrona para poder verificarlos.
+AUDIT_ASYNC = os.environ.get('AUDIT_ASYNC', '1') == '1' and 'test' not in sys.argv
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 100))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 2.0))  # segundos
+AUDIT_SPOOL_PATH = os.environ.get('AUDIT_SPOOL_PATH', str(BASE_DIR / 'var' / 'audit_spool.jsonl'))
+
+# Particiones mensuales de la bitácora (comando bitacora_particiones)
+BITACORA_RETENCION_MESES = int(os.environ.get('BITACORA_RETENCION_MESES', 12))  # Empresa.retencion_bitacora_meses la ajusta
+BITACORA_PARTICIONES_ADELANTE = 3  # meses que se pre-crean
+BITACORA_ARCHIVO_DIR = os.environ.get('BITACORA_ARCHIVO_DIR', str(BASE_DIR / 'var' / 'bitacora_archivo'))
+
+# Reportes PDF de bitácora (comando procesar_reportes_bitacora); con AWS_STORAGE_BUCKET_NAME se suben a S3
+REPORTES_BITACORA_DIR = os.environ.get('REPORTES_BITACORA_DIR', str(BASE_DIR / 'var' / 'reportes_bitacora'))
+# Cada cuántos segundos el worker renueva fecha_inicio de un reporte en curso (< REPORTES_BITACORA_TIMEOUT)
+REPORTES_BITACORA_LATIDO = int(os.environ.get('REPORTES_BITACORA_LATIDO', 60))
+
 # ------------------------------------
 # CONFIGURACIÓN DE NOTIFICACIONES
 # ------------------------------------
@@ -276,6 +330,27 @@ EMAIL_USE_SSL = False
 # Push Notifications (OneSignal - Opcional)
 ONESIGNAL_APP_ID = ""  # Agrega tu OneSignal App ID aquí
 ONESIGNAL_REST_API_KEY = ""  # Agrega tu OneSignal REST API Key aquí
+ONESIGNAL_LOTE = 2000  # player ids por request en envíos masivos (máximo de OneSignal)
+SUPABASE_PUSH_LOTE = int(os.environ.get('SUPABASE_PUSH_LOTE', 500))  # tokens por llamada a la Edge Function
+
+# Push Expo (api.notifications_mobile.expo_sender): URLs configurables para un Expo falso en pruebas
+EXPO_PUSH_URL = os.environ.get('EXPO_PUSH_URL', 'https://exp.host/--/api/v2/push/send')
+EXPO_RECEIPTS_URL = os.environ.get('EXPO_RECEIPTS_URL', 'https://exp.host/--/api/v2/push/getReceipts')
+
+# Push FCM HTTP v1 (api.notifications_mobile.fcm_sender)
+FCM_BASE_URL = os.environ.get('FCM_BASE_URL', 'https://fcm.googleapis.com')  # un FCM falso local en pruebas
+FCM_CONCURRENCIA = int(os.environ.get('FCM_CONCURRENCIA', 16))  # envíos simultáneos por proceso
+FCM_MAX_REINTENTOS = 3  # ante 429 / 5xx
+# NotificationService: canales de una notificación en paralelo, con plazo por canal (segundos)
+NOTIF_CANALES_CONCURRENCIA = int(os.environ.get('NOTIF_CANALES_CONCURRENCIA', 8))
+NOTIF_TIMEOUT_CANAL = {'email': 15, 'push': 10}
+# NotificationService.enviar_notificacion pasa a modo masivo (envío por lotes) desde N usuarios
+NOTIFICACIONES_MASIVO_UMBRAL = int(os.environ.get('NOTIFICACIONES_MASIVO_UMBRAL', 20))
+# POST /api/mobile-notif/dispatch-due/: filas por lote y segundos máximos por llamada
+MOBILE_DISPATCH_LOTE = int(os.environ.get('MOBILE_DISPATCH_LOTE', 200))
+MOBILE_DISPATCH_PRESUPUESTO = float(os.environ.get('MOBILE_DISPATCH_PRESUPUESTO', 25))
+# Minutos tras los cuales un reclamo del despacho (claimed_at) se da por abandonado
+MOBILE_DISPATCH_RECLAMO_MIN = int(os.environ.get('MOBILE_DISPATCH_RECLAMO_MIN', 10))
 
 # ------------------------------------
 # Stripe (Pagos SaaS - Opcional)
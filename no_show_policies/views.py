@@ -8,6 +8,7 @@ from django.utils.functional import cached_property
 import logging
 
 from api.models import Estadodeconsulta, Empresa
+from api.identity import get_identity
 from .serializers import EstadodeconsultaSerializer, PoliticaNoShowSerializer
 from .models import PoliticaNoShow
 
@@ -23,6 +24,7 @@ class EmpresaFromRequestMixin:
     """
     Resuelve empresa_id (tenant) desde múltiples fuentes.
     Orden:
+      0) request.tenant (TenantMiddleware) y la identidad del request (api.identity)
       1) request.user.empresa_id
       2) request.user.empresa.id
       3) Perfil enlazado: usuario/perfil/profile/userprofile/usuario_perfil/usuario_profile
@@ -227,6 +229,11 @@ class EmpresaFromRequestMixin:
             logger.debug(f"[EmpresaFromRequestMixin] Usando tenant del middleware: {tenant.nombre} (ID: {tenant.id})")
             return tenant.id
 
+        # PRIORIDAD 2: identidad de negocio ya resuelta en este request (sesión o Token, ver api.identity)
+        eid = get_identity(req).empresa_id
+        if eid:
+            return eid
+
         user = getattr(req, "user", None)
 
         if getattr(user, "is_authenticated", False):